@@ -10,12 +10,23 @@ from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash, check_password_hash
 from extensions import socketio
 from state import online_users
-from backend.db import init_db, get_db, is_admin
+from backend.db import init_db, get_db
+from backend.principal import is_admin, current_principal, is_asset_request
 from backend.auth import auth_bp
-from backend.email_service import send_welcome_email
 from backend.admin import admin_bp
 from backend.payment import payment_bp
 from backend.webhook import webhook_bp
+from backend.query_stats import init_query_stats
+from backend.catalog import get_catalog
+from backend.conditional import etag
+from backend.notifications import (
+    notifications_etag, feed_page, unread_count, mark_read, archive_read,
+    sync_notification_state, FEED_PAGE_SIZE, BROADCAST_FLOOR_SQL
+)
+import backend.socket_events  # registers the Socket.IO connect/disconnect handlers
+from backend.assets import init_assets
+from backend.outbox import init_outbox, outbox_emails, wake_outbox
+from backend.fanout import init_fanout
 
 import requests
 import hashlib
@@ -46,6 +57,10 @@ app.config.update(
 )
 
 socketio.init_app(app)
+init_query_stats(app)
+init_assets(app)
+init_outbox(app)
+init_fanout(app)
 
 # =====================
 # REGISTER BLUEPRINTS
@@ -86,19 +101,18 @@ def force_custom_domain():
 
 @app.before_request
 def make_session_permanent():
+    if is_asset_request():
+        return
     session.permanent = True
 
 @app.before_request
 def block_suspended_users():
-    if "user_id" in session:
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("SELECT is_suspended FROM users WHERE id=?", (session["user_id"],))
-        user = c.fetchone()
-        conn.close()
-        if user and user["is_suspended"]:
-            session.clear()
-            return redirect("/login-page")
+    if is_asset_request():
+        return
+    principal = current_principal()
+    if principal and principal.is_suspended:
+        session.clear()
+        return redirect("/login-page")
 
 # =====================
 # PAGES
@@ -181,27 +195,33 @@ def register():
         conn.close()
         return jsonify({"error": "Email already exists"}), 400
 
-    c.execute(
-        "INSERT INTO users (name, email, password, department, level) VALUES (?, ?, ?, ?, ?)",
-        (name, email, hashed_pw, department, level)
-    )
-    user_id = c.lastrowid
-
-    c.execute("SELECT id FROM payments WHERE user_id=? ORDER BY id DESC LIMIT 1", (user_id,))
-    if not c.fetchone():
-        c.execute(
-            "INSERT INTO payments (user_id, amount, status) VALUES (?, ?, ?)",
-            (user_id, 1026375, "unpaid")
-        )
+    # A brand-new user has no payments yet; the rows and the queued welcome
+    # email go in one atomic round trip
+    try:
+        conn.batch([
+            (
+                "INSERT INTO users (name, email, password, department, level, broadcast_floor) "
+                f"VALUES (?, ?, ?, ?, ?, {BROADCAST_FLOOR_SQL})",
+                (name, email, hashed_pw, department, level)
+            ),
+            (
+                "INSERT INTO payments (user_id, amount, status) VALUES (last_insert_rowid(), ?, ?)",
+                (1026375, "unpaid")
+            ),
+            # Keyed to the new user id: a deleted account's key must not
+            # swallow the welcome when the same email registers again
+            outbox_emails("SELECT id FROM users WHERE email = ?", (email,), "welcome", {}, "welcome:"),
+        ])
+    except Exception as e:
+        conn.close()
+        if "UNIQUE" in str(e):
+            # Lost a race with a concurrent registration for the same email
+            return jsonify({"error": "Email already exists"}), 400
+        raise
 
     conn.commit()
     conn.close()
-
-    # Send welcome email
-    try:
-        send_welcome_email(email, name)
-    except Exception as e:
-        print("Welcome email failed:", e)
+    wake_outbox()
 
     return jsonify({"message": "Registration successful", "redirect": "/login-page"}), 201
 
@@ -212,31 +232,28 @@ def courses_page():
     if is_admin(session["user_id"]):
         return redirect("/admin")
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT id, course_code, course_title, description FROM courses ORDER BY id DESC")
-    courses = c.fetchall()
-    conn.close()
-
-    return render_template("courses.html", courses=courses)
+    return render_template("courses.html", courses=get_catalog().courses)
 
 
 # =====================
 # COURSES FOR USERS
 # =====================
+def _my_courses_etag():
+    if "user_id" not in session:
+        return None
+    return get_catalog().etag
+
+
 @app.route("/api/courses/my")
+@etag(_my_courses_etag)
 def my_courses():
     if "user_id" not in session:
         return jsonify({"error": "Not authenticated"}), 401
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT id, course_code, course_title FROM courses ORDER BY id DESC")
     courses = [
         {"id": r["id"], "code": r["course_code"], "title": r["course_title"]}
-        for r in c.fetchall()
+        for r in get_catalog().courses
     ]
-    conn.close()
 
     return jsonify({"courses": courses})
 
@@ -248,30 +265,17 @@ def course_page(course_id):
     if "user_id" not in session:
         return redirect("/login-page")
 
-    conn = get_db()
-    c = conn.cursor()
-
-    c.execute("SELECT * FROM payments WHERE user_id=? ORDER BY id DESC LIMIT 1", (session["user_id"],))
-    payment = c.fetchone()
-
-    admin_override = payment["admin_override_status"] if payment and payment["admin_override_status"] else None
-    if not payment or (payment["status"] != "paid" and admin_override != "paid"):
-        conn.close()
+    principal = current_principal()
+    if not principal or not principal.has_paid:
         return "<h3>Payment required to access this course</h3>", 403
 
-    c.execute("SELECT * FROM courses WHERE id=?", (course_id,))
-    course = c.fetchone()
+    catalog = get_catalog()
+    course = catalog.course(course_id)
     if not course:
-        conn.close()
         abort(404)
 
-    c.execute("SELECT * FROM materials WHERE course_id=? AND file_type='audio'", (course_id,))
-    audios = c.fetchall()
-
-    c.execute("SELECT * FROM materials WHERE course_id=? AND file_type='pdf'", (course_id,))
-    pdfs = c.fetchall()
-
-    conn.close()
+    audios = catalog.materials(course_id, "audio")
+    pdfs = catalog.materials(course_id, "pdf")
 
     return render_template("course.html", course=course, audios=audios, pdfs=pdfs)
 
@@ -283,45 +287,15 @@ def pdf_viewer(course_id, material_id):
     if "user_id" not in session:
         return redirect("/login-page")
 
-    conn = get_db()
-    c = conn.cursor()
-
-    c.execute(
-        """
-        SELECT status, admin_override_status
-        FROM payments
-        WHERE user_id=?
-        ORDER BY id DESC
-        LIMIT 1
-        """,
-        (session["user_id"],)
-    )
-    payment = c.fetchone()
-
-    if not payment or (
-        payment["status"] != "paid"
-        and payment["admin_override_status"] != "paid"
-    ):
-        conn.close()
+    principal = current_principal()
+    if not principal or not principal.has_paid:
         return "<h3>Payment required to access PDF</h3>", 403
 
-    c.execute("SELECT * FROM courses WHERE id=?", (course_id,))
-    course = c.fetchone()
-    if not course:
-        conn.close()
+    catalog = get_catalog()
+    if not catalog.course(course_id):
         abort(404)
 
-    c.execute(
-        """
-        SELECT id, filename
-        FROM materials
-        WHERE id=? AND course_id=? AND file_type='pdf'
-        """,
-        (material_id, course_id)
-    )
-    material = c.fetchone()
-    conn.close()
-
+    material = catalog.material(material_id, course_id, "pdf")
     if not material:
         abort(404)
 
@@ -362,24 +336,11 @@ def stream_audio(material_id):
     if "user_id" not in session:
         abort(403)
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT * FROM payments WHERE user_id=? ORDER BY id DESC LIMIT 1", (session["user_id"],))
-    payment = c.fetchone()
-    admin_override = payment["admin_override_status"] if payment and payment["admin_override_status"] else None
-
-    if not payment or (payment["status"] != "paid" and admin_override != "paid"):
-        conn.close()
+    principal = current_principal()
+    if not principal or not principal.has_paid:
         abort(403)
 
-    c.execute("""
-        SELECT m.filename
-        FROM materials m
-        JOIN courses c ON m.course_id = c.id
-        WHERE m.id=? AND m.file_type='audio'
-    """, (material_id,))
-    material = c.fetchone()
-    conn.close()
+    material = get_catalog().material(material_id, file_type="audio")
 
     if not material:
         abort(404)
@@ -396,27 +357,11 @@ def stream_pdf(material_id):
     if "user_id" not in session:
         abort(403)
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT * FROM payments WHERE user_id=? ORDER BY id DESC LIMIT 1",
-        (session["user_id"],)
-    )
-    payment = c.fetchone()
-    admin_override = payment["admin_override_status"] if payment else None
-
-    if not payment or (payment["status"] != "paid" and admin_override != "paid"):
-        conn.close()
+    principal = current_principal()
+    if not principal or not principal.has_paid:
         abort(403)
 
-    c.execute("""
-        SELECT m.filename
-        FROM materials m
-        JOIN courses c ON m.course_id = c.id
-        WHERE m.id=? AND m.file_type='pdf'
-    """, (material_id,))
-    material = c.fetchone()
-    conn.close()
+    material = get_catalog().material(material_id, file_type="pdf")
 
     if not material:
         abort(404)
@@ -431,38 +376,84 @@ def stream_pdf(material_id):
 # NOTIFICATIONS API
 # =====================
 @app.route("/api/notifications")
+@etag(notifications_etag)
 def get_notifications():
     if "user_id" not in session:
-        return jsonify([])
-
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("""
-        SELECT * FROM notifications
-        WHERE user_id=? AND is_archived=0
-        ORDER BY created_at DESC
-    """, (session["user_id"],))
-    rows = c.fetchall()
-    conn.close()
+        return jsonify({"items": [], "has_more": False})
+
+    return jsonify(feed_page(
+        session["user_id"],
+        before=request.args.get("before", type=int),
+        since_id=request.args.get("since_id", type=int),
+        limit=request.args.get("limit", FEED_PAGE_SIZE, type=int),
+    ))
+
+@app.route("/api/notifications/unread-count")
+@etag(notifications_etag)
+def get_unread_count():
+    if "user_id" not in session:
+        return jsonify({"unread": 0})
 
-    return jsonify([dict(r) for r in rows])
+    return jsonify({"unread": unread_count(session["user_id"])})
 
 @app.route("/api/notifications/read/<int:notif_id>", methods=["POST"])
 def mark_notification_read(notif_id):
     if "user_id" not in session:
         return jsonify({"error": "Unauthorized"}), 401
 
+    return _change_notifications("read", mark_read, from_id=notif_id, to_id=notif_id)
+
+@app.route("/api/notifications/read-all", methods=["POST"])
+def mark_all_notifications_read():
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    return _change_notifications("read", mark_read)
+
+@app.route("/api/notifications/read-range", methods=["POST"])
+def mark_notification_range_read():
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    data = request.get_json() or {}
+    try:
+        from_id = int(data["from_id"]) if data.get("from_id") is not None else None
+        to_id = int(data["to_id"]) if data.get("to_id") is not None else None
+    except (TypeError, ValueError):
+        return jsonify({"error": "from_id and to_id must be integers"}), 400
+    if from_id is None and to_id is None:
+        return jsonify({"error": "from_id or to_id is required"}), 400
+
+    return _change_notifications("read", mark_read, from_id=from_id, to_id=to_id)
+
+@app.route("/api/notifications/archive", methods=["POST"])
+def archive_notifications():
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    data = request.get_json() or {}
+    try:
+        days = int(data.get("older_than_days", 30))
+    except (TypeError, ValueError):
+        return jsonify({"error": "older_than_days must be an integer"}), 400
+    if days < 0:
+        return jsonify({"error": "older_than_days must not be negative"}), 400
+
+    return _change_notifications("archive", archive_read, days)
+
+def _change_notifications(action, change, *args, **kwargs):
+    user_id = session["user_id"]
     conn = get_db()
-    c = conn.cursor()
-    c.execute("""
-        UPDATE notifications
-        SET is_read=1
-        WHERE id=? AND user_id=?
-    """, (notif_id, session["user_id"]))
-    conn.commit()
+    with conn.transaction():
+        ids = change(conn, user_id, *args, **kwargs)
     conn.close()
 
-    return jsonify({"success": True})
+    # Other tabs only hear about it when something actually changed
+    if ids:
+        payload = sync_notification_state(user_id, action, ids)
+    else:
+        payload = {"action": action, "ids": [], "unread": unread_count(user_id)}
+    return jsonify({"success": True, **payload})
 
 # =====================
 # PAYMENT SUCCESS
@@ -514,14 +505,9 @@ def settings():
     c = conn.cursor()
     c.execute("SELECT id, name, email, level FROM users WHERE id=?", (session["user_id"],))
     user = c.fetchone()
-    c.execute("""
-        SELECT COALESCE(p.admin_override_status, p.status) AS status
-        FROM payments p WHERE p.user_id=?
-        ORDER BY p.id DESC LIMIT 1
-    """, (session["user_id"],))
-    payment = c.fetchone()
     conn.close()
-    payment_status = payment["status"] if payment else "unpaid"
+    principal = current_principal()
+    payment_status = principal.effective_payment_status if principal else "unpaid"
     return render_template("settings.html", user=user, payment_status=payment_status)
 
 # =====================
@@ -1,13 +1,15 @@
-from flask import Blueprint, render_template, jsonify, session, redirect, request, abort, flash, send_file, url_for, current_app
-from extensions import socketio
+from flask import Blueprint, render_template, stream_template, jsonify, session, redirect, request, abort, flash, send_file, url_for, current_app
 from state import online_users
-from backend.db import get_db, is_admin
+from backend.db import get_db, pool_stats, KeysetPager
+from backend.principal import is_admin, revoke_claims
+from backend.catalog import bump_catalog_version
+from backend.notifications import bump_notif_version, BROADCAST_USER_ID
+from backend.fanout import create_job, start_job, get_job
+from backend.push import push_stats
 from functools import wraps
-from pywebpush import webpush
-import json
 import os
 from werkzeug.utils import secure_filename
-from backend.email_service import send_email, send_new_material_email
+from backend.outbox import wake_outbox, outbox_stats, retry_dead
 admin_bp = Blueprint("admin_bp", __name__, url_prefix="/admin")
 # ---------------------
 # ADMIN GUARD
@@ -33,6 +35,11 @@ def dashboard():
     conn.close()
     return render_template("admin/dashboard.html", unread=unread)
 
+@admin_bp.route("/api/db-pool")
+@admin_required
+def db_pool_stats():
+    return jsonify(pool_stats())
+
 @admin_bp.route("/api/subscribe", methods=["POST"])
 def subscribe():
 
@@ -43,20 +50,28 @@ def subscribe():
     if not user_id:
         return jsonify({"error": "Not logged in"}), 401
 
-    data = request.get_json()
+    data = request.get_json(silent=True) or {}
+    keys = data.get("keys") or {}
+    if not data.get("endpoint") or not keys.get("p256dh") or not keys.get("auth"):
+        return jsonify({"error": "Invalid subscription"}), 400
 
+    # One row per endpoint: a re-subscribe (or another account signing in
+    # on the same browser) refreshes the existing row
     conn = get_db()
-    c = conn.cursor()
-
-    c.execute("""
-        INSERT OR REPLACE INTO push_subscriptions
-        (user_id, endpoint, p256dh, auth)
-        VALUES (?, ?, ?, ?)
+    conn.execute("""
+        INSERT INTO push_subscriptions
+        (user_id, endpoint, p256dh, auth, last_seen)
+        VALUES (?, ?, ?, ?, datetime('now'))
+        ON CONFLICT(endpoint) DO UPDATE SET
+            user_id = excluded.user_id,
+            p256dh = excluded.p256dh,
+            auth = excluded.auth,
+            last_seen = excluded.last_seen
     """, (
         user_id,
         data["endpoint"],
-        data["keys"]["p256dh"],
-        data["keys"]["auth"]
+        keys["p256dh"],
+        keys["auth"]
     ))
 
     conn.commit()
@@ -94,116 +109,78 @@ def send_notification():
         flash("Missing title or message", "error")
         return redirect(url_for("admin_bp.notifications_page"))
 
-    conn = get_db()
-    c = conn.cursor()
+    if not send_all and not user_id:
+        flash("Select a user or choose send to all", "error")
+        return redirect(url_for("admin_bp.notifications_page"))
 
     # ---------------------
-    # DETERMINE TARGET USERS
+    # SAVE NOTIFICATION + JOB
     # ---------------------
-    if send_all:
-        c.execute("SELECT id, email FROM users WHERE role != 'admin'")
-        users = c.fetchall()
-    else:
-        if not user_id:
-            flash("Select a user or choose send to all", "error")
-            conn.close()
-            return redirect(url_for("admin_bp.notifications_page"))
+    # A broadcast is a single row shared by every student; a personal
+    # notification is one row for its user. Critical emails are queued in the
+    # same transaction; the rest of the delivery runs in the background.
+    conn = get_db()
+    with conn.transaction():
+        if send_all:
+            notification = conn.execute("""
+                INSERT INTO notifications (user_id, title, message, link, is_critical)
+                VALUES (?, ?, ?, ?, ?) RETURNING id, user_id
+            """, (BROADCAST_USER_ID, title, message, link, int(is_critical))).fetchone()
+        else:
+            notification = conn.execute("""
+                INSERT INTO notifications (user_id, title, message, link, is_critical)
+                SELECT id, ?, ?, ?, ? FROM users WHERE id = ? RETURNING id, user_id
+            """, (title, message, link, int(is_critical), user_id)).fetchone()
+        job_id = None
+        if notification:
+            if not send_all:
+                bump_notif_version(conn, [notification["user_id"]])
+            job_id = create_job(conn, notification, (title, message) if is_critical else None)
+    conn.close()
 
-        c.execute("SELECT id, email FROM users WHERE id=?", (user_id,))
-        users = c.fetchall()
+    if notification is None:
+        flash("User not found", "error")
+        return redirect(url_for("admin_bp.notifications_page"))
 
-    # ---------------------
-    # PROCESS EACH USER
-    # ---------------------
-    for user in users:
+    start_job(job_id)
+    if is_critical:
+        wake_outbox()
 
-        uid = int(user["id"])
-        email = user["email"]
+    progress_url = url_for("admin_bp.notification_job", job_id=job_id)
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify({"job_id": job_id, "progress_url": progress_url}), 202
 
-        # 1️⃣ Save notification in DB
-        c.execute("""
-            INSERT INTO notifications (user_id, title, message, link, is_critical)
-            VALUES (?, ?, ?, ?, ?)
-        """, (uid, title, message, link, int(is_critical)))
-
-        # 2️⃣ Real-time WebSocket
-        socketio.emit(
-            "new_notification",
-            {
-                "title": title,
-                "message": message,
-                "link": link
-            },
-            room=f"user_{uid}"
-        )
+    flash(f"Notification queued for delivery (job #{job_id}, progress: {progress_url})", "success")
+    return redirect(url_for("admin_bp.notifications_page"))
 
-        # 3️⃣ Push Notification
-        try:
-            send_push(uid, title, message, link)
-        except Exception as e:
-            print("Push error:", e)
-
-        # 4️⃣ Email ONLY if critical
-        if is_critical:
-            try:
-                send_email(
-                    to_email=email,
-                    subject=title,
-                    body=message
-                )
-            except Exception as e:
-                print("Email failed:", e)
-
-    # Commit AFTER loop finishes
-    conn.commit()
-    conn.close()
 
-    flash("Notification sent successfully", "success")
-    return redirect(url_for("admin_bp.notifications_page"))
+@admin_bp.route("/api/push-stats")
+@admin_required
+def push_delivery_stats():
+    return jsonify(push_stats())
 
 
-# ---------------------
-# PUSH DELIVERY
-# ---------------------
+@admin_bp.route("/api/email-outbox")
+@admin_required
+def email_outbox():
+    return jsonify(outbox_stats())
 
-def send_push(user_id, title, message, link):
 
-    conn = get_db()
-    c = conn.cursor()
+@admin_bp.route("/api/email-outbox/<int:email_id>/retry", methods=["POST"])
+@admin_required
+def retry_outbox_email(email_id):
+    if not retry_dead(email_id):
+        return jsonify({"error": "No dead-lettered email with that id"}), 404
+    return jsonify({"success": True})
 
-    c.execute("SELECT * FROM push_subscriptions WHERE user_id=?", (user_id,))
-    subs = c.fetchall()
-    conn.close()
 
-    print(f"send_push: user={user_id}, subs found={len(subs)}")
-
-    for sub in subs:
-        try:
-            private_key = os.environ.get("VAPID_PRIVATE_KEY")
-            print(f"VAPID_PRIVATE_KEY present: {bool(private_key)}")
-            print(f"Endpoint: {sub['endpoint'][:60]}")
-
-            webpush(
-                subscription_info={
-                    "endpoint": sub["endpoint"],
-                    "keys": {
-                        "p256dh": sub["p256dh"],
-                        "auth": sub["auth"]
-                    }
-                },
-                data=json.dumps({
-                    "title": title,
-                    "message": message,
-                    "link": link
-                }),
-                vapid_private_key=private_key,
-                vapid_claims={
-                    "sub": "mailto:wideminddevs@gmail.com"
-                }
-            )
-            print("Push sent successfully!")
-        except Exception as e:
-            print(f"Push failed: {type(e).__name__}: {e}")
+@admin_bp.route("/api/notifications/jobs/<int:job_id>")
+@admin_required
+def notification_job(job_id):
+    job = get_job(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
 
 
 # ---------------------
@@ -212,16 +189,12 @@ def send_push(user_id, title, message, link):
 @admin_bp.route("/messages")
 @admin_required
 def messages():
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("""
+    # Newest first by id (same order as created_at), streamed page by page
+    messages = KeysetPager("""
         SELECT id, name, email, subject, message, created_at, is_read
         FROM contact_messages
-        ORDER BY created_at DESC
     """)
-    messages = c.fetchall()
-    conn.close()
-    return render_template("admin/messages.html", messages=messages)
+    return stream_template("admin/messages.html", messages=messages)
 
 @admin_bp.route("/messages/unread-count")
 @admin_required
@@ -345,6 +318,7 @@ def toggle_suspend_user(user_id):
         SET is_suspended = CASE WHEN is_suspended = 1 THEN 0 ELSE 1 END
         WHERE id = ?
     """, (user_id,))
+    revoke_claims(conn, user_id)
     conn.commit()
     c.execute("SELECT is_suspended FROM users WHERE id = ?", (user_id,))
     user = c.fetchone()
@@ -356,16 +330,17 @@ def toggle_suspend_user(user_id):
 @admin_required
 def delete_user(user_id):
     conn = get_db()
-    c = conn.cursor()
-
-    # Delete all related records first
-    c.execute("DELETE FROM payments WHERE user_id=?", (user_id,))
-    c.execute("DELETE FROM notifications WHERE user_id=?", (user_id,))
-    c.execute("DELETE FROM push_subscriptions WHERE user_id=?", (user_id,))
-    c.execute("DELETE FROM password_resets WHERE user_id=?", (user_id,))
 
-    # Now delete the user
-    c.execute("DELETE FROM users WHERE id=?", (user_id,))
+    # Related records first, then the user — one atomic round trip
+    conn.batch([
+        ("DELETE FROM payments WHERE user_id=?", (user_id,)),
+        ("DELETE FROM notifications WHERE user_id=?", (user_id,)),
+        ("DELETE FROM broadcast_state WHERE user_id=?", (user_id,)),
+        ("DELETE FROM push_subscriptions WHERE user_id=?", (user_id,)),
+        ("DELETE FROM password_resets WHERE user_id=?", (user_id,)),
+        ("DELETE FROM users WHERE id=?", (user_id,)),
+    ])
+    revoke_claims(conn, user_id)
 
     conn.commit()
     conn.close()
@@ -377,54 +352,53 @@ def delete_user(user_id):
 # ---------------------
 
 def get_user_list(filter_type):
-    conn = get_db()
-    c = conn.cursor()
-
+    # Each user appears once, with their latest payment; rows are paged by
+    # id so long lists stream out in bounded chunks
     base_query = """
         SELECT
             u.id, u.name, u.email, u.level, u.role, u.is_suspended,
             COALESCE(p.admin_override_status, p.status) AS payment_status
         FROM users u
-        LEFT JOIN payments p ON u.id = p.user_id
+        LEFT JOIN payments p ON p.id = (
+            SELECT MAX(id) FROM payments WHERE user_id = u.id
+        )
         WHERE u.role != 'admin'
     """
 
     if filter_type == "paid":
-        c.execute(base_query + " AND COALESCE(p.admin_override_status, p.status) = 'paid' ORDER BY u.id DESC")
+        query = base_query + " AND COALESCE(p.admin_override_status, p.status) = 'paid'"
     elif filter_type == "unpaid":
-        c.execute(base_query + " AND (COALESCE(p.admin_override_status, p.status) != 'paid' OR p.id IS NULL) ORDER BY u.id DESC")
+        query = base_query + " AND (COALESCE(p.admin_override_status, p.status) != 'paid' OR p.id IS NULL)"
     elif filter_type == "suspended":
-        c.execute(base_query + " AND u.is_suspended = 1 ORDER BY u.id DESC")
+        query = base_query + " AND u.is_suspended = 1"
     else:  # all
-        c.execute(base_query + " ORDER BY u.id DESC")
+        query = base_query
 
-    users = c.fetchall()
-    conn.close()
-    return users
+    return KeysetPager(query)
 
 
 @admin_bp.route("/users/all")
 @admin_required
 def users_all():
-    return render_template("admin/total.html", users=get_user_list("all"))
+    return stream_template("admin/total.html", users=get_user_list("all"))
 
 
 @admin_bp.route("/users/paid")
 @admin_required
 def users_paid():
-    return render_template("admin/paid.html", users=get_user_list("paid"))
+    return stream_template("admin/paid.html", users=get_user_list("paid"))
 
 
 @admin_bp.route("/users/unpaid")
 @admin_required
 def users_unpaid():
-    return render_template("admin/unpaid.html", users=get_user_list("unpaid"))
+    return stream_template("admin/unpaid.html", users=get_user_list("unpaid"))
 
 
 @admin_bp.route("/users/suspended")
 @admin_required
 def users_suspended():
-    return render_template("admin/suspended.html", users=get_user_list("suspended"))
+    return stream_template("admin/suspended.html", users=get_user_list("suspended"))
 # ---------------------
 # TOGGLE PAYMENT (FIXED)
 # ---------------------
@@ -464,6 +438,7 @@ def toggle_payment(user_id):
             WHERE id=?
         """, (new_status, payment["id"]))
 
+    revoke_claims(conn, user_id)
     conn.commit()
     conn.close()
     flash(f"Payment marked as {new_status}", "success")
@@ -500,6 +475,7 @@ def add_course():
         flash(f"Course code '{course_code}' already exists.", "error")
         return redirect(url_for("admin_bp.courses"))
     c.execute("INSERT INTO courses (course_code, course_title, description) VALUES (?, ?, ?)", (course_code, course_title, description))
+    bump_catalog_version(conn)
     conn.commit()
     conn.close()
     flash("Course added successfully!", "success")
@@ -523,6 +499,7 @@ def edit_course(course_id):
             return redirect(f"/admin/courses/edit/{course_id}")
         c.execute("UPDATE courses SET course_code=?, course_title=?, description=? WHERE id=?", 
                   (course_code, course_title, description, course_id))
+        bump_catalog_version(conn)
         conn.commit()
         flash("Course updated successfully!", "success")
     c.execute("SELECT * FROM courses WHERE id=?", (course_id,))
@@ -538,6 +515,7 @@ def delete_course(course_id):
     conn = get_db()
     c = conn.cursor()
     c.execute("DELETE FROM courses WHERE id=?", (course_id,))
+    bump_catalog_version(conn)
     conn.commit()
     conn.close()
     flash("Course deleted", "success")
@@ -592,38 +570,29 @@ def add_material(file_type, course_id):
     # Build public URL
     file_url = f"{supabase_url}/storage/v1/object/public/{bucket}/{filename}"
 
-    # Save to Turso
-    c.execute(
-        "INSERT INTO materials (course_id, filename, file_type, title, file_url) VALUES (?, ?, ?, ?, ?)",
-        (course_id, filename, file_type, title, file_url)
-    )
-    conn.commit()
-    conn.close()
-    # Send new material email to all paid users
-    try:
-        conn2 = get_db()
-        c2 = conn2.cursor()
-        c2.execute("SELECT * FROM courses WHERE id=?", (course_id,))
-        course = c2.fetchone()
-        c2.execute("""
-            SELECT u.name, u.email FROM users u
+    # Save to Turso, queueing the announcement for every paid user in the
+    # same transaction (the outbox sends it in the background)
+    with conn.transaction():
+        material_id = conn.execute(
+            "INSERT INTO materials (course_id, filename, file_type, title, file_url) VALUES (?, ?, ?, ?, ?) RETURNING id",
+            (course_id, filename, file_type, title, file_url)
+        ).fetchone()["id"]
+        conn.execute("""
+            INSERT INTO email_outbox (to_email, template, params, dedupe_key)
+            SELECT u.email, 'new_material', json_object(
+                'name', u.name, 'material_title', ?,
+                'course_title', COALESCE((SELECT course_title FROM courses WHERE id=?), 'your course'),
+                'file_type', ?, 'course_id', ?
+            ), 'material:' || ? || ':' || u.id
+            FROM users u
             JOIN payments p ON u.id = p.user_id
             WHERE u.role != 'admin'
             AND COALESCE(p.admin_override_status, p.status) = 'paid'
-        """)
-        paid_users = c2.fetchall()
-        conn2.close()
-        for u in paid_users:
-            send_new_material_email(
-                to_email=u["email"],
-                name=u["name"],
-                material_title=title,
-                course_title=course["course_title"] if course else "your course",
-                file_type=file_type,
-                course_id=course_id
-            )
-    except Exception as e:
-        print("New material email failed:", e)
+            ON CONFLICT(dedupe_key) DO NOTHING
+        """, (title, course_id, file_type, course_id, material_id))
+        bump_catalog_version(conn)
+    conn.close()
+    wake_outbox()
 
     flash("Material uploaded successfully!", "success")
     return redirect(f"/admin/courses/edit/{course_id}")
@@ -652,6 +621,7 @@ def delete_material(material_id):
 
     # Delete from Turso
     c.execute("DELETE FROM materials WHERE id=?", (material_id,))
+    bump_catalog_version(conn)
     conn.commit()
     conn.close()
     return redirect(f"/admin/courses/edit/{material['course_id']}")
\ No newline at end of file
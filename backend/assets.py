@@ -0,0 +1,417 @@
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+import time
+from flask import request, send_from_directory, url_for, abort
+from markupsafe import Markup, escape
+
+try:
+    import brotli
+except ImportError:  # gzip-only builds still work
+    brotli = None
+
+try:
+    from PIL import Image, features
+except ImportError:  # images are copied as-is without Pillow
+    Image = None
+
+try:
+    import fcntl
+except ImportError:  # no cross-process build lock off Unix
+    fcntl = None
+
+# -----------------------
+# STATIC ASSET PIPELINE
+# -----------------------
+# `python -m backend.assets` copies static/css, static/js and static/images
+# into static/dist under content-hashed names, writes .gz/.br variants,
+# resized AVIF/WebP images (with Pillow) and a manifest. Templates call
+# asset_url("css/main.css") or picture("images/x.png", ...); once the
+# manifest exists those URLs point at /assets/..., served as immutable with
+# the best precompressed encoding the browser accepts. static/dist is not
+# committed, so the deploy step runs the build; without one the helpers fall
+# back to the plain /static/ URL (ASSETS_BUILD_ON_START=1 builds on boot
+# instead, at the cost of a slower start).
+# Each build goes into its own directory under static/dist-builds and
+# static/dist is a symlink switched to it in one rename. Hashed files the
+# new build no longer produces are carried over for ASSET_GRACE_DAYS, so
+# pages rendered from an older manifest keep working.
+STATIC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "static")
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+BUILDS_DIR = os.path.join(STATIC_DIR, "dist-builds")
+MANIFEST_PATH = os.path.join(DIST_DIR, "manifest.json")
+BUILD_LOCK_PATH = DIST_DIR + ".lock"
+ASSETS_BUILD_ON_START = os.environ.get("ASSETS_BUILD_ON_START", "0") == "1"
+ASSET_GRACE_DAYS = int(os.environ.get("ASSET_GRACE_DAYS", "7"))
+
+SOURCE_DIRS = ("images", "css", "js")  # images first so CSS url() can be rewritten
+SKIP_FILES = {"js/service-worker.js"}  # must keep a stable URL for its scope
+COMPRESS_EXTENSIONS = {".css", ".js", ".svg", ".json"}
+
+# Optional concatenated bundles, referenced as asset_url("bundle/<name>")
+BUNDLES = {
+    "base.css": ["css/main.css", "css/dark.css"],
+}
+
+# Responsive variants for raster images: every width below the source's
+# own, in each modern format the installed Pillow can encode
+RASTER_EXTENSIONS = {".png", ".jpg", ".jpeg"}
+IMAGE_WIDTHS = (160, 320, 640, 960, 1280)
+IMAGE_FORMATS = (("image/avif", "AVIF", ".avif", 50), ("image/webp", "WEBP", ".webp", 75))
+
+# Small fixed-size PNGs derived from a source: name -> (source, width)
+DERIVED_IMAGES = {
+    "images/logo-email.png": ("images/logo.png", 260),
+    "images/logo-icon.png": ("images/logo.png", 192),
+}
+
+# Images sent in emails: every hashed version ever built is kept, since
+# messages already in inboxes link to them for good
+EMAIL_IMAGES = {"images/logo-email.png"}
+
+SITE_URL = os.environ.get("SITE_URL", "https://www.widemindtutorial.com")
+
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+_CSS_URL_RE = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+_manifest = {"mtime": None, "files": {}, "images": {}}
+
+
+# -----------------------
+# BUILD
+# -----------------------
+def _fingerprint(path, data):
+    root, ext = os.path.splitext(path)
+    return f"{root}.{hashlib.sha256(data).hexdigest()[:10]}{ext}"
+
+
+def _write(out_dir, rel_path, data):
+    target = os.path.join(out_dir, rel_path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, "wb") as f:
+        f.write(data)
+    if os.path.splitext(rel_path)[1] in COMPRESS_EXTENSIONS:
+        with open(target + ".gz", "wb") as f:
+            f.write(gzip.compress(data, 9, mtime=0))
+        if brotli is not None:
+            with open(target + ".br", "wb") as f:
+                f.write(brotli.compress(data, quality=11))
+
+
+def _image_formats():
+    if Image is None:
+        return []
+    return [f for f in IMAGE_FORMATS if features.check(f[1].lower())]
+
+
+def _resized(image, width):
+    if width >= image.width:
+        return image.copy()
+    height = round(image.height * width / image.width)
+    return image.resize((width, height), Image.LANCZOS)
+
+
+def _build_image_variants(out_dir, rel_path, source_path, formats):
+    with Image.open(source_path) as image:
+        image.load()
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+        widths = [w for w in IMAGE_WIDTHS if w < image.width] + [image.width]
+        root = os.path.splitext(rel_path)[0]
+        variants = {}
+        for mime, pil_format, ext, quality in formats:
+            entries = []
+            for width in widths:
+                buffer = io.BytesIO()
+                _resized(image, width).save(buffer, pil_format, quality=quality)
+                data = buffer.getvalue()
+                hashed = _fingerprint(f"{root}-{width}w{ext}", data)
+                _write(out_dir, hashed, data)
+                entries.append([width, hashed])
+            variants[mime] = entries
+        return {"width": image.width, "height": image.height, "variants": variants}
+
+
+def _build_derived_image(source_path, width):
+    with Image.open(source_path) as image:
+        image = _resized(image.convert("RGBA"), width)
+        image = image.quantize(256, method=Image.Quantize.FASTOCTREE)
+        buffer = io.BytesIO()
+        image.save(buffer, "PNG", optimize=True)
+        return buffer.getvalue()
+
+
+def _rewrite_css_urls(css_path, text, files):
+    base = os.path.dirname(css_path)
+
+    def replace(match):
+        url = match.group(2).strip()
+        if url.startswith(("data:", "http:", "https:", "//", "#")):
+            return match.group(0)
+        target = os.path.normpath(os.path.join(base, url)).replace(os.sep, "/")
+        if target in files:
+            return f'url("/assets/{files[target]}")'
+        return match.group(0)
+
+    return _CSS_URL_RE.sub(replace, text)
+
+
+def _is_email_image(rel_path):
+    root, ext = os.path.splitext(rel_path)
+    return any(
+        root.rsplit(".", 1)[0] + ext == image and len(root.rsplit(".", 1)[-1]) == 10
+        for image in EMAIL_IMAGES
+    )
+
+
+def _carry_over(out_dir):
+    # Copies the previous build's files that this one did not produce, until
+    # they have been retired for ASSET_GRACE_DAYS (email images forever);
+    # returns {path: retired_at}
+    try:
+        with open(MANIFEST_PATH) as f:
+            previous = json.load(f).get("retired", {})
+    except (OSError, ValueError):
+        previous = {}
+    now = time.time()
+    retired = {}
+    for dirpath, _, filenames in os.walk(DIST_DIR):
+        for filename in filenames:
+            source = os.path.join(dirpath, filename)
+            rel_path = os.path.relpath(source, DIST_DIR).replace(os.sep, "/")
+            target = os.path.join(out_dir, rel_path)
+            if rel_path == "manifest.json" or os.path.exists(target):
+                continue
+            retired_at = previous.get(rel_path, now)
+            if now - retired_at >= ASSET_GRACE_DAYS * 86400 and not _is_email_image(rel_path):
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copy2(source, target)
+            retired[rel_path] = retired_at
+    return retired
+
+
+def _publish(out_dir):
+    # Points static/dist at out_dir in one rename, then removes older builds
+    link = os.path.join(STATIC_DIR, ".dist-link")
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.relpath(out_dir, STATIC_DIR), link)
+    if os.path.isdir(DIST_DIR) and not os.path.islink(DIST_DIR):
+        # A plain directory from before builds were versioned
+        os.replace(DIST_DIR, os.path.join(BUILDS_DIR, "previous"))
+    os.replace(link, DIST_DIR)
+    for name in os.listdir(BUILDS_DIR):
+        path = os.path.join(BUILDS_DIR, name)
+        if path != out_dir:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def build():
+    os.makedirs(BUILDS_DIR, exist_ok=True)
+    out_dir = tempfile.mkdtemp(prefix="build-", dir=BUILDS_DIR)
+    os.chmod(out_dir, 0o755)
+    try:
+        files, images = _build_into(out_dir)
+        retired = _carry_over(out_dir)
+        with open(os.path.join(out_dir, "manifest.json"), "w") as f:
+            json.dump({"files": files, "images": images, "retired": retired}, f, indent=2, sort_keys=True)
+        _publish(out_dir)
+    except BaseException:
+        shutil.rmtree(out_dir, ignore_errors=True)
+        raise
+    return files
+
+
+def _build_into(out_dir):
+    files = {}
+    images = {}
+    by_digest = {}  # identical sources share one set of output files
+    formats = _image_formats()
+
+    for folder in SOURCE_DIRS:
+        source_root = os.path.join(STATIC_DIR, folder)
+        for dirpath, _, filenames in os.walk(source_root):
+            for filename in sorted(filenames):
+                rel_path = os.path.relpath(os.path.join(dirpath, filename), STATIC_DIR).replace(os.sep, "/")
+                if rel_path in SKIP_FILES:
+                    continue
+                source_path = os.path.join(STATIC_DIR, rel_path)
+                with open(source_path, "rb") as f:
+                    data = f.read()
+                if rel_path.endswith(".css"):
+                    data = _rewrite_css_urls(rel_path, data.decode("utf-8"), files).encode("utf-8")
+
+                digest = hashlib.sha256(data).hexdigest()
+                if digest in by_digest:
+                    original = by_digest[digest]
+                    files[rel_path] = files[original]
+                    if original in images:
+                        images[rel_path] = images[original]
+                    continue
+                by_digest[digest] = rel_path
+
+                hashed = _fingerprint(rel_path, data)
+                _write(out_dir, hashed, data)
+                files[rel_path] = hashed
+                if formats and os.path.splitext(rel_path)[1].lower() in RASTER_EXTENSIONS:
+                    images[rel_path] = _build_image_variants(out_dir, rel_path, source_path, formats)
+
+    if Image is not None:
+        for name, (source, width) in DERIVED_IMAGES.items():
+            data = _build_derived_image(os.path.join(STATIC_DIR, source), width)
+            hashed = _fingerprint(name, data)
+            _write(out_dir, hashed, data)
+            files[name] = hashed
+
+    for name, parts in BUNDLES.items():
+        data = b"\n".join(
+            open(os.path.join(out_dir, files[part]), "rb").read() for part in parts
+        )
+        hashed = _fingerprint(f"bundle/{name}", data)
+        _write(out_dir, hashed, data)
+        files[f"bundle/{name}"] = hashed
+    return files, images
+
+
+def ensure_built():
+    # Workers booting together build once: the rest wait on the lock and
+    # then find the manifest
+    if os.path.exists(MANIFEST_PATH):
+        return
+    if not ASSETS_BUILD_ON_START:
+        print(f"[ASSETS] WARNING: {MANIFEST_PATH} is missing; serving unhashed /static/ files. "
+              "Run `python -m backend.assets` in the deploy step.")
+        return
+    print("[ASSETS] WARNING: no asset manifest, building static/dist now")
+    try:
+        # static/ may be read-only; that only means serving unhashed files
+        with open(BUILD_LOCK_PATH, "w") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(MANIFEST_PATH):
+                return
+            built = build()
+    except Exception as e:
+        print(f"[ASSETS] WARNING: build failed, serving unhashed /static/ files: {type(e).__name__}: {e}")
+        return
+    print(f"[ASSETS] built {len(built)} assets")
+
+
+# -----------------------
+# TEMPLATE HELPER
+# -----------------------
+def _load_manifest():
+    try:
+        mtime = os.path.getmtime(MANIFEST_PATH)
+    except OSError:
+        _manifest.update(mtime=None, files={}, images={})
+        return _manifest
+    if mtime != _manifest["mtime"]:
+        with open(MANIFEST_PATH) as f:
+            data = json.load(f)
+        _manifest.update(mtime=mtime, files=data["files"], images=data["images"])
+    return _manifest
+
+
+def asset_url(path):
+    hashed = _load_manifest()["files"].get(path)
+    if hashed:
+        return f"/assets/{hashed}"
+    if path.startswith("bundle/"):
+        # Bundles only exist after a build; templates go through asset_urls()
+        return None
+    if path in DERIVED_IMAGES:
+        return asset_url(DERIVED_IMAGES[path][0])
+    return url_for("static", filename=path)
+
+
+def asset_urls(bundle):
+    # The bundle when built, otherwise its individual source files
+    url = asset_url(f"bundle/{bundle}")
+    if url:
+        return [url]
+    return [url_for("static", filename=part) for part in BUNDLES[bundle]]
+
+
+def _attrs(attrs):
+    # class_="x" -> class="x"; None values are left out
+    return "".join(
+        f' {name.rstrip("_").replace("_", "-")}="{escape(value)}"'
+        for name, value in attrs.items() if value is not None
+    )
+
+
+def picture(path, alt="", sizes="100vw", loading="lazy", **attrs):
+    # <picture> with AVIF/WebP srcsets when the build produced variants,
+    # otherwise a plain <img>
+    info = _load_manifest()["images"].get(path)
+    img_attrs = {"src": asset_url(path), "alt": alt, "loading": loading, "decoding": "async"}
+    if info:
+        img_attrs.update(width=info["width"], height=info["height"])
+    img = f"<img{_attrs({**img_attrs, **attrs})}>"
+    if not info:
+        return Markup(img)
+
+    sources = "".join(
+        f"<source{_attrs({'type': mime, 'srcset': ', '.join(f'/assets/{h} {w}w' for w, h in entries), 'sizes': sizes})}>"
+        for mime, entries in info["variants"].items()
+    )
+    return Markup(f"<picture>{sources}{img}</picture>")
+
+
+def email_logo_url():
+    # Absolute URL for emails; the small derived logo once built
+    hashed = _load_manifest()["files"].get("images/logo-email.png")
+    if hashed:
+        return f"{SITE_URL}/assets/{hashed}"
+    return f"{SITE_URL}/static/images/logo.png"
+
+
+# -----------------------
+# SERVING
+# -----------------------
+def serve_asset(filename):
+    path = os.path.normpath(filename)
+    if path.startswith("..") or path.endswith((".gz", ".br")):
+        abort(404)
+    mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    encoding = None
+    for candidate, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if request.accept_encodings[candidate] and os.path.exists(os.path.join(DIST_DIR, path + suffix)):
+            encoding, path = candidate, path + suffix
+            break
+
+    response = send_from_directory(DIST_DIR, path, mimetype=mimetype, max_age=31536000)
+    response.headers["Cache-Control"] = CACHE_CONTROL
+    response.headers["Vary"] = "Accept-Encoding"
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def init_assets(app):
+    ensure_built()
+    app.add_url_rule("/assets/<path:filename>", "assets", serve_asset)
+
+    @app.context_processor
+    def inject_assets():
+        return {"asset_url": asset_url, "asset_urls": asset_urls, "picture": picture}
+
+
+if __name__ == "__main__":
+    built = build()
+    notes = []
+    if brotli is None:
+        notes.append("no brotli module: gzip only")
+    if Image is None:
+        notes.append("no Pillow: images copied without variants")
+    print(f"Built {len(built)} assets into {DIST_DIR}" + (f" ({'; '.join(notes)})" if notes else ""))
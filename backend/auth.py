@@ -1,7 +1,9 @@
 from flask import Blueprint, jsonify, session, request
 from werkzeug.security import check_password_hash, generate_password_hash
-from backend.db import get_db, is_admin
-from backend.email_service import send_email
+from backend.db import get_db
+from backend.principal import revoke_claims, current_principal
+from backend.conditional import etag
+from backend.outbox import outbox_email, wake_outbox
 import secrets
 import hashlib
 from datetime import datetime, timedelta
@@ -11,7 +13,16 @@ auth_bp = Blueprint("auth_bp", __name__)
 # ---------------------
 # GET CURRENT USER
 # ---------------------
+def _me_etag():
+    # Profile fields never change in place; role changes bump auth_epoch
+    principal = current_principal()
+    if principal is None:
+        return None
+    return f"me-{principal.user_id}-{principal.auth_epoch}"
+
+
 @auth_bp.route("/me", methods=["GET"])
+@etag(_me_etag)
 def me():
     if "user_id" not in session:
         return jsonify({"error": "Not authenticated"}), 401
@@ -51,7 +62,7 @@ def login():
     conn = get_db()
     c = conn.cursor()
     c.execute(
-        "SELECT id, password, is_suspended FROM users WHERE email=?",
+        "SELECT id, password, is_suspended, role FROM users WHERE email=?",
         (email,)
     )
     user = c.fetchone()
@@ -68,8 +79,9 @@ def login():
 
     session.permanent = True
     session["user_id"] = user["id"]
+    session.pop("claims", None)
 
-    if is_admin(user["id"]):
+    if user["role"] == "admin":
         return jsonify({"redirect": "/admin"}), 200
     else:
         return jsonify({"redirect": "/account"}), 200
@@ -100,53 +112,21 @@ def forgot_password():
     token_hash = hashlib.sha256(raw_token.encode()).hexdigest()
     expires_at = (datetime.utcnow() + timedelta(hours=1)).strftime("%Y-%m-%d %H:%M:%S")
 
-    # Store token in db (create table if needed)
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS password_resets (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            token_hash TEXT NOT NULL,
-            expires_at TEXT NOT NULL,
-            used INTEGER DEFAULT 0
-        )
-    """)
-    # Clear old tokens for this user
-    c.execute("DELETE FROM password_resets WHERE user_id=?", (user["id"],))
-    c.execute(
-        "INSERT INTO password_resets (user_id, token_hash, expires_at) VALUES (?, ?, ?)",
-        (user["id"], token_hash, expires_at)
-    )
-    conn.commit()
-    conn.close()
-
     reset_link = f"https://www.widemindtutorial.com/reset-password?token={raw_token}"
 
-    body = f"""
-        <p>Hi <strong>{user['name']}</strong>,</p>
-        <p>We received a request to reset your password for your Wide Mind Tutorial account.</p>
-        <p>Click the button below to reset it. This link expires in <strong>1 hour</strong>.</p>
-        <div style="text-align:center;margin:28px 0;">
-            <a href="{reset_link}"
-               style="background:linear-gradient(135deg,#8B7500,#d4af37);
-                      color:#fff;
-                      padding:14px 32px;
-                      border-radius:8px;
-                      text-decoration:none;
-                      font-weight:bold;
-                      font-size:15px;">
-                Reset My Password
-            </a>
-        </div>
-        <p style="font-size:13px;color:#777;">
-            If you didn't request this, you can safely ignore this email.
-            Your password will not change.
-        </p>
-        <p style="font-size:12px;color:#999;word-break:break-all;">
-            Or copy this link: {reset_link}
-        </p>
-    """
-
-    send_email(email, "Reset Your Password — Wide Mind Tutorial", body)
+    # Replace any old tokens for this user (table is created by migrations)
+    # and queue the email in the same atomic round trip
+    conn.batch([
+        ("DELETE FROM password_resets WHERE user_id=?", (user["id"],)),
+        (
+            "INSERT INTO password_resets (user_id, token_hash, expires_at) VALUES (?, ?, ?)",
+            (user["id"], token_hash, expires_at)
+        ),
+        outbox_email(email, "password_reset", {"name": user["name"], "reset_link": reset_link}),
+    ])
+    conn.commit()
+    conn.close()
+    wake_outbox()
 
     return jsonify({"message": "If that email exists, a reset link has been sent."}), 200
 
@@ -193,6 +173,7 @@ def reset_password():
     hashed = generate_password_hash(new_password)
     c.execute("UPDATE users SET password=? WHERE id=?", (hashed, record["user_id"]))
     c.execute("UPDATE password_resets SET used=1 WHERE token_hash=?", (token_hash,))
+    revoke_claims(conn, record["user_id"])
     conn.commit()
     conn.close()
 
@@ -0,0 +1,105 @@
+import os
+import threading
+import time
+from backend.db import get_primary
+
+# -----------------------
+# COURSE CATALOG
+# -----------------------
+# Courses and their materials change only through the admin course pages,
+# so each worker keeps a snapshot in memory. Admin writes bump
+# catalog_version in schema_meta; workers compare it at most every
+# CATALOG_CHECK_INTERVAL seconds and reload only when it moved. The
+# version also serves as the catalog's ETag.
+CATALOG_CHECK_INTERVAL = float(os.environ.get("CATALOG_CHECK_INTERVAL", "5"))
+
+_state = {"catalog": None, "checked": 0.0}
+_lock = threading.Lock()
+
+
+class Catalog:
+    def __init__(self, version, courses, materials):
+        self.version = version
+        self.courses = courses  # newest first, as the course list shows them
+        self._courses = {c["id"]: c for c in courses}
+        self._materials = {m["id"]: m for m in materials}
+        self._by_course = {}
+        for m in materials:
+            self._by_course.setdefault((m["course_id"], m["file_type"]), []).append(m)
+
+    @property
+    def etag(self):
+        return f"catalog-{self.version}"
+
+    def course(self, course_id):
+        return self._courses.get(course_id)
+
+    def materials(self, course_id, file_type):
+        return self._by_course.get((course_id, file_type), [])
+
+    def material(self, material_id, course_id=None, file_type=None):
+        m = self._materials.get(material_id)
+        if m is None or m["course_id"] not in self._courses:
+            return None
+        if course_id is not None and m["course_id"] != course_id:
+            return None
+        if file_type is not None and m["file_type"] != file_type:
+            return None
+        return m
+
+
+def _read_version(conn):
+    row = conn.execute(
+        "SELECT value FROM schema_meta WHERE key='catalog_version'"
+    ).fetchone()
+    return int(row["value"]) if row else 0
+
+
+def _load(conn, version):
+    courses, materials = conn.batch([
+        ("SELECT * FROM courses ORDER BY id DESC", ()),
+        ("SELECT * FROM materials ORDER BY id", ()),
+    ])
+    return Catalog(
+        version,
+        [dict(r) for r in courses.fetchall()],
+        [dict(r) for r in materials.fetchall()],
+    )
+
+
+def get_catalog():
+    catalog = _state["catalog"]
+    if catalog is not None and time.monotonic() - _state["checked"] < CATALOG_CHECK_INTERVAL:
+        return catalog
+
+    # One greenlet refreshes; the others keep serving the current snapshot
+    if not _lock.acquire(blocking=catalog is None):
+        return catalog
+    try:
+        catalog = _state["catalog"]
+        if catalog is not None and time.monotonic() - _state["checked"] < CATALOG_CHECK_INTERVAL:
+            return catalog
+        # Straight from the primary: a lagging replica must not be cached
+        # under the new version
+        conn = get_primary()
+        try:
+            version = _read_version(conn)
+            if catalog is None or catalog.version != version:
+                catalog = _load(conn, version)
+        finally:
+            conn.close()
+        _state["catalog"] = catalog
+        _state["checked"] = time.monotonic()
+        return catalog
+    finally:
+        _lock.release()
+
+
+def bump_catalog_version(conn):
+    # Runs on the caller's connection so it commits with their write; this
+    # worker re-checks on its next read, the others within the interval
+    conn.execute("""
+        INSERT INTO schema_meta (key, value) VALUES ('catalog_version', '1')
+        ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+    """)
+    _state["checked"] = 0.0
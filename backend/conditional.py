@@ -0,0 +1,32 @@
+from functools import wraps
+from flask import request, make_response
+
+# -----------------------
+# CONDITIONAL GET
+# -----------------------
+# @etag(make_tag) computes a tag from cheap version counters before the view
+# runs. A matching If-None-Match gets an empty 304 without touching the
+# view's queries; otherwise the view's 200 response is tagged. make_tag
+# returns None when the request can't be tagged (e.g. not logged in).
+CACHE_CONTROL = "private, no-cache"
+
+
+def etag(make_tag):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            tag = make_tag()
+            if tag is None:
+                return view(*args, **kwargs)
+
+            if tag in request.if_none_match:
+                response = make_response("", 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(tag)
+            response.headers["Cache-Control"] = CACHE_CONTROL
+            return response
+        return wrapper
+    return decorator
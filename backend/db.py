@@ -1,6 +1,14 @@
+import hashlib
 import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from itertools import islice
 import requests
+from requests.adapters import HTTPAdapter
 from werkzeug.security import generate_password_hash
+from backend.query_stats import record_query
 
 # -----------------------
 # TURSO HTTP CONFIG
@@ -8,6 +16,27 @@ from werkzeug.security import generate_password_hash
 TURSO_URL = os.environ.get("TURSO_URL", "")
 TURSO_AUTH_TOKEN = os.environ.get("TURSO_AUTH_TOKEN", "")
 
+# DB_BACKEND=sqlite runs in-process on a local SQLite file instead of Turso;
+# TURSO_URL=file:/path/to.db is shorthand for the same thing
+DB_BACKEND = os.environ.get("DB_BACKEND", "sqlite" if TURSO_URL.startswith("file:") else "turso")
+SQLITE_PATH = os.environ.get(
+    "SQLITE_PATH",
+    TURSO_URL[len("file:"):] if TURSO_URL.startswith("file:") else "widemind.db"
+)
+SQLITE_STATEMENT_CACHE = int(os.environ.get("SQLITE_STATEMENT_CACHE", "256"))
+
+# Default fetchmany() size and keyset page size
+CURSOR_ARRAYSIZE = int(os.environ.get("DB_CURSOR_ARRAYSIZE", "100"))
+KEYSET_PAGE_SIZE = int(os.environ.get("DB_KEYSET_PAGE_SIZE", "200"))
+
+# Optional per-worker embedded replica for reads (see backend/replica.py)
+DB_REPLICA_PATH = os.environ.get("DB_REPLICA_PATH", "")
+DB_REPLICA_SYNC_INTERVAL = float(os.environ.get("DB_REPLICA_SYNC_INTERVAL", "5"))
+DB_REPLICA_PRUNE_INTERVAL = float(os.environ.get("DB_REPLICA_PRUNE_INTERVAL", "60"))
+# A replica that has not reported its position for this long no longer holds
+# back pruning of the change log; it re-bootstraps if it comes back
+DB_REPLICA_STALE_AFTER = int(os.environ.get("DB_REPLICA_STALE_AFTER", "3600"))
+
 # Convert libsql:// URL to https:// for HTTP API
 HTTP_URL = TURSO_URL.replace("libsql://", "https://") + "/v2/pipeline"
 HEADERS = {
@@ -15,32 +44,136 @@ HEADERS = {
     "Content-Type": "application/json"
 }
 
+# Keep-alive pool per worker process (greenlet-safe once gevent has patched threading)
+TURSO_POOL_SIZE = int(os.environ.get("TURSO_POOL_SIZE", "10"))
+TURSO_POOL_IDLE_TIMEOUT = float(os.environ.get("TURSO_POOL_IDLE_TIMEOUT", "60"))
+TURSO_TIMEOUT = float(os.environ.get("TURSO_TIMEOUT", "10"))
+
+
+# -----------------------
+# HTTP SESSION POOL
+# -----------------------
+_pool_lock = threading.Lock()
+_pool = {
+    "session": None,
+    "pid": None,
+    "last_used": 0.0,
+}
+_pool_stats = {
+    "requests": 0,
+    "sessions_created": 0,
+    "idle_evictions": 0,
+    "fork_resets": 0,
+}
+
+
+def _new_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=TURSO_POOL_SIZE,
+        pool_block=True,
+        max_retries=0
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(HEADERS)
+    _pool_stats["sessions_created"] += 1
+    return session
+
+
+def _get_session():
+    with _pool_lock:
+        now = time.monotonic()
+        session = _pool["session"]
+        pid = os.getpid()
+
+        if session is not None and _pool["pid"] != pid:
+            # Inherited from the gunicorn master; its sockets belong to the parent
+            _pool["session"] = session = None
+            _pool_stats["fork_resets"] += 1
+        elif session is not None and now - _pool["last_used"] > TURSO_POOL_IDLE_TIMEOUT:
+            # Turso closes idle keep-alive sockets; drop them before they fail mid-request
+            session.close()
+            _pool["session"] = session = None
+            _pool_stats["idle_evictions"] += 1
+
+        if session is None:
+            session = _new_session()
+            _pool["session"] = session
+            _pool["pid"] = pid
+
+        _pool["last_used"] = now
+        _pool_stats["requests"] += 1
+        return session
+
+
+def _reset_session_after_fork():
+    global _pool_lock
+    _pool_lock = threading.Lock()
+    if _pool["session"] is not None:
+        _pool_stats["fork_resets"] += 1
+    _pool["session"] = None
+    _pool["pid"] = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_session_after_fork)
+
+
+def pool_stats():
+    stats = dict(_pool_stats)
+    stats["pid"] = os.getpid()
+    stats["pool_size"] = TURSO_POOL_SIZE
+    stats["idle_timeout"] = TURSO_POOL_IDLE_TIMEOUT
+    stats["connections_created"] = 0
+    stats["idle_connections"] = 0
+    session = _pool["session"]
+    if session is not None and _pool["pid"] == os.getpid():
+        adapter = session.adapters["https://"]
+        for key in list(adapter.poolmanager.pools.keys()):
+            http_pool = adapter.poolmanager.pools[key]
+            stats["connections_created"] += http_pool.num_connections
+            if http_pool.pool is not None:
+                stats["idle_connections"] += sum(1 for c in list(http_pool.pool.queue) if c is not None)
+    return stats
+
 
 # -----------------------
 # ROW — access by name like sqlite3.Row
 # -----------------------
 class Row:
-    def __init__(self, columns, values):
-        self._columns = columns
+    # Rows of one result share a single column -> position map
+    __slots__ = ("_index", "_values")
+
+    def __init__(self, index, values):
+        self._index = index
         self._values = values
-        self._dict = dict(zip(columns, values))
 
     def __getitem__(self, key):
         if isinstance(key, int):
             return self._values[key]
-        return self._dict[key]
+        return self._values[self._index[key]]
 
     def __iter__(self):
         return iter(self._values)
 
+    def __len__(self):
+        return len(self._values)
+
     def keys(self):
-        return self._columns
+        return list(self._index)
 
     def get(self, key, default=None):
-        return self._dict.get(key, default)
+        i = self._index.get(key)
+        return default if i is None else self._values[i]
 
     def __repr__(self):
-        return str(self._dict)
+        return str(dict(self))
+
+
+def _column_index(columns):
+    return {name: i for i, name in enumerate(columns)}
 
 
 # -----------------------
@@ -51,58 +184,187 @@ class TursoCursor:
         self._conn = conn
         self.description = None
         self.lastrowid = None
-        self._rows = []
-        self._columns = []
+        self.rowcount = -1
+        self.arraysize = CURSOR_ARRAYSIZE
+        self._raw = []
+        self._pos = 0
+        self._index = {}
+        self._decoders = ()
+
+    def _load(self, result):
+        cols = result.get("cols", [])
+        self._index = _column_index(c["name"] for c in cols)
+        self._decoders = tuple(_decoder_for(c.get("decltype")) for c in cols)
+        self.description = [(c["name"],) for c in cols] if cols else None
+        # Cells are decoded only when a row is actually fetched
+        self._raw = result.get("rows", [])
+        self._pos = 0
+        lastrowid = result.get("last_insert_rowid")
+        self.lastrowid = int(lastrowid) if lastrowid is not None else None
+        self.rowcount = result.get("affected_row_count", -1)
+        return self
+
+    def _decode(self, raw):
+        return Row(self._index, tuple(decode(v) for decode, v in zip(self._decoders, raw)))
 
     def execute(self, sql, params=()):
         # Convert ? placeholders and Python params to Turso format
-        args = [{"type": _turso_type(p), "value": _turso_value(p)} for p in params]
-        result = self._conn._execute(sql, args)
-        cols = result.get("cols", [])
-        self._columns = [c["name"] for c in cols]
-        self.description = [(c["name"],) for c in cols]
-        rows = result.get("rows", [])
-        self._rows = [
-            Row(self._columns, [_parse_value(v) for v in row])
-            for row in rows
-        ]
-        self.lastrowid = result.get("last_insert_rowid")
+        args = _turso_args(params)
+        if self._conn.deferred and _is_write(sql):
+            # Queued until commit(); lastrowid is not known yet
+            self._conn._statements.append((sql, args))
+            return self._load({})
+        result = self._conn._run([(sql, args)])[-1]
+        return self._load(result)
+
+    def executemany(self, sql, seq_of_params):
+        stmts = [(sql, _turso_args(params)) for params in seq_of_params]
+        if not stmts:
+            return self._load({})
+        if self._conn.deferred and _is_write(sql):
+            self._conn._statements.extend(stmts)
+            return self._load({})
+        results = self._conn._run(stmts)
+        self._load(results[-1])
+        self.rowcount = sum(r.get("affected_row_count", 0) for r in results[-len(stmts):])
         return self
 
     def fetchone(self):
-        return self._rows[0] if self._rows else None
+        if self._pos >= len(self._raw):
+            return None
+        row = self._decode(self._raw[self._pos])
+        self._pos += 1
+        return row
+
+    def fetchmany(self, size=None):
+        end = self._pos + (size or self.arraysize)
+        rows = [self._decode(raw) for raw in self._raw[self._pos:end]]
+        self._pos += len(rows)
+        return rows
 
     def fetchall(self):
-        return self._rows
+        rows = [self._decode(raw) for raw in self._raw[self._pos:]]
+        self._pos = len(self._raw)
+        return rows
+
+    def __iter__(self):
+        while self._pos < len(self._raw):
+            yield self.fetchone()
 
 
 # -----------------------
 # CONNECTION
 # -----------------------
 class TursoConnection:
-    def __init__(self):
+    def __init__(self, deferred=False):
+        # deferred=True queues INSERT/UPDATE/DELETE until commit() and sends
+        # them in a single pipeline together with whatever runs next
+        self.deferred = deferred
         self._statements = []
+        # Hrana stream state, only held open while a transaction is active
+        self._baton = None
+        self._base_url = None
+        self._in_transaction = False
+        self._begin_sql = None
+
+    def _send(self, reqs, close=True):
+        if close:
+            reqs = reqs + [{"type": "close"}]
+        payload = {"baton": self._baton, "requests": reqs}
+        url = (self._base_url.rstrip("/") + "/v2/pipeline") if self._base_url else HTTP_URL
+        started = time.perf_counter()
+        data = None
+        try:
+            resp = _get_session().post(url, json=payload, timeout=TURSO_TIMEOUT)
+            resp.raise_for_status()
+            data = resp.json()
+        except Exception:
+            # The stream (and any open transaction) is unusable after a transport error
+            self._reset_stream()
+            raise
+        finally:
+            if any(req["type"] != "close" for req in reqs):
+                record_query(_request_sql(reqs, data), time.perf_counter() - started, _result_rows(data))
+        if close:
+            self._reset_stream()
+        else:
+            self._baton = data.get("baton")
+            self._base_url = data.get("base_url") or self._base_url
+        return data["results"][:len(reqs) - 1 if close else len(reqs)]
+
+    def _reset_stream(self):
+        self._baton = None
+        self._base_url = None
+        self._in_transaction = False
+        self._begin_sql = None
+
+    def _pipeline(self, stmts, close=True):
+        reqs = [
+            {
+                "type": "execute",
+                "stmt": {
+                    "sql": sql,
+                    "args": args or []
+                }
+            }
+            for sql, args in stmts
+        ]
+        results = []
+        for result in self._send(reqs, close=close):
+            if result["type"] == "error":
+                raise Exception(result["error"]["message"])
+            results.append(result.get("response", {}).get("result", {}))
+        return results
+
+    def _run(self, stmts):
+        # Pending deferred writes ride along in front so reads see them
+        pending, self._statements = self._statements, []
+        if not self._in_transaction:
+            stmts = pending + stmts
+            if len(stmts) > 1 and any(_is_write(sql) for sql, _ in stmts):
+                # Several statements with a write: all or nothing
+                return self._atomic([("BEGIN IMMEDIATE", [])] + stmts)[1 + len(pending):]
+            return self._pipeline(stmts)[len(pending):]
+        head = []
+        if self._begin_sql:
+            # BEGIN is sent lazily with the first statement of the transaction
+            head, self._begin_sql = [(self._begin_sql, [])], None
+        skip = len(head) + len(pending)
+        return self._pipeline(head + pending + stmts, close=False)[skip:]
 
     def _execute(self, sql, args=None):
-        payload = {
-            "requests": [
-                {
-                    "type": "execute",
-                    "stmt": {
-                        "sql": sql,
-                        "args": args or []
-                    }
-                },
-                {"type": "close"}
-            ]
-        }
-        resp = requests.post(HTTP_URL, json=payload, headers=HEADERS, timeout=10)
-        resp.raise_for_status()
-        data = resp.json()
-        result = data["results"][0]
+        return self._run([(sql, args or [])])[0]
+
+    def _atomic(self, stmts):
+        # One Hrana batch ending in COMMIT: each step only runs if the one
+        # before it succeeded, and a failure anywhere rolls back. Returns the
+        # results of stmts.
+        steps = []
+        for i, (sql, args) in enumerate(stmts + [("COMMIT", [])]):
+            condition = {"type": "ok", "step": i - 1} if i else None
+            steps.append({"stmt": {"sql": sql, "args": args}, "condition": condition})
+        commit_step = len(steps) - 1
+        steps.append({
+            "stmt": {"sql": "ROLLBACK", "args": []},
+            "condition": {"type": "not", "cond": {"type": "ok", "step": commit_step}}
+        })
+        result = self._send([{"type": "batch", "batch": {"steps": steps}}])[0]
         if result["type"] == "error":
             raise Exception(result["error"]["message"])
-        return result.get("response", {}).get("result", {})
+        batch = result["response"]["result"]
+        for error in batch.get("step_errors", []):
+            if error:
+                raise Exception(error["message"])
+        return [r or {} for r in batch.get("step_results", [])[:len(stmts)]]
+
+    def _commit_transaction(self):
+        pending, self._statements = self._statements, []
+        stmts = ([(self._begin_sql, [])] if self._begin_sql else []) + pending
+        if not stmts and self._baton is None:
+            # Nothing was ever sent, so there is no server-side transaction
+            self._reset_stream()
+            return
+        self._atomic(stmts)
 
     def cursor(self):
         return TursoCursor(self)
@@ -112,16 +374,291 @@ class TursoConnection:
         c.execute(sql, params)
         return c
 
+    def batch(self, statements):
+        # [(sql, params), ...] in one round trip, one cursor per statement
+        statements = list(statements)
+        if not statements:
+            return []
+        results = self._run([(sql, _turso_args(params)) for sql, params in statements])
+        return [self.cursor()._load(result) for result in results]
+
+    @property
+    def in_transaction(self):
+        return self._in_transaction
+
+    def begin(self, mode="DEFERRED"):
+        if self._in_transaction:
+            raise Exception("Transaction already in progress")
+        self._in_transaction = True
+        self._begin_sql = f"BEGIN {mode}"
+
+    def commit(self):
+        if self._in_transaction:
+            self._commit_transaction()
+        elif self._statements:
+            # Statements auto-commit outside a transaction; only queued writes need sending
+            self._run([])
+
+    def rollback(self):
+        self._statements = []
+        if self._in_transaction and self._baton is not None:
+            self._send([{"type": "execute", "stmt": {"sql": "ROLLBACK", "args": []}}])
+        self._reset_stream()
+
+    @contextmanager
+    def transaction(self, mode="DEFERRED"):
+        self.begin(mode)
+        try:
+            yield self
+        except BaseException:
+            try:
+                self.rollback()
+            except Exception as e:
+                print("Rollback failed:", e)
+            raise
+        self.commit()
+
+    def close(self):
+        # Like sqlite3, closing without commit() drops queued writes and
+        # rolls back an open transaction
+        if self._in_transaction:
+            self.rollback()
+        self._statements = []
+
+
+# -----------------------
+# NATIVE SQLITE BACKEND
+# -----------------------
+# Connections are pooled per file and held by one greenlet/thread at a time
+# (checked out by SQLiteConnection, returned on close()), so each keeps its
+# own prepared-statement cache warm across requests.
+_sqlite_lock = threading.Lock()
+_sqlite_idle = {}
+
+
+def _sqlite_checkout(path):
+    with _sqlite_lock:
+        idle = _sqlite_idle.setdefault(path, [])
+        if idle:
+            return idle.pop()
+    db = sqlite3.connect(
+        path,
+        timeout=30,
+        check_same_thread=False,
+        cached_statements=SQLITE_STATEMENT_CACHE
+    )
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+
+def _sqlite_checkin(path, db):
+    if db.in_transaction:
+        db.rollback()
+    with _sqlite_lock:
+        _sqlite_idle.setdefault(path, []).append(db)
+
+
+def _sqlite_discard(path):
+    # Closes the idle connections to a file that is going away
+    with _sqlite_lock:
+        idle = _sqlite_idle.pop(path, [])
+    for db in idle:
+        db.close()
+
+
+def _reset_sqlite_after_fork():
+    global _sqlite_lock
+    _sqlite_lock = threading.Lock()
+    _sqlite_idle.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_sqlite_after_fork)
+
+
+class _BufferedRows:
+    # Stands in for a sqlite3 cursor whose rows were read ahead
+    def __init__(self, rows):
+        self._rows = iter(rows)
+
+    def fetchone(self):
+        return next(self._rows, None)
+
+    def fetchmany(self, size):
+        return list(islice(self._rows, size))
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def __iter__(self):
+        return self._rows
+
+
+class SQLiteCursor:
+    def __init__(self, conn):
+        self._conn = conn
+        self._cursor = conn._db.cursor()
+        self.description = None
+        self.lastrowid = None
+        self.rowcount = -1
+        self.arraysize = CURSOR_ARRAYSIZE
+        self._index = {}
+
+    def _load(self):
+        # Rows stay in sqlite3 and are stepped through as they are fetched
+        cur = self._cursor
+        self.description = cur.description
+        self._index = _column_index(d[0] for d in cur.description) if cur.description else {}
+        self.lastrowid = cur.lastrowid
+        self.rowcount = cur.rowcount
+        return self
+
+    def _buffer(self):
+        # Reads every row now, for results that must outlive a commit
+        if self._index:
+            rows = self._cursor.fetchall()
+            self.rowcount = self._cursor.rowcount
+            self._cursor = _BufferedRows(rows)
+        return self
+
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        try:
+            self._cursor.execute(sql, tuple(params))
+        finally:
+            record_query([sql], time.perf_counter() - started)
+        return self._load()
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = [tuple(p) for p in seq_of_params]
+        started = time.perf_counter()
+        try:
+            self._cursor.executemany(sql, seq_of_params)
+        finally:
+            record_query([sql], time.perf_counter() - started)
+        return self._load()
+
+    def fetchone(self):
+        if not self._index:
+            return None
+        values = self._cursor.fetchone()
+        return Row(self._index, values) if values is not None else None
+
+    def fetchmany(self, size=None):
+        if not self._index:
+            return []
+        return [Row(self._index, values) for values in self._cursor.fetchmany(size or self.arraysize)]
+
+    def fetchall(self):
+        if not self._index:
+            return []
+        return [Row(self._index, values) for values in self._cursor.fetchall()]
+
+    def __iter__(self):
+        if self._index:
+            for values in self._cursor:
+                yield Row(self._index, values)
+
+
+class SQLiteConnection:
+    # Same surface as TursoConnection over sqlite3; also used for the local
+    # replica file. deferred is accepted for parity — local writes are cheap.
+    def __init__(self, path=None, deferred=False):
+        self.deferred = deferred
+        self.path = path or SQLITE_PATH
+        self._db = _sqlite_checkout(self.path)
+
+    def cursor(self):
+        return SQLiteCursor(self)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def batch(self, statements):
+        # Atomic like the Turso batch: writes outside a transaction get one
+        statements = list(statements)
+        if self._db.in_transaction or not any(_is_write(sql) for sql, _ in statements):
+            return [self.cursor().execute(sql, params) for sql, params in statements]
+        with self.transaction():
+            # RETURNING rows are read before COMMIT, which needs them finished
+            return [self.cursor().execute(sql, params)._buffer() for sql, params in statements]
+
+    @property
+    def in_transaction(self):
+        return self._db.in_transaction
+
+    def begin(self, mode="DEFERRED"):
+        self._db.execute(f"BEGIN {mode}")
+
     def commit(self):
-        pass  # HTTP API auto-commits
+        self._db.commit()
+
+    def rollback(self):
+        self._db.rollback()
+
+    @contextmanager
+    def transaction(self, mode="DEFERRED"):
+        self.begin(mode)
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
 
     def close(self):
-        pass
+        # Uncommitted work is rolled back, as with sqlite3
+        if self._db is not None:
+            _sqlite_checkin(self.path, self._db)
+            self._db = None
 
 
 # -----------------------
 # TYPE HELPERS
 # -----------------------
+_WRITE_KEYWORDS = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+_CONTROL_KEYWORDS = ("BEGIN", "COMMIT", "END", "ROLLBACK", "SAVEPOINT", "RELEASE")
+
+
+def _request_sql(reqs, data=None):
+    # The statements that ran, for query stats: transaction control and
+    # batch steps skipped by their condition are left out
+    results = (data or {}).get("results", [])
+    statements = []
+    for i, req in enumerate(reqs):
+        if req["type"] == "execute":
+            sqls = [req["stmt"]["sql"]]
+        elif req["type"] == "batch":
+            sqls = [step["stmt"]["sql"] for step in req["batch"]["steps"]]
+            result = results[i] if i < len(results) else {}
+            batch = result.get("response", {}).get("result") if result.get("type") == "ok" else None
+            if batch:
+                ran = zip(batch.get("step_results", []), batch.get("step_errors", []))
+                sqls = [sql for sql, (res, err) in zip(sqls, ran) if res is not None or err is not None]
+        else:
+            continue
+        statements.extend(sql for sql in sqls if sql.lstrip().split(None, 1)[0].upper() not in _CONTROL_KEYWORDS)
+    return statements
+
+
+def _result_rows(data):
+    if not data:
+        return 0
+    rows = 0
+    for result in data.get("results", []):
+        if result.get("type") == "ok":
+            rows += len(result.get("response", {}).get("result", {}).get("rows", []))
+    return rows
+
+
+def _is_write(sql):
+    return sql.lstrip().split(None, 1)[0].upper() in _WRITE_KEYWORDS
+
+
+def _turso_args(params):
+    return [{"type": _turso_type(p), "value": _turso_value(p)} for p in params]
+
 def _turso_type(value):
     if value is None:
         return "null"
@@ -136,6 +673,33 @@ def _turso_value(value):
         return None
     return str(value)
 
+def _decode_integer(v):
+    if v.get("type") == "integer":
+        return int(v["value"])
+    return _parse_value(v)
+
+def _decode_float(v):
+    if v.get("type") == "float":
+        return float(v["value"])
+    return _parse_value(v)
+
+def _decode_text(v):
+    if v.get("type") == "text":
+        return v["value"]
+    return _parse_value(v)
+
+def _decoder_for(decltype):
+    # SQLite column affinity rules; the generic decoder covers everything else
+    # (expressions, NULL-typed cells, values stored against their affinity)
+    t = (decltype or "").upper()
+    if "INT" in t:
+        return _decode_integer
+    if "CHAR" in t or "CLOB" in t or "TEXT" in t:
+        return _decode_text
+    if "REAL" in t or "FLOA" in t or "DOUB" in t:
+        return _decode_float
+    return _parse_value
+
 def _parse_value(v):
     if v is None or v == {"type": "null"}:
         return None
@@ -155,65 +719,340 @@ def _parse_value(v):
 # -----------------------
 # GET DB CONNECTION
 # -----------------------
-def get_db():
-    return TursoConnection()
+def get_primary(deferred=False):
+    if DB_BACKEND == "sqlite":
+        return SQLiteConnection(SQLITE_PATH, deferred=deferred)
+    return TursoConnection(deferred=deferred)
+
+
+def get_db(deferred=False):
+    if DB_REPLICA_PATH:
+        from backend.replica import ReplicaConnection
+        return ReplicaConnection(get_primary(deferred=deferred))
+    return get_primary(deferred=deferred)
 
 
 # -----------------------
-# INITIALIZE DATABASE
+# KEYSET PAGINATION
 # -----------------------
-def init_db():
-    conn = get_db()
+# Pages through any query by a unique, indexed key column (id by default)
+# with "WHERE key < ? ORDER BY key DESC LIMIT n", so each page costs the
+# same no matter how deep it is and only one page is held in memory.
+def keyset_page(conn, sql, params=(), key="id", after=None, limit=KEYSET_PAGE_SIZE, descending=True):
+    op, order = ("<", "DESC") if descending else (">", "ASC")
+    where = f"WHERE {key} {op} ?" if after is not None else ""
+    args = tuple(params) + ((after,) if after is not None else ()) + (limit,)
+    return conn.execute(
+        f"SELECT * FROM ({sql}) {where} ORDER BY {key} {order} LIMIT ?", args
+    ).fetchall()
 
-    conn.execute("""CREATE TABLE IF NOT EXISTS users (
+
+class KeysetPager:
+    # Iterable over every row of a query, fetched a page at a time. A fresh
+    # connection is used per page so it is safe to hand to a streamed response.
+    def __init__(self, sql, params=(), key="id", page_size=KEYSET_PAGE_SIZE, descending=True):
+        self.sql = sql
+        self.params = tuple(params)
+        self.key = key
+        self.page_size = page_size
+        self.descending = descending
+        self._first = None
+
+    def page(self, after=None):
+        conn = get_db()
+        try:
+            return keyset_page(conn, self.sql, self.params, self.key, after, self.page_size, self.descending)
+        finally:
+            conn.close()
+
+    def __bool__(self):
+        if self._first is None:
+            self._first = self.page()
+        return bool(self._first)
+
+    def __iter__(self):
+        rows, self._first = (self._first if self._first is not None else self.page()), None
+        while rows:
+            yield from rows
+            if len(rows) < self.page_size:
+                return
+            rows = self.page(after=rows[-1][self.key])
+
+
+# -----------------------
+# SCHEMA MIGRATIONS
+# -----------------------
+# Applied in order, once each, and recorded in schema_migrations. Steps are
+# SQL strings or callables taking the connection; every step must be safe
+# to run against a database that already has the change (older databases
+# were created by hand-written CREATE TABLE IF NOT EXISTS calls).
+def _add_column(table, column, decl):
+    def step(conn):
+        columns = [r["name"] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+        if column not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    # What the schema fingerprint hashes for this step
+    step.sql = f"ALTER TABLE {table} ADD COLUMN {column} {decl}"
+    return step
+
+
+MIGRATIONS = [
+    (1, "base tables", [
+        """CREATE TABLE IF NOT EXISTS users (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         name TEXT NOT NULL, email TEXT UNIQUE NOT NULL,
         password TEXT NOT NULL, department TEXT, level TEXT,
         role TEXT DEFAULT 'student', is_suspended INTEGER DEFAULT 0,
-        push_enabled INTEGER DEFAULT 0)""")
+        push_enabled INTEGER DEFAULT 0)""",
 
-    conn.execute("""CREATE TABLE IF NOT EXISTS courses (
+        """CREATE TABLE IF NOT EXISTS courses (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         course_code TEXT UNIQUE NOT NULL,
-        course_title TEXT NOT NULL, description TEXT)""")
+        course_title TEXT NOT NULL, description TEXT)""",
 
-    conn.execute("""CREATE TABLE IF NOT EXISTS materials (
+        """CREATE TABLE IF NOT EXISTS materials (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         course_id INTEGER NOT NULL, filename TEXT NOT NULL,
         file_type TEXT NOT NULL, title TEXT NOT NULL,
-        FOREIGN KEY(course_id) REFERENCES courses(id))""")
+        FOREIGN KEY(course_id) REFERENCES courses(id))""",
 
-    conn.execute("""CREATE TABLE IF NOT EXISTS payments (
+        """CREATE TABLE IF NOT EXISTS payments (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER NOT NULL, amount INTEGER NOT NULL,
         status TEXT DEFAULT 'unpaid',
         admin_override_status TEXT DEFAULT NULL,
         reference TEXT, paid_at DATETIME,
-        FOREIGN KEY(user_id) REFERENCES users(id))""")
+        FOREIGN KEY(user_id) REFERENCES users(id))""",
 
-    conn.execute("""CREATE TABLE IF NOT EXISTS contact_messages (
+        """CREATE TABLE IF NOT EXISTS contact_messages (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         name TEXT NOT NULL, email TEXT NOT NULL,
         subject TEXT, message TEXT NOT NULL,
         is_read INTEGER DEFAULT 0,
-        created_at DATETIME DEFAULT CURRENT_TIMESTAMP)""")
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP)""",
 
-    conn.execute("""CREATE TABLE IF NOT EXISTS notifications (
+        """CREATE TABLE IF NOT EXISTS notifications (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER NOT NULL, title TEXT NOT NULL,
         message TEXT NOT NULL, link TEXT,
         is_read INTEGER DEFAULT 0, is_archived INTEGER DEFAULT 0,
         is_critical INTEGER DEFAULT 0,
         created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY(user_id) REFERENCES users(id))""")
+        FOREIGN KEY(user_id) REFERENCES users(id))""",
 
-    conn.execute("""CREATE TABLE IF NOT EXISTS push_subscriptions (
+        """CREATE TABLE IF NOT EXISTS push_subscriptions (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER NOT NULL, endpoint TEXT NOT NULL,
         p256dh TEXT NOT NULL, auth TEXT NOT NULL,
         created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY(user_id) REFERENCES users(id))""")
+        FOREIGN KEY(user_id) REFERENCES users(id))""",
+
+        """CREATE TABLE IF NOT EXISTS password_resets (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        token_hash TEXT NOT NULL,
+        expires_at TEXT NOT NULL,
+        used INTEGER DEFAULT 0)""",
+    ]),
+    (2, "materials.file_url", [
+        _add_column("materials", "file_url", "TEXT"),
+    ]),
+    (3, "hot path indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(user_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_reference ON payments(reference)",
+        "CREATE INDEX IF NOT EXISTS idx_notifications_feed ON notifications(user_id, is_archived, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_materials_course ON materials(course_id, file_type)",
+        "CREATE INDEX IF NOT EXISTS idx_push_subscriptions_user ON push_subscriptions(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_password_resets_token ON password_resets(token_hash)",
+        "CREATE INDEX IF NOT EXISTS idx_password_resets_user ON password_resets(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_contact_messages_unread ON contact_messages(is_read)",
+    ]),
+    (4, "users.auth_epoch", [
+        _add_column("users", "auth_epoch", "INTEGER DEFAULT 0"),
+    ]),
+    (5, "users.notif_version", [
+        _add_column("users", "notif_version", "INTEGER DEFAULT 0"),
+    ]),
+    (6, "notification feed indexes", [
+        # Feed pages are keyed on id, not created_at
+        "DROP INDEX IF EXISTS idx_notifications_feed",
+        "CREATE INDEX IF NOT EXISTS idx_notifications_user ON notifications(user_id, is_archived, id)",
+        "CREATE INDEX IF NOT EXISTS idx_notifications_unread ON notifications(user_id, is_archived, is_read)",
+    ]),
+    (7, "broadcast notifications", [
+        # Broadcasts are notifications rows with user_id = 0; this is the
+        # sparse per-user overlay for the ones a user has read or archived
+        """CREATE TABLE IF NOT EXISTS broadcast_state (
+        notification_id INTEGER NOT NULL, user_id INTEGER NOT NULL,
+        is_read INTEGER DEFAULT 0, is_archived INTEGER DEFAULT 0,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (notification_id, user_id)) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_state_user ON broadcast_state(user_id, is_archived)",
+        _add_column("users", "broadcast_floor", "INTEGER DEFAULT 0"),
+    ]),
+    (8, "notification fan-out jobs", [
+        """CREATE TABLE IF NOT EXISTS notification_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        notification_id INTEGER NOT NULL,
+        status TEXT DEFAULT 'queued',
+        push_total INTEGER DEFAULT 0, push_sent INTEGER DEFAULT 0, push_failed INTEGER DEFAULT 0,
+        email_total INTEGER DEFAULT 0, email_sent INTEGER DEFAULT 0, email_failed INTEGER DEFAULT 0,
+        error TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP, finished_at DATETIME)""",
+    ]),
+    (9, "push subscriptions keyed by endpoint", [
+        # One row per browser endpoint: keep the newest of each duplicate set
+        _add_column("push_subscriptions", "last_seen", "DATETIME"),
+        "UPDATE push_subscriptions SET last_seen = COALESCE(last_seen, created_at, CURRENT_TIMESTAMP)",
+        """DELETE FROM push_subscriptions WHERE id NOT IN (
+        SELECT MAX(id) FROM push_subscriptions GROUP BY endpoint)""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_push_subscriptions_endpoint ON push_subscriptions(endpoint)",
+        "CREATE INDEX IF NOT EXISTS idx_push_subscriptions_seen ON push_subscriptions(last_seen)",
+    ]),
+    (10, "email outbox", [
+        """CREATE TABLE IF NOT EXISTS email_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        to_email TEXT NOT NULL, template TEXT NOT NULL, params TEXT,
+        dedupe_key TEXT,
+        status TEXT DEFAULT 'queued', attempts INTEGER DEFAULT 0,
+        next_attempt_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        last_error TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP, sent_at DATETIME)""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_email_outbox_dedupe ON email_outbox(dedupe_key)",
+        "CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox(status, next_attempt_at)",
+    ]),
+    (11, "auth revocations", [
+        # One row per revoke_claims(): the user's new auth_epoch, read by
+        # every worker to drop that user's older session claims
+        """CREATE TABLE IF NOT EXISTS auth_revocations (
+        version INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL, epoch INTEGER NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP)""",
+        "CREATE INDEX IF NOT EXISTS idx_auth_revocations_created ON auth_revocations(created_at)",
+    ]),
+    (12, "notification job heartbeat", [
+        _add_column("notification_jobs", "updated_at", "DATETIME"),
+        "CREATE INDEX IF NOT EXISTS idx_notification_jobs_status ON notification_jobs(status)",
+    ]),
+]
+
+
+def _schema_fingerprint():
+    h = hashlib.sha256()
+    for version, name, steps in MIGRATIONS:
+        h.update(f"{version}:{name}".encode())
+        for step in steps:
+            h.update((step if isinstance(step, str) else getattr(step, "sql", step.__qualname__)).encode())
+    if DB_REPLICA_PATH:
+        h.update(b"replica-change-log")
+    return h.hexdigest()[:16]
+
+
+SCHEMA_FINGERPRINT = _schema_fingerprint()
+
 
+def schema_is_current(conn=None):
+    # Single round trip; a missing schema_meta table just means "not current"
+    conn = conn or get_primary()
+    try:
+        row = conn.execute(
+            "SELECT value FROM schema_meta WHERE key='fingerprint'"
+        ).fetchone()
+    except Exception:
+        return False
+    return bool(row) and row["value"] == SCHEMA_FINGERPRINT
+
+
+def migrate(conn=None):
+    conn = conn or get_primary()
+    conn.batch([
+        ("""CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY, name TEXT NOT NULL,
+        applied_at DATETIME DEFAULT CURRENT_TIMESTAMP)""", ()),
+        ("""CREATE TABLE IF NOT EXISTS schema_meta (
+        key TEXT PRIMARY KEY, value TEXT NOT NULL)""", ()),
+    ])
+    conn.commit()
+    applied = {r["version"] for r in conn.execute("SELECT version FROM schema_migrations").fetchall()}
+
+    for version, name, steps in MIGRATIONS:
+        if version in applied:
+            continue
+        with conn.transaction():
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            # OR IGNORE: workers booting together may race to apply the same one
+            conn.execute(
+                "INSERT OR IGNORE INTO schema_migrations (version, name) VALUES (?, ?)",
+                (version, name)
+            )
+        print(f"Applied migration {version}: {name}")
+
+    from backend.replica import install_change_log, drop_change_log
+    if DB_REPLICA_PATH:
+        install_change_log(conn)
+    else:
+        # Triggers left behind would keep filling a log nothing reads
+        drop_change_log(conn)
+
+    conn.execute(
+        "INSERT OR REPLACE INTO schema_meta (key, value) VALUES ('fingerprint', ?)",
+        (SCHEMA_FINGERPRINT,)
+    )
+    conn.commit()
+
+
+# -----------------------
+# QUERY PLAN AUDIT
+# -----------------------
+# Query shapes the hot routes run; audit_queries() EXPLAINs each one and
+# reports any that scan a table instead of searching an index.
+HOT_QUERIES = {
+    "latest_payment": "SELECT * FROM payments WHERE user_id=? ORDER BY id DESC LIMIT 1",
+    "payment_by_reference": "SELECT id FROM payments WHERE reference = ?",
+    "user_by_email": "SELECT id, name FROM users WHERE email=?",
+    "user_by_id": "SELECT role, is_suspended FROM users WHERE id=?",
+    "course_by_id": "SELECT * FROM courses WHERE id=?",
+    "course_materials": "SELECT * FROM materials WHERE course_id=? AND file_type='pdf'",
+    "material_in_course": "SELECT id, filename FROM materials WHERE id=? AND course_id=? AND file_type='pdf'",
+    "push_subscriptions": "SELECT * FROM push_subscriptions WHERE user_id=?",
+    "password_reset": "SELECT user_id, expires_at, used FROM password_resets WHERE token_hash=?",
+    "unread_messages": "SELECT COUNT(*) AS unread FROM contact_messages WHERE is_read = 0",
+}
+
+
+def register_query(name, sql):
+    HOT_QUERIES[name] = sql
+    return sql
+
+
+def audit_queries(conn=None):
+    conn = conn or get_primary()
+    problems = {}
+    for name, sql in HOT_QUERIES.items():
+        params = (None,) * sql.count("?")
+        plan = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+        scans = [
+            r["detail"] for r in plan
+            if r["detail"].startswith("SCAN") and "CONSTANT ROW" not in r["detail"]
+        ]
+        if scans:
+            problems[name] = scans
+    return problems
+
+
+# -----------------------
+# INITIALIZE DATABASE
+# -----------------------
+def init_db():
+    # Runs on every worker boot: one query when the schema is already current
+    conn = get_primary()
+    if schema_is_current(conn):
+        return
+    migrate(conn)
     print("Database initialized successfully.")
 
 
@@ -233,4 +1072,22 @@ def hash_password(password):
 
 
 if __name__ == "__main__":
-    init_db()
+    # python -m backend.db [init|migrate|audit]
+    import sys
+    command = sys.argv[1] if len(sys.argv) > 1 else "init"
+    if command == "migrate":
+        migrate()
+    elif command == "audit":
+        # Run as __main__ this file is a second copy of backend.db; audit the
+        # registry the other modules add their hot queries to, after importing
+        # every module that calls register_query()
+        from backend import db as registry
+        import backend.principal  # noqa: F401
+        import backend.notifications  # noqa: F401
+        problems = registry.audit_queries()
+        for name, scans in problems.items():
+            print(f"FULL SCAN  {name}: {'; '.join(scans)}")
+        print(f"{len(registry.HOT_QUERIES)} queries checked, {len(problems)} with full scans.")
+        sys.exit(1 if problems else 0)
+    else:
+        init_db()
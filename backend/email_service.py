@@ -1,176 +1,138 @@
 import os
+import time
 import requests
-from datetime import datetime
+from gevent.pool import Pool
+from backend.email_templates import FIRST_NAME_SLOT, first_name_of, prepare_email, render_email
 
 
-def send_email(to_email, subject, body):
+# -----------------------
+# BREVO
+# -----------------------
+# deliver_email() sends one rendered message (see backend/email_templates.py).
+# send_bulk_email() sends one template to many recipients using Brevo's
+# messageVersions: the shared parts are rendered once, and each request
+# carries up to BREVO_BATCH_SIZE recipients whose first names are filled
+# into {{ params.first_name }} by Brevo, and BREVO_BATCH_CONCURRENCY
+# requests run at once. BREVO_API_URL can point at a local stand-in.
+# Failures are reported as (reason, permanent): permanent when Brevo
+# rejected the request itself (a 4xx other than a rate limit or an account
+# problem), so sending it again would get the same answer.
+BREVO_API_URL = os.environ.get("BREVO_API_URL", "https://api.brevo.com/v3").rstrip("/")
+BREVO_BATCH_SIZE = int(os.environ.get("BREVO_BATCH_SIZE", "500"))  # Brevo accepts up to 1000
+BREVO_BATCH_CONCURRENCY = int(os.environ.get("BREVO_BATCH_CONCURRENCY", "4"))
+BREVO_TIMEOUT = 15
+
+FROM_NAME = "Wide Mind Tutorial"
 
-    api_key = os.environ.get("BREVO_API_KEY")
-    from_email = os.environ.get("EMAIL_FROM", "no-reply@widemindtutorial.com")
-    from_name = "Wide Mind Tutorial"
 
+def _post(payload):
+    # Returns None once Brevo accepted the request, else (status, reason)
+    api_key = os.environ.get("BREVO_API_KEY")
     if not api_key:
         print("[EMAIL] BREVO_API_KEY missing")
-        return False
-
-    html_content = f"""
-<div style="margin:0;padding:0;background-color:#fdf6e3;">
-  <div style="max-width:600px;margin:0 auto;background-color:#ffffff;
-              font-family:'Poppins', Arial, sans-serif;border-radius:14px;
-              overflow:hidden;border:1px solid #e6d8b5;">
-    <div style="background:linear-gradient(135deg,#8B7500,#d4af37);padding:25px;text-align:center;">
-      <img src="https://www.widemindtutorial.com/static/images/logo.png"
-           alt="Wide Mind Tutorial" style="max-width:130px;margin-bottom:12px;">
-    </div>
-    <div style="padding:32px;color:#3c2f1f;font-size:15px;line-height:1.7;">
-      <div style="background-color:#fffaf0;padding:20px;border-radius:10px;border:1px solid #f0e6d2;">
-        {body}
-      </div>
-      <p style="margin-top:28px;font-size:12px;color:#8B7500;">
-        Sent on {datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC")}
-      </p>
-      <hr style="margin:25px 0;border:none;border-top:1px solid #e6d8b5;">
-      <p style="font-size:13px;color:#555;margin:0;">
-        This is an official email from <strong>Wide Mind Tutorial</strong>.
-      </p>
-      <p style="font-size:12px;color:#777;margin-top:8px;">
-        Please do not reply to this message. For support, visit our website.
-      </p>
-    </div>
-    <div style="background-color:#8B7500;padding:18px;text-align:center;
-                font-size:12px;color:#f0e6d2;">
-      &copy; {datetime.utcnow().year} Wide Mind Tutorial<br>
-      www.widemindtutorial.com
-    </div>
-  </div>
-</div>
-"""
+        return None, "BREVO_API_KEY missing"
 
+    payload = {
+        "sender": {
+            "name": FROM_NAME,
+            "email": os.environ.get("EMAIL_FROM", "no-reply@widemindtutorial.com"),
+        },
+        **payload,
+    }
     try:
         response = requests.post(
-            "https://api.brevo.com/v3/smtp/email",
+            f"{BREVO_API_URL}/smtp/email",
             headers={
                 "accept": "application/json",
                 "api-key": api_key,
                 "content-type": "application/json"
             },
-            json={
-                "sender": {"name": from_name, "email": from_email},
-                "to": [{"email": to_email}],
-                "subject": subject,
-                "htmlContent": html_content
-            },
-            timeout=15
+            json=payload,
+            timeout=BREVO_TIMEOUT
         )
-        print(f"[EMAIL] Brevo status: {response.status_code} to {to_email}")
-        if response.status_code not in (200, 201):
-            print(f"[EMAIL] Brevo error: {response.text}")
-            return False
-        return True
-
     except Exception as e:
         print(f"[EMAIL] Failed: {type(e).__name__}: {e}")
-        return False
-
-
-# =====================
-# WELCOME EMAIL
-# =====================
-def send_welcome_email(to_email, name):
-    first_name = name.split()[0].capitalize()
-    body = f"""
-    <p style="font-size:18px;font-weight:700;color:#8B7500;">Welcome to Wide Mind Tutorial! 🎉</p>
-    <p>Hi <strong>{first_name}</strong>,</p>
-    <p>
-        We're excited to have you on board. Your account has been created successfully
-        and you're one step away from accessing all your course materials.
-    </p>
-    <p><strong>Here's what you get with full access:</strong></p>
-    <ul style="padding-left:20px;line-height:2;">
-        <li>📄 Full PDF notes for all your courses</li>
-        <li>🎧 Audio lectures you can listen to anywhere</li>
-        <li>🔔 Real-time notifications for new materials</li>
-    </ul>
-    <p>
-        To unlock your access, simply log in and complete your payment.
-    </p>
-    <div style="text-align:center;margin:24px 0;">
-        <a href="https://www.widemindtutorial.com"
-           style="background:linear-gradient(135deg,#8B7500,#d4af37);color:#fff;
-                  padding:14px 32px;border-radius:8px;text-decoration:none;
-                  font-weight:bold;font-size:15px;">
-            Get Started →
-        </a>
-    </div>
-    <p>If you have any questions, feel free to reach out via our contact page.</p>
-    <p>Welcome aboard! 💛<br><strong>Wide Mind Tutorial Team</strong></p>
-    """
-    return send_email(to_email, "Welcome to Wide Mind Tutorial! 🎉", body)
-
-
-# =====================
-# PAYMENT SUCCESS EMAIL
-# =====================
-def send_payment_success_email(to_email, name):
-    first_name = name.split()[0].capitalize()
-    body = f"""
-    <p style="font-size:18px;font-weight:700;color:#8B7500;">Payment Confirmed! ✅</p>
-    <p>Hi <strong>{first_name}</strong>,</p>
-    <p>
-        Your payment has been received and your account is now <strong>fully active</strong>.
-        You now have complete access to all course materials.
-    </p>
-    <p><strong>You can now access:</strong></p>
-    <ul style="padding-left:20px;line-height:2;">
-        <li>📄 PDF notes for all your courses</li>
-        <li>🎧 Audio lectures for all sessions</li>
-        <li>🔔 Push notifications for new uploads</li>
-    </ul>
-    <div style="text-align:center;margin:24px 0;">
-        <a href="https://www.widemindtutorial.com/account"
-           style="background:linear-gradient(135deg,#8B7500,#d4af37);color:#fff;
-                  padding:14px 32px;border-radius:8px;text-decoration:none;
-                  font-weight:bold;font-size:15px;">
-            Go to My Account →
-        </a>
-    </div>
-    <p>Study hard and excel! 💛<br><strong>Wide Mind Tutorial Team</strong></p>
-    """
-    return send_email(to_email, "Payment Confirmed — Your Access is Active! ✅", body)
-
-
-# =====================
-# NEW MATERIAL EMAIL
-# =====================
-def send_new_material_email(to_email, name, material_title, course_title, file_type, course_id):
-    first_name = name.split()[0].capitalize()
-    icon = "📄" if file_type == "pdf" else "🎧"
-    type_label = "PDF Notes" if file_type == "pdf" else "Audio Lecture"
-    body = f"""
-    <p style="font-size:18px;font-weight:700;color:#8B7500;">New Material Available! {icon}</p>
-    <p>Hi <strong>{first_name}</strong>,</p>
-    <p>
-        A new <strong>{type_label}</strong> has just been added to your course materials.
-    </p>
-    <div style="background:#fff8e1;border:1px solid #e6d8b5;border-radius:10px;
-                padding:16px;margin:20px 0;">
-        <p style="margin:0;font-size:14px;color:#555;">Course</p>
-        <p style="margin:4px 0 12px;font-weight:700;color:#3c2f1f;font-size:16px;">{course_title}</p>
-        <p style="margin:0;font-size:14px;color:#555;">Material</p>
-        <p style="margin:4px 0 0;font-weight:700;color:#3c2f1f;font-size:16px;">{icon} {material_title}</p>
-    </div>
-    <div style="text-align:center;margin:24px 0;">
-        <a href="https://www.widemindtutorial.com/course/{course_id}"
-           style="background:linear-gradient(135deg,#8B7500,#d4af37);color:#fff;
-                  padding:14px 32px;border-radius:8px;text-decoration:none;
-                  font-weight:bold;font-size:15px;">
-            View Material →
-        </a>
-    </div>
-    <p>Keep studying! 💛<br><strong>Wide Mind Tutorial Team</strong></p>
-    """
-    return send_email(
-        to_email,
-        f"New {type_label} Available — {course_title} {icon}",
-        body
-    )
\ No newline at end of file
+        return None, f"{type(e).__name__}: {e}"
+    if response.status_code not in (200, 201):
+        print(f"[EMAIL] Brevo error {response.status_code}: {response.text}")
+        return response.status_code, f"{response.status_code}: {response.text[:200]}"
+    return None
+
+
+def _failure(status, reason):
+    # Rate limits clear up, and so do a bad key or an unverified sender once fixed
+    permanent = status is not None and 400 <= status < 500 and status not in (401, 403, 429)
+    return reason, permanent
+
+
+def deliver_email(to_email, subject, html, text=None):
+    # Returns None once the provider accepted the message, else (reason, permanent)
+    failure = _post({
+        "to": [{"email": to_email}],
+        "subject": subject,
+        "htmlContent": html,
+        **({"textContent": text} if text else {}),
+    })
+    print(f"[EMAIL] {'failed' if failure else 'sent'} to {to_email}")
+    return _failure(*failure) if failure else None
+
+
+def send_email(to_email, subject, body):
+    return deliver_email(to_email, *render_email("message", {"subject": subject, "body": body})) is None
+
+
+def _send_chunk(payload, chunk):
+    # One request for the chunk; a 400 (usually one bad address) is split
+    # in half until the offending recipients are isolated
+    failure = _post({**payload, "messageVersions": [
+        {
+            "to": [{"email": r["email"], **({"name": r["name"]} if r.get("name") else {})}],
+            "params": {"first_name": first_name_of(r.get("name"))},
+        }
+        for r in chunk
+    ]})
+    if failure is None:
+        return [None] * len(chunk), 1
+    status, reason = failure
+    if status == 400 and len(chunk) > 1:
+        middle = len(chunk) // 2
+        left, left_requests = _send_chunk(payload, chunk[:middle])
+        right, right_requests = _send_chunk(payload, chunk[middle:])
+        return left + right, 1 + left_requests + right_requests
+    return [_failure(status, reason)] * len(chunk), 1
+
+
+def send_bulk_email(template, params, recipients, on_result=None):
+    # recipients: [{"email": ..., "name": ...}]. Returns one entry per
+    # recipient, in order: None when accepted, else (reason, permanent).
+    # on_result(index, error) is called as each chunk finishes.
+    results = [None] * len(recipients)
+    if not recipients:
+        return results
+    started = time.perf_counter()
+    subject, html, text = prepare_email(template, params).render({"first_name": FIRST_NAME_SLOT})
+    payload = {"subject": subject, "htmlContent": html, "textContent": text}
+    chunks = [
+        (i, recipients[i:i + BREVO_BATCH_SIZE])
+        for i in range(0, len(recipients), BREVO_BATCH_SIZE)
+    ]
+
+    def send(item):
+        offset, chunk = item
+        return offset, _send_chunk(payload, chunk)
+
+    requests_made = 0
+    for offset, (errors, count) in Pool(BREVO_BATCH_CONCURRENCY).imap_unordered(send, chunks):
+        requests_made += count
+        for i, error in enumerate(errors):
+            results[offset + i] = error
+            if on_result:
+                on_result(offset + i, error)
+
+    failed = sum(1 for error in results if error)
+    ms = (time.perf_counter() - started) * 1000
+    print(
+        f"[EMAIL] bulk {template}: {len(results) - failed}/{len(results)} accepted, "
+        f"{failed} failed in {requests_made} requests, {ms:.0f}ms"
+    )
+    return results
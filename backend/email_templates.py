@@ -0,0 +1,312 @@
+import html
+import re
+from datetime import datetime
+from string import Formatter
+from backend.assets import email_logo_url
+
+# -----------------------
+# EMAIL TEMPLATES
+# -----------------------
+# Templates are compiled once per process into literal text and named
+# slots, with the body already inlined into the shared layout and a
+# plain-text version derived from the same HTML. render_email() fills every
+# slot for one message; prepare_email() fills everything except first_name
+# so a campaign renders its shared parts once and each recipient only costs
+# the first-name slot (or nothing at all when Brevo fills it in).
+# Slot values are HTML-escaped unless the template lists them as raw.
+FIRST_NAME_SLOT = "{{ params.first_name }}"
+
+_LINK_RE = re.compile(r'<a\s[^>]*href="([^"]*)"[^>]*>(.*?)</a>', re.S)
+_BREAK_RE = re.compile(r"<br\s*/?>|</li>")
+_BLOCK_RE = re.compile(r"</(?:p|div|ul|ol|h\d)>")
+_TAG_RE = re.compile(r"<[^>]+>")
+
+
+def html_to_text(source):
+    text = " ".join(source.split())
+    text = _LINK_RE.sub(lambda m: f"{_TAG_RE.sub('', m.group(2)).strip()}: {m.group(1)}", text)
+    text = re.sub(r"<li[^>]*>", "\n- ", text)
+    text = _BREAK_RE.sub("\n", text)
+    text = _BLOCK_RE.sub("\n\n", text)
+    text = html.unescape(_TAG_RE.sub("", text))
+    lines = [line.strip() for line in text.split("\n")]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+def _compile(source):
+    # "Hi {first_name}!" -> ("Hi ", _Slot("first_name"), "!")
+    parts = []
+    for literal, field, _, _ in Formatter().parse(source):
+        if literal:
+            parts.append(literal)
+        if field is not None:
+            parts.append(_Slot(field))
+    return tuple(parts)
+
+
+class _Slot(str):
+    pass
+
+
+def _fill(parts, values, convert):
+    # Replaces the slots values has; adjacent literals are merged so a fully
+    # filled template is a single string
+    out = []
+
+    def add(part):
+        if out and not isinstance(part, _Slot) and not isinstance(out[-1], _Slot):
+            out[-1] += part
+        else:
+            out.append(part)
+
+    for part in parts:
+        if isinstance(part, _Slot) and part in values:
+            value = values[part]
+            if isinstance(value, tuple):  # compiled parts are inlined as they are
+                for inner in value:
+                    add(inner)
+                continue
+            part = convert(part, value)
+        add(part)
+    return tuple(out)
+
+
+def _join(parts):
+    missing = [p for p in parts if isinstance(p, _Slot)]
+    if missing:
+        raise KeyError(missing[0])
+    return "".join(parts)
+
+
+class EmailTemplate:
+    def __init__(self, subject, body, raw=(), derive=None, _parts=None):
+        self.raw = frozenset(raw)
+        self.derive = derive
+        if _parts is not None:
+            self.subject, self.html, self.text = _parts
+            return
+        # The body is inlined into the layout at compile time
+        self.subject = _compile(subject)
+        self.html = _fill(_LAYOUT_HTML, {"body": _compile(body)}, None)
+        self.text = _fill(_LAYOUT_TEXT, {"body": _compile(html_to_text(body))}, None)
+
+    def _html_value(self, name, value):
+        return str(value) if name in self.raw else html.escape(str(value))
+
+    def _text_value(self, name, value):
+        return html_to_text(str(value)) if name in self.raw else str(value)
+
+    def fill(self, values):
+        if self.derive:
+            values = {**values, **self.derive(values)}
+        return EmailTemplate(None, None, self.raw, None, (
+            _fill(self.subject, values, lambda name, value: str(value)),
+            _fill(self.html, values, self._html_value),
+            _fill(self.text, values, self._text_value),
+        ))
+
+    def render(self, values):
+        # -> (subject, html, text)
+        filled = self.fill(values)
+        return _join(filled.subject), _join(filled.html), _join(filled.text)
+
+
+# -----------------------
+# LAYOUT
+# -----------------------
+LAYOUT = """
+<div style="margin:0;padding:0;background-color:#fdf6e3;">
+  <div style="max-width:600px;margin:0 auto;background-color:#ffffff;
+              font-family:'Poppins', Arial, sans-serif;border-radius:14px;
+              overflow:hidden;border:1px solid #e6d8b5;">
+    <div style="background:linear-gradient(135deg,#8B7500,#d4af37);padding:25px;text-align:center;">
+      <img src="{logo_url}"
+           alt="Wide Mind Tutorial" style="max-width:130px;margin-bottom:12px;">
+    </div>
+    <div style="padding:32px;color:#3c2f1f;font-size:15px;line-height:1.7;">
+      <div style="background-color:#fffaf0;padding:20px;border-radius:10px;border:1px solid #f0e6d2;">
+        {body}
+      </div>
+      <p style="margin-top:28px;font-size:12px;color:#8B7500;">
+        Sent on {sent_on}
+      </p>
+      <hr style="margin:25px 0;border:none;border-top:1px solid #e6d8b5;">
+      <p style="font-size:13px;color:#555;margin:0;">
+        This is an official email from <strong>Wide Mind Tutorial</strong>.
+      </p>
+      <p style="font-size:12px;color:#777;margin-top:8px;">
+        Please do not reply to this message. For support, visit our website.
+      </p>
+    </div>
+    <div style="background-color:#8B7500;padding:18px;text-align:center;
+                font-size:12px;color:#f0e6d2;">
+      &copy; {year} Wide Mind Tutorial<br>
+      www.widemindtutorial.com
+    </div>
+  </div>
+</div>
+"""
+
+_LAYOUT_HTML = _compile(LAYOUT)
+_LAYOUT_TEXT = _compile(html_to_text(LAYOUT))
+
+
+def _layout_values():
+    now = datetime.utcnow()
+    return {"logo_url": email_logo_url(), "sent_on": now.strftime("%Y-%m-%d %H:%M UTC"), "year": now.year}
+
+
+# =====================
+# WELCOME EMAIL
+# =====================
+WELCOME = """
+    <p style="font-size:18px;font-weight:700;color:#8B7500;">Welcome to Wide Mind Tutorial! 🎉</p>
+    <p>Hi <strong>{first_name}</strong>,</p>
+    <p>
+        We're excited to have you on board. Your account has been created successfully
+        and you're one step away from accessing all your course materials.
+    </p>
+    <p><strong>Here's what you get with full access:</strong></p>
+    <ul style="padding-left:20px;line-height:2;">
+        <li>📄 Full PDF notes for all your courses</li>
+        <li>🎧 Audio lectures you can listen to anywhere</li>
+        <li>🔔 Real-time notifications for new materials</li>
+    </ul>
+    <p>
+        To unlock your access, simply log in and complete your payment.
+    </p>
+    <div style="text-align:center;margin:24px 0;">
+        <a href="https://www.widemindtutorial.com"
+           style="background:linear-gradient(135deg,#8B7500,#d4af37);color:#fff;
+                  padding:14px 32px;border-radius:8px;text-decoration:none;
+                  font-weight:bold;font-size:15px;">
+            Get Started →
+        </a>
+    </div>
+    <p>If you have any questions, feel free to reach out via our contact page.</p>
+    <p>Welcome aboard! 💛<br><strong>Wide Mind Tutorial Team</strong></p>
+"""
+
+
+# =====================
+# PAYMENT SUCCESS EMAIL
+# =====================
+PAYMENT_SUCCESS = """
+    <p style="font-size:18px;font-weight:700;color:#8B7500;">Payment Confirmed! ✅</p>
+    <p>Hi <strong>{first_name}</strong>,</p>
+    <p>
+        Your payment has been received and your account is now <strong>fully active</strong>.
+        You now have complete access to all course materials.
+    </p>
+    <p><strong>You can now access:</strong></p>
+    <ul style="padding-left:20px;line-height:2;">
+        <li>📄 PDF notes for all your courses</li>
+        <li>🎧 Audio lectures for all sessions</li>
+        <li>🔔 Push notifications for new uploads</li>
+    </ul>
+    <div style="text-align:center;margin:24px 0;">
+        <a href="https://www.widemindtutorial.com/account"
+           style="background:linear-gradient(135deg,#8B7500,#d4af37);color:#fff;
+                  padding:14px 32px;border-radius:8px;text-decoration:none;
+                  font-weight:bold;font-size:15px;">
+            Go to My Account →
+        </a>
+    </div>
+    <p>Study hard and excel! 💛<br><strong>Wide Mind Tutorial Team</strong></p>
+"""
+
+
+# =====================
+# NEW MATERIAL EMAIL
+# =====================
+NEW_MATERIAL = """
+    <p style="font-size:18px;font-weight:700;color:#8B7500;">New Material Available! {icon}</p>
+    <p>Hi <strong>{first_name}</strong>,</p>
+    <p>
+        A new <strong>{type_label}</strong> has just been added to your course materials.
+    </p>
+    <div style="background:#fff8e1;border:1px solid #e6d8b5;border-radius:10px;
+                padding:16px;margin:20px 0;">
+        <p style="margin:0;font-size:14px;color:#555;">Course</p>
+        <p style="margin:4px 0 12px;font-weight:700;color:#3c2f1f;font-size:16px;">{course_title}</p>
+        <p style="margin:0;font-size:14px;color:#555;">Material</p>
+        <p style="margin:4px 0 0;font-weight:700;color:#3c2f1f;font-size:16px;">{icon} {material_title}</p>
+    </div>
+    <div style="text-align:center;margin:24px 0;">
+        <a href="https://www.widemindtutorial.com/course/{course_id}"
+           style="background:linear-gradient(135deg,#8B7500,#d4af37);color:#fff;
+                  padding:14px 32px;border-radius:8px;text-decoration:none;
+                  font-weight:bold;font-size:15px;">
+            View Material →
+        </a>
+    </div>
+    <p>Keep studying! 💛<br><strong>Wide Mind Tutorial Team</strong></p>
+"""
+
+
+def _material_fields(values):
+    if "file_type" not in values:
+        return {}
+    pdf = values["file_type"] == "pdf"
+    return {"icon": "📄" if pdf else "🎧", "type_label": "PDF Notes" if pdf else "Audio Lecture"}
+
+
+# =====================
+# PASSWORD RESET EMAIL
+# =====================
+PASSWORD_RESET = """
+        <p>Hi <strong>{first_name}</strong>,</p>
+        <p>We received a request to reset your password for your Wide Mind Tutorial account.</p>
+        <p>Click the button below to reset it. This link expires in <strong>1 hour</strong>.</p>
+        <div style="text-align:center;margin:28px 0;">
+            <a href="{reset_link}"
+               style="background:linear-gradient(135deg,#8B7500,#d4af37);
+                      color:#fff;
+                      padding:14px 32px;
+                      border-radius:8px;
+                      text-decoration:none;
+                      font-weight:bold;
+                      font-size:15px;">
+                Reset My Password
+            </a>
+        </div>
+        <p style="font-size:13px;color:#777;">
+            If you didn't request this, you can safely ignore this email.
+            Your password will not change.
+        </p>
+        <p style="font-size:12px;color:#999;word-break:break-all;">
+            Or copy this link: {reset_link}
+        </p>
+"""
+
+
+EMAIL_TEMPLATES = {
+    # Notification messages are admin-written HTML, as shown in the app
+    "message": EmailTemplate("{subject}", "{body}", raw=("body",)),
+    "welcome": EmailTemplate("Welcome to Wide Mind Tutorial! 🎉", WELCOME),
+    "payment_success": EmailTemplate("Payment Confirmed — Your Access is Active! ✅", PAYMENT_SUCCESS),
+    "new_material": EmailTemplate(
+        "New {type_label} Available — {course_title} {icon}", NEW_MATERIAL, derive=_material_fields
+    ),
+    "password_reset": EmailTemplate("Reset Your Password — Wide Mind Tutorial", PASSWORD_RESET),
+}
+
+
+# -----------------------
+# RENDERING
+# -----------------------
+# Params are as the outbox stores them: a "name" becomes first_name.
+def first_name_of(name):
+    parts = (name or "").split()
+    return parts[0].capitalize() if parts else "there"
+
+
+def prepare_email(template, params):
+    # Everything but first_name, for rendering many recipients
+    params = {k: v for k, v in params.items() if k != "name"}
+    return EMAIL_TEMPLATES[template].fill({**params, **_layout_values()})
+
+
+def render_email(template, params):
+    # -> (subject, html, text)
+    return prepare_email(template, params).render({"first_name": first_name_of(params.get("name"))})
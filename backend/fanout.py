@@ -0,0 +1,196 @@
+import json
+import os
+import gevent
+from extensions import socketio
+from backend.db import get_db
+from backend.outbox import outbox_emails
+from backend.push import deliver as deliver_push, expire_subscriptions
+from backend.notifications import notification_payload, BROADCAST_USER_ID
+
+# -----------------------
+# NOTIFICATION FAN-OUT
+# -----------------------
+# send_notification saves the notification and a notification_jobs row, and
+# for critical notifications queues one email per recipient in the outbox
+# (backend/outbox.py), all in one transaction. A background job then does
+# the rest of the delivery: one socket emit (the students room for
+# broadcasts), one query for every push subscription, and push sends spread
+# over a bounded pool (backend/push.py). Progress is written back to the
+# job row so any worker can report it; email progress comes from the outbox.
+# A job row doubles as a heartbeat: on its first request each worker re-runs
+# queued jobs nobody started and fails running ones whose worker died.
+JOB_PROGRESS_INTERVAL = float(os.environ.get("JOB_PROGRESS_INTERVAL", "1"))
+JOB_STALE_AFTER = int(os.environ.get("JOB_STALE_AFTER", "120"))
+
+STUDENTS_ROOM = "students"
+
+_COUNTERS = ("push_sent", "push_failed")
+
+_state = {"pid": None}
+
+
+def _target_users(user_id):
+    # SQL selecting the ids a notification for user_id goes to
+    if user_id == BROADCAST_USER_ID:
+        return "SELECT id FROM users WHERE role != 'admin'", ()
+    return "SELECT id FROM users WHERE id = ?", (user_id,)
+
+
+def _email_prefix(notification_id):
+    return f"notification:{notification_id}:"
+
+
+def create_job(conn, notification, email=None):
+    # On the caller's connection, so the job and the emails commit with the
+    # notification. email: (subject, body) for critical notifications; the
+    # caller wakes the outbox after committing.
+    email_total = 0
+    if email:
+        subject, body = email
+        users, args = _target_users(notification["user_id"])
+        email_total = conn.execute(*outbox_emails(
+            users, args, "message", {"subject": subject, "body": body}, _email_prefix(notification["id"])
+        )).rowcount
+    return conn.execute("""
+        INSERT INTO notification_jobs (notification_id, email_total, updated_at)
+        VALUES (?, ?, datetime('now')) RETURNING id
+    """, (notification["id"], email_total)).fetchone()["id"]
+
+
+def start_job(job_id):
+    socketio.start_background_task(run_job, job_id)
+
+
+def get_job(job_id):
+    conn = get_db()
+    row = conn.execute("SELECT * FROM notification_jobs WHERE id=?", (job_id,)).fetchone()
+    job = dict(row) if row else None
+    if job and job["email_total"]:
+        # Sent rows are purged after a while, so sent = total - pending - dead
+        prefix = _email_prefix(job["notification_id"])
+        counts = conn.execute("""
+            SELECT
+                COALESCE(SUM(status IN ('queued', 'sending')), 0) AS pending,
+                COALESCE(SUM(status = 'dead'), 0) AS dead
+            FROM email_outbox WHERE dedupe_key >= ? AND dedupe_key < ?
+        """, (prefix, prefix[:-1] + ";")).fetchone()
+        job["email_failed"] = counts["dead"]
+        job["email_sent"] = job["email_total"] - counts["pending"] - counts["dead"]
+    conn.close()
+    return job
+
+
+# -----------------------
+# JOB
+# -----------------------
+def _update_job(job_id, finished=False, **fields):
+    assignments = [f"{name}=?" for name in fields] + ["updated_at=datetime('now')"]
+    if finished:
+        assignments.append("finished_at=datetime('now')")
+    conn = get_db()
+    conn.execute(
+        f"UPDATE notification_jobs SET {', '.join(assignments)} WHERE id=?",
+        tuple(fields.values()) + (job_id,)
+    )
+    conn.commit()
+    conn.close()
+
+
+def _load_targets(notification):
+    users, args = _target_users(notification["user_id"])
+    conn = get_db()
+    subs = conn.execute(
+        f"SELECT endpoint, p256dh, auth FROM push_subscriptions WHERE user_id IN ({users})", args
+    ).fetchall()
+    conn.close()
+    return subs
+
+
+def run_job(job_id):
+    try:
+        conn = get_db()
+        notification = conn.execute("""
+            SELECT n.* FROM notification_jobs j
+            JOIN notifications n ON n.id = j.notification_id
+            WHERE j.id=?
+        """, (job_id,)).fetchone()
+        conn.close()
+        if notification is None:
+            _update_job(job_id, finished=True, status="failed", error="notification not found")
+            return
+
+        payload = notification_payload(notification)
+        if notification["user_id"] == BROADCAST_USER_ID:
+            socketio.emit("new_notification", payload, room=STUDENTS_ROOM)
+        else:
+            socketio.emit("new_notification", payload, room=f"user_{notification['user_id']}")
+
+        try:
+            expire_subscriptions()
+        except Exception as e:
+            print("[PUSH] expiry failed:", e)
+        subs = _load_targets(notification)
+        _update_job(job_id, status="running", push_total=len(subs))
+
+        progress = dict.fromkeys(_COUNTERS, 0)
+        push_data = json.dumps({
+            "title": notification["title"],
+            "message": notification["message"],
+            "link": notification["link"],
+        })
+
+        def count(outcome):
+            progress["push_sent" if outcome == "sent" else "push_failed"] += 1
+
+        worker = gevent.spawn(deliver_push, subs, push_data, on_result=count)
+        while not worker.ready():
+            worker.join(timeout=JOB_PROGRESS_INTERVAL)
+            _update_job(job_id, **progress)
+        worker.get()
+
+        _update_job(job_id, finished=True, status="done", **progress)
+        print(f"[FANOUT] job {job_id}: " + " ".join(f"{k}={v}" for k, v in progress.items()))
+    except Exception as e:
+        print(f"[FANOUT] job {job_id} failed:", e)
+        _update_job(job_id, finished=True, status="failed", error=str(e)[:500])
+
+
+# -----------------------
+# RECOVERY
+# -----------------------
+def recover_jobs():
+    # Claims stale queued jobs by bumping their heartbeat (so only one worker
+    # re-runs each) and fails running ones, whose pushes may be half sent
+    stale = f"-{JOB_STALE_AFTER} seconds"
+    conn = get_db()
+    queued, interrupted = conn.batch([
+        ("""UPDATE notification_jobs SET updated_at=datetime('now')
+            WHERE status='queued' AND COALESCE(updated_at, created_at) < datetime('now', ?)
+            RETURNING id""", (stale,)),
+        ("""UPDATE notification_jobs SET status='failed', finished_at=datetime('now'),
+            updated_at=datetime('now'), error='interrupted by a worker restart'
+            WHERE status='running' AND COALESCE(updated_at, created_at) < datetime('now', ?)
+            RETURNING id""", (stale,)),
+    ])
+    resumed = [r["id"] for r in queued.fetchall()]
+    failed = [r["id"] for r in interrupted.fetchall()]
+    conn.commit()
+    conn.close()
+    for job_id in resumed:
+        start_job(job_id)
+    if resumed or failed:
+        print(f"[FANOUT] resumed jobs {resumed}, failed interrupted jobs {failed}")
+
+
+def init_fanout(app):
+    # Once per worker process, from its first request
+    @app.before_request
+    def recover_stale_jobs():
+        pid = os.getpid()
+        if _state["pid"] == pid:
+            return
+        _state["pid"] = pid
+        try:
+            recover_jobs()
+        except Exception as e:
+            print("[FANOUT] job recovery failed:", e)
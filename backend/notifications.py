@@ -0,0 +1,204 @@
+from flask import session
+from extensions import socketio
+from backend import db
+from backend.db import get_db
+
+# -----------------------
+# NOTIFICATION FEED
+# -----------------------
+# A user's feed is their personal notifications plus broadcasts. A broadcast
+# is a single notifications row with user_id = BROADCAST_USER_ID; it shares
+# the id sequence, so both streams page and sync on the same id cursor.
+# Per-user read/archived state for broadcasts lives in broadcast_state,
+# which only gets a row once the user acts on one. users.broadcast_floor
+# hides broadcasts sent before the user registered.
+BROADCAST_USER_ID = 0
+
+FEED_PAGE_SIZE = 20
+FEED_MAX_PAGE_SIZE = 100
+
+_PERSONAL_SQL = """
+    SELECT id, title, message, link, is_read, is_critical, created_at
+    FROM notifications
+    WHERE user_id=? AND is_archived=0 AND id {op} ?
+    ORDER BY id {order} LIMIT ?
+"""
+
+# Broadcasts visible to u.id, with their overlay state
+_BROADCASTS_FROM = f"""
+    FROM users u
+    JOIN notifications n ON n.user_id = {BROADCAST_USER_ID} AND n.is_archived = 0
+        AND n.id > COALESCE(u.broadcast_floor, 0)
+    LEFT JOIN broadcast_state s ON s.notification_id = n.id AND s.user_id = u.id
+"""
+
+_BROADCAST_SQL = """
+    SELECT n.id, n.title, n.message, n.link, COALESCE(s.is_read, 0) AS is_read,
+        n.is_critical, n.created_at
+""" + _BROADCASTS_FROM + """
+    WHERE u.id = ? AND n.id {op} ? AND COALESCE(s.is_archived, 0) = 0
+    ORDER BY n.id {order} LIMIT ?
+"""
+
+# Each stream is limited on its own index range before the two are merged
+_FEED_SQL = "SELECT * FROM ({personal}) UNION ALL SELECT * FROM ({broadcast}) ORDER BY id {order} LIMIT ?"
+
+db.register_query("notifications_feed", _PERSONAL_SQL.format(op="<", order="DESC"))
+db.register_query("broadcasts_feed", _BROADCAST_SQL.format(op="<", order="DESC"))
+
+UNREAD_SQL = db.register_query("notifications_unread", f"""
+    SELECT (
+        SELECT COUNT(*) FROM notifications
+        WHERE user_id=? AND is_archived=0 AND is_read=0
+    ) + (
+        SELECT COUNT(*) {_BROADCASTS_FROM}
+        WHERE u.id = ? AND COALESCE(s.is_read, 0) = 0
+    ) AS unread
+""")
+
+_NO_CURSOR = 2 ** 63 - 1
+
+
+def notification_payload(row):
+    return {
+        "id": row["id"], "title": row["title"], "message": row["message"],
+        "link": row["link"], "is_read": row["is_read"],
+        "is_critical": row["is_critical"], "created_at": row["created_at"],
+    }
+
+
+def feed_page(user_id, before=None, since_id=None, limit=FEED_PAGE_SIZE):
+    limit = max(1, min(limit, FEED_MAX_PAGE_SIZE))
+    if since_id is not None:
+        op, order, cursor = ">", "ASC", since_id
+    else:
+        op, order, cursor = "<", "DESC", before if before is not None else _NO_CURSOR
+    sql = _FEED_SQL.format(
+        personal=_PERSONAL_SQL.format(op=op, order=order),
+        broadcast=_BROADCAST_SQL.format(op=op, order=order),
+        order=order,
+    )
+    conn = get_db()
+    try:
+        rows = conn.execute(sql, (user_id, cursor, limit, user_id, cursor, limit, limit)).fetchall()
+    finally:
+        conn.close()
+    if since_id is not None:
+        rows = list(reversed(rows))
+    return {
+        "items": [notification_payload(r) for r in rows],
+        "has_more": len(rows) == limit,
+    }
+
+
+def unread_count(user_id):
+    conn = get_db()
+    row = conn.execute(UNREAD_SQL, (user_id, user_id)).fetchone()
+    conn.close()
+    return row["unread"]
+
+
+# Value for a new user's broadcast_floor: every broadcast so far predates them
+BROADCAST_FLOOR_SQL = f"(SELECT COALESCE(MAX(id), 0) FROM notifications WHERE user_id = {BROADCAST_USER_ID} AND is_archived = 0)"
+
+
+# -----------------------
+# BULK STATE CHANGES
+# -----------------------
+# Each change is one set-based statement per stream, sent together on the
+# caller's connection; RETURNING gives the ids that actually changed so
+# other tabs can patch their lists.
+def mark_read(conn, user_id, from_id=None, to_id=None):
+    personal = "UPDATE notifications SET is_read=1 WHERE user_id=? AND is_archived=0 AND is_read=0"
+    broadcast = f"""
+        INSERT OR IGNORE INTO broadcast_state (notification_id, user_id, is_read)
+        SELECT n.id, u.id, 1 {_BROADCASTS_FROM}
+        WHERE u.id = ? AND s.notification_id IS NULL
+    """
+    personal_args, broadcast_args = [user_id], [user_id]
+    if from_id is not None:
+        personal += " AND id >= ?"
+        broadcast += " AND n.id >= ?"
+        personal_args.append(from_id)
+        broadcast_args.append(from_id)
+    if to_id is not None:
+        personal += " AND id <= ?"
+        broadcast += " AND n.id <= ?"
+        personal_args.append(to_id)
+        broadcast_args.append(to_id)
+
+    personal_ids, broadcast_ids = conn.batch([
+        (personal + " RETURNING id", personal_args),
+        (broadcast + " RETURNING notification_id AS id", broadcast_args),
+    ])
+    ids = sorted(r["id"] for r in personal_ids.fetchall() + broadcast_ids.fetchall())
+    if ids:
+        bump_notif_version(conn, [user_id])
+    return ids
+
+
+def archive_read(conn, user_id, older_than_days):
+    cutoff = f"-{int(older_than_days)} days"
+    personal_ids, broadcast_ids = conn.batch([
+        ("""
+            UPDATE notifications SET is_archived=1
+            WHERE user_id=? AND is_archived=0 AND is_read=1
+            AND created_at < datetime('now', ?)
+            RETURNING id
+        """, (user_id, cutoff)),
+        (f"""
+            UPDATE broadcast_state SET is_archived=1
+            WHERE user_id=? AND is_read=1 AND is_archived=0
+            AND notification_id IN (
+                SELECT id FROM notifications
+                WHERE user_id = {BROADCAST_USER_ID} AND is_archived = 0
+                AND created_at < datetime('now', ?)
+            )
+            RETURNING notification_id AS id
+        """, (user_id, cutoff)),
+    ])
+    ids = sorted(r["id"] for r in personal_ids.fetchall() + broadcast_ids.fetchall())
+    if ids:
+        bump_notif_version(conn, [user_id])
+    return ids
+
+
+def sync_notification_state(user_id, action, ids):
+    # Tells every open tab/device of the user what changed, with the new
+    # unread count so none of them has to refetch
+    payload = {"action": action, "ids": ids, "unread": unread_count(user_id)}
+    socketio.emit("notifications_sync", payload, room=f"user_{user_id}")
+    return payload
+
+
+# -----------------------
+# NOTIFICATION VERSIONS
+# -----------------------
+# users.notif_version moves whenever anything in a user's own notification
+# state changes; the newest broadcast id covers broadcasts. Together they
+# revalidate the feed with one primary-key lookup.
+def bump_notif_version(conn, user_ids):
+    user_ids = sorted(set(int(u) for u in user_ids))
+    if not user_ids:
+        return
+    placeholders = ",".join("?" for _ in user_ids)
+    conn.execute(
+        f"UPDATE users SET notif_version = COALESCE(notif_version, 0) + 1 WHERE id IN ({placeholders})",
+        user_ids
+    )
+
+
+def notifications_etag():
+    user_id = session.get("user_id")
+    if user_id is None:
+        return None
+    conn = get_db()
+    row = conn.execute(f"""
+        SELECT COALESCE(notif_version, 0) AS v, (
+            SELECT COALESCE(MAX(id), 0) FROM notifications
+            WHERE user_id = {BROADCAST_USER_ID} AND is_archived = 0
+        ) AS b
+        FROM users WHERE id=?
+    """, (user_id,)).fetchone()
+    conn.close()
+    return f"notif-{user_id}-{row['v']}-{row['b']}" if row else None
@@ -0,0 +1,274 @@
+import json
+import os
+import time
+import gevent
+from gevent.event import Event
+from gevent.pool import Pool
+from backend.db import get_db
+from backend.email_service import deliver_email, send_bulk_email
+from backend.email_templates import render_email
+
+# -----------------------
+# EMAIL OUTBOX
+# -----------------------
+# Request handlers never talk to the email provider. They add an
+# email_outbox row (template name + JSON params) alongside their own writes
+# and call wake_outbox() after committing; a background loop in each worker
+# claims due rows, renders and sends them over a small pool, and retries
+# failures with exponential backoff until OUTBOX_MAX_ATTEMPTS, after which
+# the row is dead-lettered for an admin to inspect or retry; failures the
+# provider reports as permanent are dead-lettered at once. Claimed rows are
+# leased, and the lease is renewed while their send is still running so a
+# long bulk send is never picked up by another worker. A dedupe_key
+# makes enqueueing the same email twice (e.g. from both the payment
+# callback and the webhook) a no-op. Claimed rows that share a template and
+# every param but the recipient's name (a material announcement) go out
+# through one bulk send instead of one request each.
+OUTBOX_CONCURRENCY = int(os.environ.get("OUTBOX_CONCURRENCY", "4"))
+OUTBOX_BATCH = int(os.environ.get("OUTBOX_BATCH", "500"))
+OUTBOX_POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", "5"))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE = int(os.environ.get("OUTBOX_BACKOFF_BASE", "30"))
+OUTBOX_BACKOFF_MAX = 6 * 60 * 60
+# A claimed row is picked up again if its worker died and stopped renewing
+OUTBOX_LEASE = int(os.environ.get("OUTBOX_LEASE", "300"))
+OUTBOX_RETENTION_DAYS = int(os.environ.get("OUTBOX_RETENTION_DAYS", "14"))
+OUTBOX_MAINTENANCE_INTERVAL = 60 * 60
+
+_ENQUEUE_SQL = """
+    INSERT INTO email_outbox (to_email, template, params, dedupe_key)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(dedupe_key) DO NOTHING
+"""
+
+_state = {"pid": None, "maintained": None}
+_wake = Event()
+
+
+def outbox_email(to_email, template, params, dedupe_key=None):
+    # (sql, params) for the caller's batch or transaction
+    return _ENQUEUE_SQL, (to_email, template, json.dumps(params), dedupe_key)
+
+
+def outbox_emails(users_sql, args, template, params, dedupe_prefix):
+    # (sql, params) queueing one email per user id users_sql selects, with
+    # the shared params plus each user's name; dedupe_prefix + user id is
+    # the dedupe key
+    return f"""
+        INSERT INTO email_outbox (to_email, template, params, dedupe_key)
+        SELECT u.email, ?, json_set(?, '$.name', u.name), ? || u.id
+        FROM users u WHERE u.id IN ({users_sql})
+        ON CONFLICT(dedupe_key) DO NOTHING
+    """, (template, json.dumps(params), dedupe_prefix) + tuple(args)
+
+
+def enqueue_email(conn, to_email, template, params, dedupe_key=None):
+    conn.execute(*outbox_email(to_email, template, params, dedupe_key))
+
+
+def wake_outbox():
+    start_outbox()
+    _wake.set()
+
+
+# -----------------------
+# WORKER
+# -----------------------
+def start_outbox():
+    # One drain loop per worker process
+    pid = os.getpid()
+    if _state["pid"] != pid:
+        _state["pid"] = pid
+        gevent.spawn(_run)
+
+
+def _backoff(attempts):
+    return min(OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
+
+
+def _claim():
+    conn = get_db()
+    rows = conn.execute("""
+        UPDATE email_outbox
+        SET status='sending', attempts=attempts+1, next_attempt_at=datetime('now', ?)
+        WHERE id IN (
+            SELECT id FROM email_outbox
+            WHERE status IN ('queued', 'sending') AND next_attempt_at <= datetime('now')
+            AND attempts < ?
+            ORDER BY next_attempt_at LIMIT ?
+        )
+        RETURNING id, to_email, template, params, attempts
+    """, (f"+{OUTBOX_LEASE} seconds", OUTBOX_MAX_ATTEMPTS, OUTBOX_BATCH)).fetchall()
+    conn.commit()
+    conn.close()
+    return rows
+
+
+def _renew_lease(ids, done):
+    # Keeps the claim on rows whose send is still running
+    while not done.wait(OUTBOX_LEASE / 3):
+        conn = get_db()
+        try:
+            conn.execute("""
+                UPDATE email_outbox SET next_attempt_at=datetime('now', ?)
+                WHERE status='sending' AND id IN (SELECT value FROM json_each(?))
+            """, (f"+{OUTBOX_LEASE} seconds", json.dumps(ids)))
+            conn.commit()
+        except Exception as e:
+            print("[OUTBOX] lease renewal failed:", e)
+        finally:
+            conn.close()
+
+
+def _send_group(group):
+    # [(row, params)] sharing one template and shared params; returns
+    # [(row, error, retryable)]. Provider failures come back as
+    # (reason, permanent), so an exception here is a template problem and
+    # will not go away on retry.
+    rows = [row for row, _ in group]
+    template = rows[0]["template"]
+    try:
+        if len(group) == 1:
+            message = render_email(template, group[0][1])
+            failures = [deliver_email(rows[0]["to_email"], *message)]
+        else:
+            shared = {k: v for k, v in group[0][1].items() if k != "name"}
+            failures = send_bulk_email(template, shared, [
+                {"email": row["to_email"], "name": params.get("name")} for row, params in group
+            ])
+    except Exception as e:
+        error = f"render failed: {type(e).__name__}: {e}"
+        return [(row, error, False) for row in rows]
+    return [
+        (row, failure[0], not failure[1]) if failure else (row, None, True)
+        for row, failure in zip(rows, failures)
+    ]
+
+
+def _group(rows):
+    groups = {}
+    for row in rows:
+        try:
+            params = json.loads(row["params"])
+            shared = {k: v for k, v in params.items() if k != "name"}
+            key = (row["template"], json.dumps(shared, sort_keys=True))
+        except Exception:
+            params, key = {}, ("unparsable", row["id"])
+        groups.setdefault(key, []).append((row, params))
+    return list(groups.values())
+
+
+def _drain_once():
+    rows = _claim()
+    if not rows:
+        return 0
+
+    done = Event()
+    gevent.spawn(_renew_lease, [row["id"] for row in rows], done)
+    updates = []
+    try:
+        sent = list(Pool(OUTBOX_CONCURRENCY).imap_unordered(_send_group, _group(rows)))
+    finally:
+        done.set()
+    for results in sent:
+        for row, error, retryable in results:
+            if error is None:
+                # params can hold one-time links; they are not needed once sent
+                updates.append((
+                    "UPDATE email_outbox SET status='sent', sent_at=datetime('now'), params=NULL, last_error=NULL WHERE id=?",
+                    (row["id"],)
+                ))
+            elif retryable and row["attempts"] < OUTBOX_MAX_ATTEMPTS:
+                updates.append((
+                    "UPDATE email_outbox SET status='queued', last_error=?, next_attempt_at=datetime('now', ?) WHERE id=?",
+                    (error[:500], f"+{_backoff(row['attempts'])} seconds", row["id"])
+                ))
+            else:
+                updates.append((
+                    "UPDATE email_outbox SET status='dead', last_error=? WHERE id=?",
+                    (error[:500], row["id"])
+                ))
+                print(f"[OUTBOX] email {row['id']} to {row['to_email']} dead-lettered: {error}")
+
+    conn = get_db()
+    conn.batch(updates)
+    conn.commit()
+    conn.close()
+    return len(rows)
+
+
+def _maintain():
+    # Dead-letter rows whose worker kept dying mid-send, forget old sent rows
+    conn = get_db()
+    conn.batch([
+        ("""UPDATE email_outbox SET status='dead', last_error='lease expired'
+            WHERE status='sending' AND next_attempt_at <= datetime('now') AND attempts >= ?""",
+         (OUTBOX_MAX_ATTEMPTS,)),
+        ("DELETE FROM email_outbox WHERE status='sent' AND sent_at < datetime('now', ?)",
+         (f"-{OUTBOX_RETENTION_DAYS} days",)),
+    ])
+    conn.commit()
+    conn.close()
+
+
+def _run():
+    while True:
+        _wake.clear()
+        claimed = 0
+        try:
+            now = time.monotonic()
+            last = _state["maintained"]
+            if last is None or now - last >= OUTBOX_MAINTENANCE_INTERVAL:
+                _state["maintained"] = now
+                _maintain()
+            claimed = _drain_once()
+        except Exception as e:
+            print("[OUTBOX] worker error:", e)
+        if claimed < OUTBOX_BATCH:
+            _wake.wait(OUTBOX_POLL_INTERVAL)
+
+
+def init_outbox(app):
+    # Started from the first request so pre-forking servers start it per worker
+    @app.before_request
+    def ensure_outbox_worker():
+        start_outbox()
+
+
+# -----------------------
+# ADMIN
+# -----------------------
+def outbox_stats():
+    conn = get_db()
+    by_status, due, dead = conn.batch([
+        ("SELECT status, COUNT(*) AS n, MIN(created_at) AS oldest FROM email_outbox GROUP BY status", ()),
+        ("""SELECT COUNT(*) AS n FROM email_outbox
+            WHERE status IN ('queued', 'sending') AND next_attempt_at <= datetime('now')""", ()),
+        ("""SELECT id, to_email, template, attempts, last_error, created_at
+            FROM email_outbox WHERE status='dead' ORDER BY id DESC LIMIT 50""", ()),
+    ])
+    counts = {r["status"]: {"count": r["n"], "oldest": r["oldest"]} for r in by_status.fetchall()}
+    stats = {
+        "queued": counts.get("queued", {}).get("count", 0),
+        "sending": counts.get("sending", {}).get("count", 0),
+        "sent": counts.get("sent", {}).get("count", 0),
+        "dead": counts.get("dead", {}).get("count", 0),
+        "due": due.fetchone()["n"],
+        "oldest_queued": counts.get("queued", {}).get("oldest"),
+        "dead_letters": [dict(r) for r in dead.fetchall()],
+    }
+    conn.close()
+    return stats
+
+
+def retry_dead(email_id):
+    conn = get_db()
+    row = conn.execute("""
+        UPDATE email_outbox SET status='queued', attempts=0, next_attempt_at=datetime('now')
+        WHERE id=? AND status='dead' RETURNING id
+    """, (email_id,)).fetchone()
+    conn.commit()
+    conn.close()
+    if row:
+        wake_outbox()
+    return row is not None
@@ -1,8 +1,10 @@
 from flask import Blueprint, jsonify, session, redirect, request
 import requests
 import os
-from backend.db import get_db, is_admin
-from backend.email_service import send_payment_success_email
+from backend.db import get_db
+from backend.principal import is_admin, revoke_claims, current_principal
+from backend.conditional import etag
+from backend.outbox import enqueue_email, wake_outbox
 
 payment_bp = Blueprint("payment_bp", __name__)
 
@@ -129,15 +131,16 @@ def payment_callback():
     else:
         already_paid = True
 
+    if not already_paid:
+        revoke_claims(conn, user_id)
+        # Same key as the webhook, so only one of them sends
+        enqueue_email(conn, email, "payment_success", {"name": user_name},
+                      dedupe_key=f"payment:{reference}")
     conn.commit()
     conn.close()
 
-    # Send payment success email
     if not already_paid:
-        try:
-            send_payment_success_email(email, user_name)
-        except Exception as e:
-            print("Payment email failed:", e)
+        wake_outbox()
 
     return redirect("/account?payment=success")
 
@@ -145,7 +148,21 @@ def payment_callback():
 # ------------------------------------
 # PAYMENT STATUS
 # ------------------------------------
+def _payment_status_etag():
+    # Only settled states are tagged: every write that settles or overrides
+    # a payment bumps auth_epoch. An unpaid payment is still checked against
+    # Paystack on each call.
+    principal = current_principal()
+    if principal is None:
+        return None
+    if not (principal.is_admin or principal.payment_status == "paid"
+            or principal.admin_override_status in ("paid", "unpaid")):
+        return None
+    return f"pay-{principal.user_id}-{principal.auth_epoch}"
+
+
 @payment_bp.route("/api/payment/status", methods=["GET"])
+@etag(_payment_status_etag)
 def payment_status():
     if "user_id" not in session:
         return jsonify({"error": "Not authenticated"}), 401
@@ -189,6 +206,7 @@ def payment_status():
                 c.execute("""
                     UPDATE payments SET status='paid', paid_at=datetime('now') WHERE id=?
                 """, (payment_data["id"],))
+                revoke_claims(conn, user_id)
                 conn.commit()
                 payment_data["status"] = "paid"
                 payment_data["paid_at"] = data["data"].get("paid_at")
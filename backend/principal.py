@@ -0,0 +1,190 @@
+import os
+import time
+from flask import g, session, request, has_request_context
+from backend import db
+
+# -----------------------
+# REQUEST PRINCIPAL
+# -----------------------
+# Role, suspension and payment state of the logged-in user. It comes from
+# signed claims in the session cookie while they are fresh, otherwise from a
+# single joined query, and is kept on flask.g for the rest of the request.
+PRINCIPAL_SQL = db.register_query("principal", """
+    SELECT
+        u.id, u.role, u.is_suspended, COALESCE(u.auth_epoch, 0) AS auth_epoch,
+        p.id AS payment_id, p.status AS payment_status, p.admin_override_status
+    FROM users u
+    LEFT JOIN payments p ON p.id = (
+        SELECT MAX(id) FROM payments WHERE user_id = u.id
+    )
+    WHERE u.id = ?
+""")
+
+# How long session claims are trusted before going back to the database.
+# Every revocation bumps the user's auth_epoch and logs the new epoch in
+# auth_revocations; each worker reads new entries at most every
+# AUTH_CHECK_INTERVAL seconds and stops trusting that user's claims issued
+# under an older epoch, so a suspension, payment change or password reset
+# reaches every worker within that interval without touching anyone else's.
+AUTH_CLAIMS_TTL = int(os.environ.get("AUTH_CLAIMS_TTL", "60"))
+AUTH_CHECK_INTERVAL = float(os.environ.get("AUTH_CHECK_INTERVAL", "2"))
+
+# Endpoints that never need the principal (or a session cookie refresh)
+ASSET_ENDPOINTS = {"static", "assets", "service_worker"}
+
+# revoked: user_id -> (latest epoch, when this worker learned of it)
+_auth_state = {"seen": 0, "checked": None, "revoked": {}}
+
+
+class Principal:
+    def __init__(self, user_id, role, is_suspended, auth_epoch,
+                 has_payment, payment_status, admin_override_status):
+        self.user_id = user_id
+        self.role = role
+        self.is_suspended = bool(is_suspended)
+        self.auth_epoch = auth_epoch
+        self.has_payment = has_payment
+        self.payment_status = payment_status
+        self.admin_override_status = admin_override_status
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(
+            row["id"], row["role"], row["is_suspended"], row["auth_epoch"],
+            row["payment_id"] is not None, row["payment_status"], row["admin_override_status"]
+        )
+
+    @classmethod
+    def from_claims(cls, claims):
+        return cls(
+            claims["uid"], claims["role"], claims["susp"], claims["epoch"],
+            claims["has_pay"], claims["pay"], claims["ovr"]
+        )
+
+    def to_claims(self):
+        now = time.time()
+        return {
+            "uid": self.user_id, "role": self.role, "susp": self.is_suspended,
+            "epoch": self.auth_epoch, "has_pay": self.has_payment,
+            "pay": self.payment_status, "ovr": self.admin_override_status,
+            "iat": now, "exp": now + AUTH_CLAIMS_TTL,
+        }
+
+    @property
+    def is_admin(self):
+        return self.role == "admin"
+
+    @property
+    def has_paid(self):
+        # Same rule the course/stream routes always used: either the Paystack
+        # status or an admin override says paid
+        return self.has_payment and (
+            self.payment_status == "paid" or self.admin_override_status == "paid"
+        )
+
+    @property
+    def effective_payment_status(self):
+        if not self.has_payment:
+            return "unpaid"
+        return self.admin_override_status or self.payment_status
+
+
+def is_asset_request():
+    return request.endpoint in ASSET_ENDPOINTS
+
+
+def load_principal(user_id):
+    conn = db.get_db()
+    row = conn.execute(PRINCIPAL_SQL, (user_id,)).fetchone()
+    conn.close()
+    return Principal.from_row(row) if row else None
+
+
+def _revoked_epochs():
+    # New revocations straight from the primary, at most every
+    # AUTH_CHECK_INTERVAL seconds; anything older than AUTH_CLAIMS_TTL can
+    # only affect claims that have expired anyway
+    now = time.monotonic()
+    checked = _auth_state["checked"]
+    if checked is None or now - checked >= AUTH_CHECK_INTERVAL:
+        conn = db.get_primary()
+        try:
+            rows = conn.execute("""
+                SELECT version, user_id, epoch FROM auth_revocations
+                WHERE version > ? AND created_at >= datetime('now', ?)
+                ORDER BY version
+            """, (_auth_state["seen"], f"-{AUTH_CLAIMS_TTL} seconds")).fetchall()
+        finally:
+            conn.close()
+        revoked = _auth_state["revoked"]
+        for user_id in [u for u, (_, at) in revoked.items() if now - at > AUTH_CLAIMS_TTL]:
+            del revoked[user_id]
+        for row in rows:
+            epoch = max(row["epoch"], revoked.get(row["user_id"], (0, 0))[0])
+            revoked[row["user_id"]] = (epoch, now)
+        if rows:
+            _auth_state["seen"] = rows[-1]["version"]
+        _auth_state["checked"] = now
+    return _auth_state["revoked"]
+
+
+def _fresh_claims(user_id):
+    claims = session.get("claims")
+    if not claims or claims.get("uid") != user_id or claims["exp"] <= time.time():
+        return None
+    revoked = _revoked_epochs().get(user_id)
+    if revoked and claims["epoch"] < revoked[0]:
+        return None
+    return claims
+
+
+def current_principal():
+    user_id = session.get("user_id")
+    if user_id is None:
+        return None
+    if g.get("principal_user_id") == user_id:
+        return g.principal
+
+    # Revocations are read before the principal, so one landing in between
+    # is seen on the next check and leaves the new claims already stale
+    claims = _fresh_claims(user_id)
+    if claims:
+        principal = Principal.from_claims(claims)
+    else:
+        principal = load_principal(user_id)
+        if principal:
+            session["claims"] = principal.to_claims()
+        else:
+            session.pop("claims", None)
+
+    g.principal = principal
+    g.principal_user_id = user_id
+    return principal
+
+
+def revoke_claims(conn, user_id):
+    # Bumps the user's auth_epoch and logs it through the caller's connection
+    # (so both join their batch or transaction). A deleted user has no epoch
+    # left, so every claim they hold is stale.
+    conn.execute(
+        "UPDATE users SET auth_epoch = COALESCE(auth_epoch, 0) + 1 WHERE id=?",
+        (user_id,)
+    )
+    conn.execute("""
+        INSERT INTO auth_revocations (user_id, epoch)
+        VALUES (?, COALESCE((SELECT auth_epoch FROM users WHERE id=?), 9223372036854775807))
+    """, (user_id, user_id))
+    conn.execute("DELETE FROM auth_revocations WHERE created_at < datetime('now', '-1 day')")
+    _auth_state["checked"] = None
+    if has_request_context():
+        if session.get("user_id") == user_id:
+            session.pop("claims", None)
+        if g.get("principal_user_id") == user_id:
+            g.pop("principal_user_id", None)
+
+
+def is_admin(user_id):
+    principal = current_principal()
+    if principal is not None and principal.user_id == user_id:
+        return principal.is_admin
+    return db.is_admin(user_id)
@@ -0,0 +1,172 @@
+import os
+import time
+from collections import Counter
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from gevent.pool import Pool
+from py_vapid import Vapid
+from pywebpush import WebPusher
+from backend.db import get_db
+
+# -----------------------
+# WEB PUSH DELIVERY
+# -----------------------
+# deliver() sends one payload to many subscriptions over a bounded gevent
+# pool sharing one pooled HTTP session. The VAPID JWT is signed once per
+# push service and reused until shortly before it expires. Subscriptions
+# the push service reports as gone (404/410) are deleted after the batch.
+# Browsers refresh their row's last_seen about once a day; rows not seen for
+# PUSH_SUBSCRIPTION_TTL_DAYS are dropped before a fan-out loads its targets.
+PUSH_CONCURRENCY = int(os.environ.get("PUSH_CONCURRENCY", "20"))
+PUSH_TIMEOUT = float(os.environ.get("PUSH_TIMEOUT", "10"))
+PUSH_TTL = int(os.environ.get("PUSH_TTL", "86400"))
+VAPID_SUBJECT = os.environ.get("VAPID_SUBJECT", "mailto:wideminddevs@gmail.com")
+VAPID_TOKEN_LIFETIME = 12 * 60 * 60  # the longest push services accept is 24h
+VAPID_RENEW_MARGIN = 10 * 60
+PUSH_SUBSCRIPTION_TTL_DAYS = int(os.environ.get("PUSH_SUBSCRIPTION_TTL_DAYS", "90"))
+PUSH_EXPIRE_INTERVAL = 60 * 60
+
+GONE_STATUSES = (404, 410)
+PRUNE_CHUNK = 500
+
+_state = {"pid": None, "session": None, "key": None, "headers": {}, "expired_at": None}
+_stats = Counter()
+
+
+def _session():
+    # One keep-alive pool per worker process, sized to the send pool
+    pid = os.getpid()
+    if _state["pid"] != pid:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=PUSH_CONCURRENCY)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _state.update(pid=pid, session=session, headers={})
+    return _state["session"]
+
+
+def _vapid_key():
+    if _state["key"] is None:
+        private_key = os.environ.get("VAPID_PRIVATE_KEY")
+        if not private_key:
+            raise Exception("VAPID_PRIVATE_KEY is not set")
+        if os.path.isfile(private_key):
+            _state["key"] = Vapid.from_file(private_key_file=private_key)
+        else:
+            _state["key"] = Vapid.from_string(private_key=private_key)
+    return _state["key"]
+
+
+def _vapid_headers(endpoint):
+    url = urlparse(endpoint)
+    audience = f"{url.scheme}://{url.netloc}"
+    now = time.time()
+    cached = _state["headers"].get(audience)
+    if cached and cached[0] - VAPID_RENEW_MARGIN > now:
+        return cached[1]
+    exp = int(now) + VAPID_TOKEN_LIFETIME
+    headers = _vapid_key().sign({"sub": VAPID_SUBJECT, "aud": audience, "exp": exp})
+    _state["headers"][audience] = (exp, headers)
+    return headers
+
+
+def send_one(sub, data):
+    # Returns ("sent" | "gone" | "failed", reason)
+    try:
+        response = WebPusher(
+            {"endpoint": sub["endpoint"], "keys": {"p256dh": sub["p256dh"], "auth": sub["auth"]}},
+            requests_session=_session(),
+        ).send(
+            data,
+            headers=dict(_vapid_headers(sub["endpoint"])),
+            ttl=PUSH_TTL,
+            timeout=PUSH_TIMEOUT,
+        )
+    except Exception as e:
+        return "failed", type(e).__name__
+    if response.status_code in GONE_STATUSES:
+        return "gone", str(response.status_code)
+    if response.status_code > 202:
+        return "failed", str(response.status_code)
+    return "sent", None
+
+
+def prune(endpoints):
+    endpoints = list(endpoints)
+    if not endpoints:
+        return
+    conn = get_db()
+    for i in range(0, len(endpoints), PRUNE_CHUNK):
+        chunk = endpoints[i:i + PRUNE_CHUNK]
+        placeholders = ",".join("?" for _ in chunk)
+        conn.execute(f"DELETE FROM push_subscriptions WHERE endpoint IN ({placeholders})", chunk)
+    conn.commit()
+    conn.close()
+
+
+def expire_subscriptions():
+    # At most once an hour per worker; returns the number of rows removed
+    now = time.monotonic()
+    last = _state["expired_at"]
+    if PUSH_SUBSCRIPTION_TTL_DAYS <= 0 or (last is not None and now - last < PUSH_EXPIRE_INTERVAL):
+        return 0
+    _state["expired_at"] = now
+    conn = get_db()
+    removed = conn.execute(
+        "DELETE FROM push_subscriptions WHERE last_seen < datetime('now', ?) RETURNING id",
+        (f"-{PUSH_SUBSCRIPTION_TTL_DAYS} days",)
+    ).fetchall()
+    conn.commit()
+    conn.close()
+    if removed:
+        _stats["expired"] += len(removed)
+        print(f"[PUSH] expired {len(removed)} subscriptions unseen for {PUSH_SUBSCRIPTION_TTL_DAYS} days")
+    return len(removed)
+
+
+def deliver(subs, data, on_result=None):
+    started = time.perf_counter()
+    batch = Counter()
+    reasons = Counter()
+    gone = set()
+
+    def send(sub):
+        return sub, send_one(sub, data)
+
+    for sub, (outcome, reason) in Pool(PUSH_CONCURRENCY).imap_unordered(send, subs):
+        batch[outcome] += 1
+        if reason:
+            reasons[reason] += 1
+        if outcome == "gone":
+            gone.add(sub["endpoint"])
+        if on_result:
+            on_result(outcome)
+
+    try:
+        prune(gone)
+    except Exception as e:
+        print("[PUSH] prune failed:", e)
+
+    ms = (time.perf_counter() - started) * 1000
+    stats = {
+        "total": len(subs), "sent": batch["sent"], "failed": batch["failed"],
+        "pruned": len(gone), "ms": round(ms, 1), "reasons": dict(reasons),
+    }
+    _stats.update({"batches": 1, "sent": batch["sent"], "failed": batch["failed"], "pruned": len(gone)})
+    if subs:
+        print(
+            f"[PUSH] {stats['sent']}/{stats['total']} sent, {stats['failed']} failed, "
+            f"{stats['pruned']} pruned in {ms:.0f}ms" + (f" {dict(reasons)}" if reasons else "")
+        )
+    return stats
+
+
+def push_stats():
+    return {
+        "concurrency": PUSH_CONCURRENCY,
+        "timeout": PUSH_TIMEOUT,
+        "subscription_ttl_days": PUSH_SUBSCRIPTION_TTL_DAYS,
+        "vapid_audiences": len(_state["headers"]),
+        **_stats,
+    }
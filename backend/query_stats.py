@@ -0,0 +1,104 @@
+import os
+import re
+import time
+from collections import Counter
+from flask import g, request, has_request_context
+
+# -----------------------
+# PER-REQUEST QUERY STATS
+# -----------------------
+# Every database round trip made while handling a request is recorded on
+# flask.g; slow requests or repeated statement shapes (likely N+1 loops) are
+# logged, and the totals go out in a Server-Timing header to admins only
+# (or to everyone with SERVER_TIMING_ALL=1 while debugging), since they
+# show how much database work each route does.
+# Streamed responses (stream_template) are reported before their body is
+# generated, so queries made while streaming are not counted.
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "500"))
+N_PLUS_ONE_THRESHOLD = int(os.environ.get("N_PLUS_ONE_THRESHOLD", "3"))
+SERVER_TIMING_ALL = os.environ.get("SERVER_TIMING_ALL", "0") == "1"
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_sql(sql):
+    sql = _STRING_RE.sub("?", sql)
+    sql = _NUMBER_RE.sub("?", sql)
+    sql = _IN_LIST_RE.sub("(?)", sql)
+    return _SPACE_RE.sub(" ", sql).strip()
+
+
+def _stats():
+    stats = g.get("db_stats")
+    if stats is None:
+        stats = g.db_stats = {
+            "round_trips": 0,
+            "queries": 0,
+            "rows": 0,
+            "ms": 0.0,
+            "shapes": Counter(),
+        }
+    return stats
+
+
+def record_query(statements, elapsed, rows=0):
+    # statements: the SQL sent in one round trip; elapsed in seconds
+    if not has_request_context():
+        return
+    stats = _stats()
+    stats["round_trips"] += 1
+    stats["queries"] += len(statements)
+    stats["rows"] += rows
+    stats["ms"] += elapsed * 1000
+    for sql in statements:
+        stats["shapes"][normalize_sql(sql)] += 1
+
+
+def _show_timing():
+    # Uses the principal the request already loaded instead of querying for it
+    if SERVER_TIMING_ALL:
+        return True
+    principal = g.get("principal")
+    return principal is not None and principal.is_admin
+
+
+def init_query_stats(app):
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def report_query_stats(response):
+        started = g.get("request_started")
+        if started is None:
+            return response
+        total_ms = (time.perf_counter() - started) * 1000
+        stats = g.get("db_stats")
+
+        if _show_timing():
+            timings = [f"app;dur={total_ms:.1f}"]
+            if stats:
+                timings.append(
+                    f'db;dur={stats["ms"]:.1f};desc="{stats["queries"]} queries, '
+                    f'{stats["round_trips"]} round trips, {stats["rows"]} rows"'
+                )
+            if response.is_streamed:
+                timings.append('partial;desc="streamed: queries run while streaming are not counted"')
+            response.headers.add("Server-Timing", ", ".join(timings))
+
+        if not stats:
+            return response
+
+        if total_ms >= SLOW_REQUEST_MS:
+            print(
+                f"[SLOW] {request.method} {request.path} {total_ms:.0f}ms "
+                f"db={stats['ms']:.0f}ms queries={stats['queries']} "
+                f"round_trips={stats['round_trips']}"
+            )
+        for shape, count in stats["shapes"].items():
+            if count >= N_PLUS_ONE_THRESHOLD:
+                print(f"[N+1] {request.method} {request.path} ran {count}x: {shape[:160]}")
+        return response
@@ -0,0 +1,481 @@
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, session, has_request_context
+from backend.db import (
+    DB_REPLICA_PATH, DB_REPLICA_SYNC_INTERVAL, DB_REPLICA_PRUNE_INTERVAL, DB_REPLICA_STALE_AFTER,
+    SQLiteConnection, _is_write, _sqlite_discard, get_primary
+)
+
+# -----------------------
+# EMBEDDED READ REPLICA
+# -----------------------
+# Each worker keeps a local SQLite copy of the primary and serves SELECTs
+# from it. The primary records every row change in _replica_log (filled by
+# triggers), so a sync only pulls rows that changed since the last one.
+# Replicas report how far they have applied the log in _replica_progress;
+# entries every live replica has applied are pruned, and the highest pruned
+# seq is kept in schema_meta so a replica that fell behind it starts over.
+CHANGE_LOG_TABLE = "_replica_log"
+PROGRESS_TABLE = "_replica_progress"
+SYNC_BATCH = 500
+
+_TABLE_RE = re.compile(r"\b(?:FROM|JOIN)\s+([A-Za-z_][A-Za-z0-9_]*)", re.IGNORECASE)
+_TRIGGERS_SQL = "SELECT name FROM sqlite_master WHERE type='trigger' AND name LIKE '\\_replica\\_%' ESCAPE '\\'"
+
+
+# -----------------------
+# PRIMARY SIDE
+# -----------------------
+def install_change_log(primary):
+    primary.batch([
+        (f"""CREATE TABLE IF NOT EXISTS {CHANGE_LOG_TABLE} (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        tbl TEXT NOT NULL, row_id INTEGER NOT NULL)""", ()),
+        (f"""CREATE TABLE IF NOT EXISTS {PROGRESS_TABLE} (
+        replica TEXT PRIMARY KEY, seq INTEGER NOT NULL,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP)""", ()),
+    ])
+    tables = [
+        r["name"] for r in primary.execute("""
+            SELECT m.name FROM sqlite_master m
+            WHERE m.type='table' AND m.name NOT LIKE 'sqlite_%' AND m.name NOT LIKE '\\_%' ESCAPE '\\'
+            AND EXISTS (SELECT 1 FROM pragma_table_info(m.name) p WHERE p.name = 'id')
+        """).fetchall()
+    ]
+    statements = []
+    for table in tables:
+        for op, ref in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+            statements.append((f"""
+                CREATE TRIGGER IF NOT EXISTS _replica_{table}_{op.lower()}
+                AFTER {op} ON {table}
+                BEGIN
+                    INSERT INTO {CHANGE_LOG_TABLE} (tbl, row_id) VALUES ('{table}', {ref}.id);
+                END
+            """, ()))
+    primary.batch(statements)
+    primary.commit()
+
+
+def drop_change_log(primary):
+    triggers = [r["name"] for r in primary.execute(_TRIGGERS_SQL).fetchall()]
+    primary.batch([(f"DROP TRIGGER IF EXISTS {name}", ()) for name in triggers] + [
+        (f"DROP TABLE IF EXISTS {CHANGE_LOG_TABLE}", ()),
+        (f"DROP TABLE IF EXISTS {PROGRESS_TABLE}", ()),
+        ("DELETE FROM schema_meta WHERE key='replica_pruned'", ()),
+    ])
+    primary.commit()
+
+
+def prune_change_log(primary, replica, seq):
+    # Report this replica's position, forget replicas that stopped reporting,
+    # and drop the entries every remaining one has applied
+    primary.batch([
+        (f"""INSERT INTO {PROGRESS_TABLE} (replica, seq, updated_at) VALUES (?, ?, datetime('now'))
+            ON CONFLICT(replica) DO UPDATE SET seq=excluded.seq, updated_at=excluded.updated_at""",
+         (replica, seq)),
+        (f"DELETE FROM {PROGRESS_TABLE} WHERE updated_at < datetime('now', ?)",
+         (f"-{DB_REPLICA_STALE_AFTER} seconds",)),
+        (f"""INSERT INTO schema_meta (key, value)
+            SELECT 'replica_pruned', MIN(seq) FROM {PROGRESS_TABLE} WHERE true
+            ON CONFLICT(key) DO UPDATE SET value=MAX(CAST(value AS INTEGER), CAST(excluded.value AS INTEGER))""",
+         ()),
+        (f"""DELETE FROM {CHANGE_LOG_TABLE}
+            WHERE seq <= (SELECT CAST(value AS INTEGER) FROM schema_meta WHERE key='replica_pruned')""",
+         ()),
+    ])
+    primary.commit()
+
+
+# -----------------------
+# LOCAL SIDE
+# -----------------------
+# Every bootstrap builds a new generation file next to DB_REPLICA_PATH and
+# switches readers to it; the previous file is removed once the last
+# connection reading it has been released. Local connections come from the
+# SQLite pool in backend.db, so nothing is opened per greenlet.
+class _Replica:
+    def __init__(self, path):
+        self.root, self.ext = os.path.splitext(path)
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self.path = None
+        self.generation = 0
+        self.tables = set()
+        self.last_seq = None
+        self.last_sync = 0.0
+        self.last_prune = 0.0
+        self._lock = threading.Lock()
+        self._files_lock = threading.Lock()
+        self._readers = {}
+        self._retired = set()
+
+    def connect(self):
+        # Pair every connect() with release()
+        with self._files_lock:
+            path = self.path
+            self._readers[path] = self._readers.get(path, 0) + 1
+        return SQLiteConnection(path)
+
+    def release(self, conn):
+        path = conn.path
+        conn.close()
+        with self._files_lock:
+            self._readers[path] -= 1
+            if self._readers[path] or path not in self._retired:
+                return
+            del self._readers[path]
+            self._retired.discard(path)
+        _remove_files(path)
+
+    def _retire(self, path):
+        with self._files_lock:
+            if self._readers.get(path):
+                self._retired.add(path)
+                return
+            self._readers.pop(path, None)
+        _remove_files(path)
+
+    @property
+    def ready(self):
+        return self.last_seq is not None
+
+    def sync(self, primary, wait=False):
+        # Only one greenlet syncs at a time; the rest read what is there unless
+        # they need their own write to be visible
+        if not self._lock.acquire(blocking=wait):
+            return False
+        try:
+            if self.last_seq is None:
+                self._bootstrap(primary)
+            else:
+                self._pull(primary)
+            self.last_sync = time.monotonic()
+        finally:
+            self._lock.release()
+        if self.last_sync - self.last_prune >= DB_REPLICA_PRUNE_INTERVAL:
+            self.last_prune = self.last_sync
+            self._prune()
+        return True
+
+    def _prune(self):
+        conn = get_primary()
+        try:
+            prune_change_log(conn, self.name, self.last_seq)
+        except Exception as e:
+            print("Replica log prune failed:", e)
+        finally:
+            conn.close()
+
+    def _bootstrap(self, primary):
+        seq, schema, triggers = primary.batch([
+            # The log may have been pruned empty; the watermark still counts
+            (f"""SELECT MAX(
+                COALESCE((SELECT MAX(seq) FROM {CHANGE_LOG_TABLE}), 0),
+                COALESCE((SELECT CAST(value AS INTEGER) FROM schema_meta WHERE key='replica_pruned'), 0)
+            ) AS seq""", ()),
+            ("""
+                SELECT type, name, tbl_name, sql FROM sqlite_master
+                WHERE type IN ('table', 'index') AND sql IS NOT NULL
+                AND name NOT LIKE 'sqlite_%'
+            """, ()),
+            ("SELECT DISTINCT tbl_name FROM sqlite_master WHERE type='trigger' AND name LIKE '\\_replica\\_%' ESCAPE '\\'", ()),
+        ])
+        last_seq = seq.fetchone()["seq"]
+        tables = {r["tbl_name"] for r in triggers.fetchall()}
+        ddl = [r for r in schema.fetchall() if r["tbl_name"] in tables]
+        names = sorted(tables)
+        snapshots = primary.batch([(f"SELECT * FROM {t}", ()) for t in names])
+
+        # Built off to the side and renamed into place: nobody has the new
+        # generation's path open yet, and readers of the old one are untouched
+        self.generation += 1
+        path = f"{self.root}-{os.getpid()}-{self.generation}{self.ext or '.db'}"
+        _remove_files(path)
+        building = path + ".tmp"
+        if os.path.exists(building):
+            os.remove(building)
+        local = sqlite3.connect(building)
+        try:
+            with local:
+                for r in sorted(ddl, key=lambda r: r["type"] != "table"):
+                    local.execute(r["sql"])
+                for table, snapshot in zip(names, snapshots):
+                    _apply_rows(local, table, snapshot)
+        finally:
+            local.close()
+        os.replace(building, path)
+
+        with self._files_lock:
+            old, self.path = self.path, path
+        if old:
+            _sqlite_discard(old)
+            self._retire(old)
+        self.tables = tables
+        self.last_seq = last_seq
+
+    def _pull(self, primary):
+        while True:
+            changes, pruned = primary.batch([
+                (f"""
+                SELECT seq, tbl, row_id FROM {CHANGE_LOG_TABLE}
+                WHERE seq > ? ORDER BY seq LIMIT ?
+                """, (self.last_seq, SYNC_BATCH)),
+                ("SELECT value FROM schema_meta WHERE key='replica_pruned'", ()),
+            ])
+            changes = changes.fetchall()
+            pruned = pruned.fetchone()
+            if pruned and int(pruned["value"]) > self.last_seq:
+                # Entries this replica still needed were pruned while it was idle
+                print("Replica resync: fell behind the pruned change log")
+                self._bootstrap(primary)
+                return
+            if not changes:
+                return
+
+            changed = {}
+            for change in changes:
+                changed.setdefault(change["tbl"], set()).add(change["row_id"])
+            names = sorted(t for t in changed if t in self.tables)
+            fetches = []
+            for table in names:
+                ids = sorted(changed[table])
+                placeholders = ",".join("?" for _ in ids)
+                fetches.append((f"SELECT * FROM {table} WHERE id IN ({placeholders})", ids))
+            current = primary.batch(fetches)
+
+            conn = self.connect()
+            local = conn._db
+            try:
+                with local:
+                    for table, rows in zip(names, current):
+                        ids = sorted(changed[table])
+                        placeholders = ",".join("?" for _ in ids)
+                        local.execute(f"DELETE FROM {table} WHERE id IN ({placeholders})", ids)
+                        _apply_rows(local, table, rows)
+            except sqlite3.Error as e:
+                # Most likely a schema change on the primary; start over
+                print("Replica resync:", e)
+                self._bootstrap(primary)
+                return
+            finally:
+                self.release(conn)
+
+            self.last_seq = changes[-1]["seq"]
+            if len(changes) < SYNC_BATCH:
+                return
+
+
+def _remove_files(path):
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def _apply_rows(local, table, cursor):
+    rows = cursor.fetchall()
+    if not rows:
+        return
+    columns = list(rows[0].keys())
+    placeholders = ",".join("?" for _ in columns)
+    local.executemany(
+        f"INSERT OR REPLACE INTO {table} ({','.join(columns)}) VALUES ({placeholders})",
+        [tuple(row) for row in rows]
+    )
+
+
+_replica = {"pid": None, "instance": None}
+
+
+def get_replica():
+    # One replica per worker process
+    pid = os.getpid()
+    if _replica["pid"] != pid:
+        _replica["instance"] = _Replica(DB_REPLICA_PATH)
+        _replica["pid"] = pid
+    return _replica["instance"]
+
+
+# -----------------------
+# READ-YOUR-WRITES
+# -----------------------
+# After a write the replica is synced and the resulting log position is
+# remembered on flask.g and in the session. Reads wait for the replica to
+# reach that position (or go to the primary), so a request — and the one
+# after a redirect, even on another worker — sees its own changes.
+def _required_seq():
+    if not has_request_context():
+        return 0
+    return max(g.get("replica_seq", 0), session.get("replica_seq", 0))
+
+
+def _note_write(seq):
+    if has_request_context():
+        g.replica_seq = max(g.get("replica_seq", 0), seq)
+        session["replica_seq"] = g.replica_seq
+
+
+def _note_dirty():
+    if has_request_context():
+        g.replica_dirty = True
+
+
+# -----------------------
+# CONNECTION
+# -----------------------
+class ReplicaCursor:
+    def __init__(self, conn):
+        self._conn = conn
+        self._cursor = None
+
+    def execute(self, sql, params=()):
+        self._cursor = self._conn._route(sql).cursor()
+        self._cursor.execute(sql, params)
+        if _is_write(sql):
+            self._conn._wrote()
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self._cursor = self._conn.primary.cursor()
+        self._cursor.executemany(sql, seq_of_params)
+        self._conn._wrote()
+        return self
+
+    @property
+    def description(self):
+        return self._cursor.description if self._cursor else None
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid if self._cursor else None
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount if self._cursor else -1
+
+    def fetchone(self):
+        return self._cursor.fetchone() if self._cursor else None
+
+    def fetchmany(self, size=None):
+        return self._cursor.fetchmany(size) if self._cursor else []
+
+    def fetchall(self):
+        return self._cursor.fetchall() if self._cursor else []
+
+    def __iter__(self):
+        return iter(self._cursor) if self._cursor else iter(())
+
+
+class ReplicaConnection:
+    def __init__(self, primary):
+        self.primary = primary
+        self.replica = get_replica()
+        self._local = None
+        self._dirty = False
+
+    def _local_conn(self):
+        # Held until close(); swapped if the replica was re-bootstrapped since
+        if self._local is not None and self._local.path != self.replica.path:
+            self.replica.release(self._local)
+            self._local = None
+        if self._local is None:
+            self._local = self.replica.connect()
+        return self._local
+
+    def _primary_busy(self):
+        # Uncommitted or queued writes are only visible on the primary
+        return self.primary.in_transaction or bool(getattr(self.primary, "_statements", None))
+
+    def _route(self, sql):
+        if _is_write(sql) or self._primary_busy():
+            return self.primary
+        if sql.lstrip()[:6].upper() not in ("SELECT", "WITH"):
+            return self.primary
+        if not self._catch_up():
+            return self.primary
+        if not set(_TABLE_RE.findall(sql)) <= self.replica.tables:
+            return self.primary
+        return self._local_conn()
+
+    def _catch_up(self):
+        replica = self.replica
+        dirty = self._dirty or (has_request_context() and g.get("replica_dirty"))
+        try:
+            if dirty or not replica.ready or replica.last_seq < _required_seq():
+                replica.sync(self.primary, wait=True)
+                self._dirty = False
+                if has_request_context():
+                    g.pop("replica_dirty", None)
+            elif time.monotonic() - replica.last_sync > DB_REPLICA_SYNC_INTERVAL:
+                replica.sync(self.primary)
+        except Exception as e:
+            print("Replica sync failed:", e)
+            return False
+        return replica.last_seq >= _required_seq()
+
+    def _wrote(self):
+        # Synced on commit(), or before the next read if commit() never comes
+        self._dirty = True
+        _note_dirty()
+
+    def cursor(self):
+        return ReplicaCursor(self)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def batch(self, statements):
+        statements = list(statements)
+        wrote = any(_is_write(sql) for sql, _ in statements)
+        if wrote or self._primary_busy():
+            cursors = self.primary.batch(statements)
+            if wrote:
+                self._wrote()
+            return cursors
+        return [self.execute(sql, params) for sql, params in statements]
+
+    @property
+    def in_transaction(self):
+        return self.primary.in_transaction
+
+    def begin(self, mode="DEFERRED"):
+        self.primary.begin(mode)
+
+    def commit(self):
+        wrote = self._dirty or self._primary_busy()
+        self.primary.commit()
+        if not wrote:
+            return
+        try:
+            self.replica.sync(self.primary, wait=True)
+            self._dirty = False
+            _note_write(self.replica.last_seq)
+        except Exception as e:
+            print("Replica sync failed:", e)
+            _note_dirty()
+
+    def rollback(self):
+        self._dirty = False
+        self.primary.rollback()
+
+    @contextmanager
+    def transaction(self, mode="DEFERRED"):
+        self.begin(mode)
+        try:
+            yield self
+        except BaseException:
+            try:
+                self.rollback()
+            except Exception as e:
+                print("Rollback failed:", e)
+            raise
+        self.commit()
+
+    def close(self):
+        if self._local is not None:
+            self.replica.release(self._local)
+            self._local = None
+        self.primary.close()
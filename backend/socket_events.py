@@ -2,6 +2,8 @@ from flask import session
 from flask_socketio import join_room
 from extensions import socketio
 from state import online_users
+from backend.principal import is_admin
+from backend.fanout import STUDENTS_ROOM
 
 
 @socketio.on("connect")
@@ -10,6 +12,9 @@ def handle_connect():
         user_id = session["user_id"]
         online_users.add(user_id)
         join_room(f"user_{user_id}")
+        # Broadcasts are emitted once to this shared room
+        if not is_admin(user_id):
+            join_room(STUDENTS_ROOM)
 
 
 @socketio.on("disconnect")
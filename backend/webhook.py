@@ -3,7 +3,8 @@ import hmac
 import hashlib
 import os
 from backend.db import get_db
-from backend.email_service import send_payment_success_email
+from backend.principal import revoke_claims
+from backend.outbox import enqueue_email, wake_outbox
 
 webhook_bp = Blueprint("webhook_bp", __name__)
 
@@ -38,59 +39,59 @@ def paystack_webhook():
     if not email or not reference or amount is None:
         return jsonify({"status": "invalid_payload"}), 200
 
-    conn = get_db()
-    c = conn.cursor()
-
-    c.execute("SELECT id FROM payments WHERE reference = ?", (reference,))
-    if c.fetchone():
-        conn.close()
-        return jsonify({"status": "duplicate"}), 200
-
-    c.execute("SELECT id, name FROM users WHERE email = ?", (email,))
-    user = c.fetchone()
-    if not user:
-        conn.close()
-        return jsonify({"status": "user_not_found"}), 200
-
-    user_id = user["id"]
-    user_name = user["name"]
-
-    c.execute("""
-        SELECT * FROM payments WHERE user_id = ? ORDER BY id DESC LIMIT 1
-    """, (user_id,))
-    payment = c.fetchone()
-
-    paid_now = False
-
-    if not payment:
-        c.execute("""
-            INSERT INTO payments (user_id, amount, status, reference, paid_at)
-            VALUES (?, ?, 'paid', ?, datetime('now'))
-        """, (user_id, amount, reference))
-        paid_now = True
-
-    elif payment["admin_override_status"] == "unpaid":
-        conn.close()
-        return jsonify({"status": "blocked_by_admin"}), 200
-
-    elif payment["admin_override_status"] == "paid":
+    # The combined lookup runs on its own, so the duplicate/blocked/no-op
+    # outcomes cost one round trip and no transaction. A payment is then
+    # written in one BEGIN IMMEDIATE + writes + COMMIT round trip; its writes
+    # are guarded on the reference so a concurrent callback or retry that got
+    # there first makes them no-ops (and the email dedupe key does the same).
+    conn = get_db(deferred=True)
+    try:
+        row = conn.execute("""
+            SELECT
+                EXISTS(SELECT 1 FROM payments WHERE reference = ?) AS duplicate,
+                u.id AS user_id, u.name,
+                p.id AS payment_id, p.status, p.admin_override_status
+            FROM (SELECT 1)
+            LEFT JOIN users u ON u.email = ?
+            LEFT JOIN payments p ON p.id = (
+                SELECT MAX(id) FROM payments WHERE user_id = u.id
+            )
+        """, (reference, email)).fetchone()
+
+        if row["duplicate"]:
+            return jsonify({"status": "duplicate"}), 200
+
+        if row["user_id"] is None:
+            return jsonify({"status": "user_not_found"}), 200
+
+        if row["payment_id"] is not None:
+            if row["admin_override_status"] == "unpaid":
+                return jsonify({"status": "blocked_by_admin"}), 200
+            if row["admin_override_status"] == "paid":
+                return jsonify({"status": "admin_paid"}), 200
+            if row["status"] != "unpaid":
+                return jsonify({"status": "ok"}), 200
+
+        user_id = row["user_id"]
+        with conn.transaction("IMMEDIATE"):
+            if row["payment_id"] is None:
+                conn.execute("""
+                    INSERT INTO payments (user_id, amount, status, reference, paid_at)
+                    SELECT ?, ?, 'paid', ?, datetime('now')
+                    WHERE NOT EXISTS (SELECT 1 FROM payments WHERE reference = ?)
+                """, (user_id, amount, reference, reference))
+            else:
+                conn.execute("""
+                    UPDATE payments SET status='paid', reference=?, paid_at=datetime('now')
+                    WHERE user_id=? AND status='unpaid'
+                    AND NOT EXISTS (SELECT 1 FROM payments WHERE reference = ?)
+                """, (reference, user_id, reference))
+            revoke_claims(conn, user_id)
+            # Same key as the payment callback, so only one of them sends
+            enqueue_email(conn, email, "payment_success", {"name": row["name"]},
+                          dedupe_key=f"payment:{reference}")
+    finally:
         conn.close()
-        return jsonify({"status": "admin_paid"}), 200
-
-    elif payment["status"] == "unpaid":
-        c.execute("""
-            UPDATE payments SET status='paid', reference=?, paid_at=datetime('now')
-            WHERE user_id=? AND status='unpaid'
-        """, (reference, user_id))
-        paid_now = True
-
-    conn.commit()
-    conn.close()
-
-    if paid_now:
-        try:
-            send_payment_success_email(email, user_name)
-        except Exception as e:
-            print("Webhook payment email failed:", e)
 
+    wake_outbox()
     return jsonify({"status": "ok"}), 200
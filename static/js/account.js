@@ -30,7 +30,7 @@ document.addEventListener("DOMContentLoaded", async () => {
     async function loadCourses() {
         if (!coursesList) return;
         try {
-            const res = await fetch("/api/courses/my", { credentials: "same-origin" });
+            const res = await fetch("/api/courses/my", { credentials: "same-origin", cache: "no-cache" });
             if (!res.ok) throw new Error("Failed to fetch courses");
             const data = await res.json();
             coursesList.innerHTML = "";
@@ -69,7 +69,7 @@ document.addEventListener("DOMContentLoaded", async () => {
         if (!paymentStatusEl || !payBtn) return;
 
         try {
-            const res = await fetch("/api/payment/status", { credentials: "same-origin" });
+            const res = await fetch("/api/payment/status", { credentials: "same-origin", cache: "no-cache" });
             if (!res.ok) {
                 if (res.status === 401) {
                     paymentStatusEl.textContent = "UNPAID ❌";
@@ -111,7 +111,7 @@ document.addEventListener("DOMContentLoaded", async () => {
     /* -------------------- LOAD USER INFO -------------------- */
     async function loadUserInfo() {
         try {
-            const meRes = await fetch("/api/auth/me", { credentials: "same-origin" });
+            const meRes = await fetch("/api/auth/me", { credentials: "same-origin", cache: "no-cache" });
             if (!meRes.ok) return;
             const user = await meRes.json();
             const usernameEl = document.getElementById("username");
@@ -25,103 +25,181 @@ if (bell) {
         return date.toLocaleString();
     }
 
-    function loadNotifications() {
-        fetch("/api/notifications")
-        .then(res => res.json())
-        .then(data => {
-            notifList.innerHTML = "";
-            let unread = 0;
-
-            if (data.length === 0) {
-                notifList.innerHTML = "<p style='padding:15px;'>No notifications yet.</p>";
-            }
-
-            data.forEach(n => {
-
-                if (!n.is_read) unread++;
+    // Newest first; ids of what is already on screen
+    const shown = new Set();
+    let newestId = null;
+    let oldestId = null;
+    let unread = 0;
+
+    function renderCount() {
+        if (unread > 0) {
+            notifCount.textContent = unread;
+            notifCount.style.display = "inline-block";
+        } else {
+            notifCount.style.display = "none";
+        }
+    }
 
-                const div = document.createElement("div");
-                div.className = `notif-item ${n.is_read ? "" : "unread"}`;
+    function renderEmpty() {
+        if (shown.size === 0) {
+            notifList.innerHTML = "<p style='padding:15px;'>No notifications yet.</p>";
+        }
+    }
 
-                div.innerHTML = `
-                    <h4>${n.title}</h4>
-                    <p>${n.message}</p>
-                    <small>${formatDateTime(n.created_at)}</small>
-                `;
+    function notificationItem(n) {
+        const div = document.createElement("div");
+        div.className = `notif-item ${n.is_read ? "" : "unread"}`;
+        div.dataset.id = n.id;
+
+        div.innerHTML = `
+            <h4>${n.title}</h4>
+            <p>${n.message}</p>
+            <small>${formatDateTime(n.created_at)}</small>
+        `;
+
+        div.onclick = () => {
+            fetch(`/api/notifications/read/${n.id}`, {
+                method: "POST"
+            }).then(() => {
+                window.location = n.link || "#";
+            });
+        };
+        return div;
+    }
 
-                div.onclick = () => {
-                    fetch(`/api/notifications/read/${n.id}`, {
-                        method: "POST"
-                    }).then(() => {
-                        window.location = n.link || "#";
-                    });
-                };
+    function addItems(items, position) {
+        if (shown.size === 0) notifList.innerHTML = "";
+        const fragment = document.createDocumentFragment();
+        items.forEach(n => {
+            if (shown.has(n.id)) return;
+            shown.add(n.id);
+            fragment.appendChild(notificationItem(n));
+            if (newestId === null || n.id > newestId) newestId = n.id;
+            if (oldestId === null || n.id < oldestId) oldestId = n.id;
+        });
+        if (position === "top") {
+            notifList.insertBefore(fragment, notifList.firstChild);
+        } else {
+            notifList.insertBefore(fragment, moreButton.parentNode ? moreButton : null);
+        }
+    }
 
-                notifList.appendChild(div);
-            });
+    const moreButton = document.createElement("button");
+    moreButton.className = "notif-more";
+    moreButton.textContent = "Load older";
+    moreButton.onclick = (e) => {
+        e.stopPropagation();
+        loadPage(oldestId);
+    };
 
-            if (unread > 0) {
-                notifCount.textContent = unread;
-                notifCount.style.display = "inline-block";
+    function loadPage(before) {
+        const url = before ? `/api/notifications?before=${before}` : "/api/notifications";
+        return fetch(url, { cache: "no-cache" })
+        .then(res => res.json())
+        .then(data => {
+            addItems(data.items, "bottom");
+            if (data.has_more) {
+                notifList.appendChild(moreButton);
             } else {
-                notifCount.style.display = "none";
+                moreButton.remove();
             }
+            renderEmpty();
         });
     }
 
-    // Real-time updates
-    socket.on("new_notification", () => {
-        loadNotifications();
-    });
-
-    loadNotifications();
-}
+    function loadUnreadCount() {
+        return fetch("/api/notifications/unread-count", { cache: "no-cache" })
+        .then(res => res.json())
+        .then(data => {
+            unread = data.unread;
+            renderCount();
+        });
+    }
 
-/* ---------------- PUSH SUBSCRIPTION ---------------- */
+    // Only what arrived while the socket was down
+    function loadSince() {
+        if (newestId === null) return loadPage(null);
+        return fetch(`/api/notifications?since_id=${newestId}&limit=100`, { cache: "no-cache" })
+        .then(res => res.json())
+        .then(data => {
+            if (data.has_more) {
+                // Too far behind to patch; start over from the newest page
+                shown.clear();
+                newestId = oldestId = null;
+                notifList.innerHTML = "";
+                return loadPage(null);
+            }
+            addItems(data.items, "top");
+        });
+    }
 
-const publicKey = typeof VAPID_PUBLIC_KEY !== "undefined" ? VAPID_PUBLIC_KEY : null;
+    // Real-time updates: the event carries the notification itself
+    socket.on("new_notification", (n) => {
+        if (!n || n.id === undefined || shown.has(n.id)) return;
+        addItems([n], "top");
+        if (!n.is_read) {
+            unread++;
+            renderCount();
+        }
+    });
 
-async function subscribePush() {
+    // Read/archive changes made in another tab or device
+    function applySync(data) {
+        data.ids.forEach(id => {
+            const item = notifList.querySelector(`.notif-item[data-id="${id}"]`);
+            if (!item) return;
+            if (data.action === "archive") {
+                item.remove();
+                shown.delete(id);
+            } else {
+                item.classList.remove("unread");
+            }
+        });
+        unread = data.unread;
+        renderCount();
+        renderEmpty();
+    }
 
-    if (!publicKey) return;
+    socket.on("notifications_sync", applySync);
 
-    const registration = await navigator.serviceWorker.ready;
+    const readAll = document.getElementById("notif-read-all");
+    if (readAll) {
+        readAll.addEventListener("click", (e) => {
+            e.stopPropagation();
+            fetch("/api/notifications/read-all", { method: "POST" })
+            .then(res => res.json())
+            .then(applySync);
+        });
+    }
 
-    const subscription = await registration.pushManager.subscribe({
-        userVisibleOnly: true,
-        applicationServerKey: urlBase64ToUint8Array(publicKey)
+    let connectedBefore = false;
+    socket.on("connect", () => {
+        if (connectedBefore) {
+            loadSince();
+            loadUnreadCount();
+        }
+        connectedBefore = true;
     });
 
-    await fetch("/api/subscribe", {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify(subscription)
-    });
+    loadPage(null);
+    loadUnreadCount();
 }
 
-function urlBase64ToUint8Array(base64String) {
-    const padding = "=".repeat((4 - base64String.length % 4) % 4);
-    const base64 = (base64String + padding)
-        .replace(/-/g, "+")
-        .replace(/_/g, "/");
-
-    const rawData = atob(base64);
-    return Uint8Array.from([...rawData].map(c => c.charCodeAt(0)));
-}
+/* ---------------- PUSH SUBSCRIPTION ---------------- */
 
+// Subscribing and saving the subscription is handled by push.js; this only
+// asks for permission the first time.
 document.addEventListener("DOMContentLoaded", async () => {
 
     if (!("serviceWorker" in navigator)) return;
 
-    // Only ask if permission not already granted
+    // Only ask if permission not already granted; push.js covers the
+    // already-granted case on its own
     if (Notification.permission === "default") {
         const permission = await Notification.requestPermission();
-        if (permission !== "granted") return;
-    }
-
-    // If granted, subscribe
-    if (Notification.permission === "granted") {
-        await subscribePush();
+        if (permission === "granted" && typeof subscribeToPush === "function") {
+            await subscribeToPush();
+        }
     }
 
 });
\ No newline at end of file
@@ -17,6 +17,12 @@ function pushLog(msg) {
     if (el) el.innerHTML += msg + "<br>";
 }
 
+// The server keys subscriptions by endpoint, so the browser's existing
+// subscription is reused and only re-sent when it changed, when a different
+// account signed in on this browser, or about once a day (which keeps its
+// last_seen fresh). Each re-send moves the endpoint to the signed-in user.
+const PUSH_RESYNC_MS = 24 * 60 * 60 * 1000;
+
 async function subscribeToPush() {
     pushLog("SW supported: " + ("serviceWorker" in navigator));
     pushLog("Push supported: " + ("PushManager" in window));
@@ -26,26 +32,34 @@ async function subscribeToPush() {
     if (!("serviceWorker" in navigator)) { pushLog("STOP: no SW"); return; }
     if (!("PushManager" in window)) { pushLog("STOP: no PushManager"); return; }
     if (typeof VAPID_PUBLIC_KEY === "undefined" || !VAPID_PUBLIC_KEY) { pushLog("STOP: no VAPID"); return; }
+    if (Notification.permission !== "granted") { pushLog("STOP: permission not granted"); return; }
+    if (typeof PUSH_USER_ID === "undefined" || PUSH_USER_ID === null) { pushLog("STOP: not signed in"); return; }
 
     try {
         pushLog("Waiting for SW...");
         const registration = await navigator.serviceWorker.ready;
         pushLog("SW ready: " + registration.scope);
 
-        // Force unsubscribe any existing subscription first
-        const existing = await registration.pushManager.getSubscription();
-        if (existing) {
-            pushLog("Clearing old subscription...");
-            await existing.unsubscribe();
-            pushLog("Old subscription cleared");
+        let subscription = await registration.pushManager.getSubscription();
+        if (subscription) {
+            pushLog("Existing subscription: " + subscription.endpoint.substring(0, 40) + "...");
+        } else {
+            pushLog("Subscribing...");
+            subscription = await registration.pushManager.subscribe({
+                userVisibleOnly: true,
+                applicationServerKey: urlBase64ToUint8Array(VAPID_PUBLIC_KEY)
+            });
+            pushLog("Subscribed: " + subscription.endpoint.substring(0, 40) + "...");
         }
 
-        pushLog("Subscribing fresh...");
-        const subscription = await registration.pushManager.subscribe({
-            userVisibleOnly: true,
-            applicationServerKey: urlBase64ToUint8Array(VAPID_PUBLIC_KEY)
-        });
-        pushLog("Subscribed: " + subscription.endpoint.substring(0, 40) + "...");
+        // Cached per user: another account on this browser must re-send
+        const syncedKey = PUSH_USER_ID + " " + subscription.endpoint;
+        const syncedAt = Number(localStorage.getItem("pushSyncedAt") || 0);
+        if (localStorage.getItem("pushSyncedFor") === syncedKey &&
+            Date.now() - syncedAt < PUSH_RESYNC_MS) {
+            pushLog("Subscription already saved");
+            return;
+        }
 
         const res = await fetch("/admin/api/subscribe", {
             method: "POST",
@@ -56,6 +70,8 @@ async function subscribeToPush() {
         pushLog("Server: " + res.status);
 
         if (res.ok) {
+            localStorage.setItem("pushSyncedFor", syncedKey);
+            localStorage.setItem("pushSyncedAt", String(Date.now()));
             pushLog("SUCCESS - push subscription saved!");
         } else {
             pushLog("FAILED - server rejected subscription");
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# Config is read at import time: run everything on a throwaway local SQLite
+# file (TURSO_URL=file:...) so no test needs Turso or Brevo
+_db_path = os.path.join(tempfile.mkdtemp(prefix="widemind-tests-"), "primary.db")
+os.environ.setdefault("TURSO_URL", f"file:{_db_path}")
+os.environ.setdefault("SQLITE_PATH", _db_path)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
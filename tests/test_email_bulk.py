@@ -0,0 +1,90 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from backend import email_service
+
+TEMPLATE_PARAMS = {"material_title": "Week 1", "course_title": "Calculus", "file_type": "pdf", "course_id": 1}
+
+
+class StubBrevo(BaseHTTPRequestHandler):
+    # Rejects any request carrying an address with "bad" in it, like Brevo
+    # does for a malformed recipient; status can be forced for every request
+    requests = []
+    status = None
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        StubBrevo.requests.append(body)
+        emails = [v["to"][0]["email"] for v in body.get("messageVersions", [])]
+        status = StubBrevo.status or (400 if any("bad" in e for e in emails) else 201)
+        self.send_response(status)
+        self.end_headers()
+        self.wfile.write(b'{"messageIds": ["x"]}' if status == 201 else b'{"code": "invalid_parameter"}')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def brevo(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubBrevo)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    StubBrevo.requests = []
+    StubBrevo.status = None
+    monkeypatch.setattr(email_service, "BREVO_API_URL", f"http://127.0.0.1:{server.server_port}/v3")
+    monkeypatch.setenv("BREVO_API_KEY", "test-key")
+    yield StubBrevo
+    server.shutdown()
+    server.server_close()
+
+
+def _recipients(n):
+    return [{"email": f"student{i}@example.com", "name": f"student {i}"} for i in range(n)]
+
+
+def test_recipients_are_split_at_the_batch_size(brevo, monkeypatch):
+    monkeypatch.setattr(email_service, "BREVO_BATCH_SIZE", 3)
+    seen = []
+    results = email_service.send_bulk_email(
+        "new_material", TEMPLATE_PARAMS, _recipients(7), on_result=lambda i, error: seen.append(i)
+    )
+    assert results == [None] * 7
+    assert sorted(seen) == list(range(7))
+    assert sorted(len(r["messageVersions"]) for r in brevo.requests) == [1, 3, 3]
+
+    versions = [v for r in brevo.requests for v in r["messageVersions"]]
+    assert sorted(v["to"][0]["email"] for v in versions) == sorted(r["email"] for r in _recipients(7))
+    assert {v["params"]["first_name"] for v in versions} == {"Student"}
+    # Shared parts are rendered once, with Brevo filling in the first name
+    assert all(email_service.FIRST_NAME_SLOT in r["htmlContent"] for r in brevo.requests)
+    assert all("Calculus" in r["subject"] for r in brevo.requests)
+
+
+def test_a_rejected_chunk_is_bisected_down_to_the_bad_address(brevo, monkeypatch):
+    monkeypatch.setattr(email_service, "BREVO_BATCH_SIZE", 8)
+    recipients = _recipients(8)
+    recipients[5]["email"] = "bad@example"
+    results = email_service.send_bulk_email("new_material", TEMPLATE_PARAMS, recipients)
+
+    reason, permanent = results[5]
+    assert reason.startswith("400")
+    assert permanent
+    assert results[:5] + results[6:] == [None] * 7
+    # 8 -> 4 + 4 -> 2 + 2 -> 1 + 1
+    assert len(brevo.requests) == 7
+
+
+def test_rate_limits_are_transient_and_not_bisected(brevo):
+    brevo.status = 429
+    results = email_service.send_bulk_email("new_material", TEMPLATE_PARAMS, _recipients(4))
+    assert len(brevo.requests) == 1
+    assert all(error[0].startswith("429") and not error[1] for error in results)
+
+
+def test_missing_api_key_fails_every_recipient_without_a_request(brevo, monkeypatch):
+    monkeypatch.delenv("BREVO_API_KEY")
+    results = email_service.send_bulk_email("new_material", TEMPLATE_PARAMS, _recipients(3))
+    assert results == [("BREVO_API_KEY missing", False)] * 3
+    assert brevo.requests == []
+    assert email_service.deliver_email("a@example.com", "s", "<p>b</p>") == ("BREVO_API_KEY missing", False)
@@ -0,0 +1,135 @@
+import os
+import pytest
+from backend import db, replica
+
+
+@pytest.fixture
+def primary_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "primary.db")
+    monkeypatch.setattr(db, "SQLITE_PATH", path)
+    monkeypatch.setattr(db, "DB_BACKEND", "sqlite")
+    return path
+
+
+@pytest.fixture
+def replica_mode(primary_path, tmp_path, monkeypatch):
+    path = str(tmp_path / "replica.db")
+    monkeypatch.setattr(db, "DB_REPLICA_PATH", path)
+    monkeypatch.setattr(replica, "DB_REPLICA_PATH", path)
+    monkeypatch.setattr(replica, "_replica", {"pid": None, "instance": None})
+    db.migrate()
+    return replica.get_replica()
+
+
+def _add_course(code):
+    conn = db.get_db()
+    conn.execute("INSERT INTO courses (course_code, course_title) VALUES (?, ?)", (code, code))
+    conn.commit()
+    conn.close()
+
+
+def _course_codes():
+    conn = db.get_db()
+    codes = [r["course_code"] for r in conn.execute("SELECT course_code FROM courses ORDER BY id").fetchall()]
+    conn.close()
+    return codes
+
+
+def _log_seqs():
+    conn = db.get_primary()
+    seqs = [r["seq"] for r in conn.execute(f"SELECT seq FROM {replica.CHANGE_LOG_TABLE}").fetchall()]
+    conn.close()
+    return seqs
+
+
+def _triggers():
+    conn = db.get_primary()
+    names = [r["name"] for r in conn.execute(replica._TRIGGERS_SQL).fetchall()]
+    conn.close()
+    return names
+
+
+def test_reads_are_served_from_the_replica(replica_mode):
+    _add_course("MTH101")
+    assert _course_codes() == ["MTH101"]
+    assert replica_mode.ready
+
+    local = replica_mode.connect()
+    assert [r["course_code"] for r in local.execute("SELECT course_code FROM courses")] == ["MTH101"]
+    replica_mode.release(local)
+
+    _add_course("PHY101")
+    assert _course_codes() == ["MTH101", "PHY101"]
+
+
+def test_local_connections_are_pooled(replica_mode):
+    _add_course("MTH101")
+    for _ in range(5):
+        _course_codes()
+    # Every reader gave its connection back; one idle handle is reused
+    assert replica_mode._readers == {replica_mode.path: 0}
+    assert len(db._sqlite_idle[replica_mode.path]) == 1
+
+
+def test_log_is_pruned_to_the_slowest_replica(replica_mode, monkeypatch):
+    monkeypatch.setattr(replica, "DB_REPLICA_PRUNE_INTERVAL", 0)
+    conn = db.get_primary()
+    replica.prune_change_log(conn, "other-worker", 0)
+    conn.close()
+
+    _add_course("MTH101")
+    _add_course("PHY101")
+    _course_codes()
+    # Held back by the other replica, which has applied nothing yet
+    assert len(_log_seqs()) == 2
+
+    conn = db.get_primary()
+    replica.prune_change_log(conn, "other-worker", replica_mode.last_seq)
+    conn.close()
+    assert _log_seqs() == []
+
+    # Pruned empty, the log keeps counting from where it was
+    _add_course("CHM101")
+    assert _course_codes() == ["MTH101", "PHY101", "CHM101"]
+
+
+def test_replica_behind_the_pruned_log_rebootstraps(replica_mode):
+    _add_course("MTH101")
+    _course_codes()
+    first = replica_mode.path
+
+    reader = replica_mode.connect()
+    watermark = replica_mode.last_seq + 10
+    conn = db.get_primary()
+    conn.execute(
+        "INSERT OR REPLACE INTO schema_meta (key, value) VALUES ('replica_pruned', ?)",
+        (str(watermark),)
+    )
+    conn.execute("INSERT INTO courses (course_code, course_title) VALUES ('PHY101', 'PHY101')")
+    conn.commit()
+    conn.close()
+
+    replica_mode.sync(db.get_primary(), wait=True)
+    assert replica_mode.path != first
+    assert replica_mode.last_seq >= watermark
+    # The old generation stays on disk while it is still being read
+    assert os.path.exists(first)
+    assert [r["course_code"] for r in reader.execute("SELECT course_code FROM courses")] == ["MTH101"]
+    replica_mode.release(reader)
+    assert not os.path.exists(first)
+
+    assert _course_codes() == ["MTH101", "PHY101"]
+
+
+def test_change_log_is_dropped_without_replica_mode(replica_mode, monkeypatch):
+    assert _triggers()
+    monkeypatch.setattr(db, "DB_REPLICA_PATH", "")
+    db.migrate()
+    assert _triggers() == []
+
+    conn = db.get_primary()
+    conn.execute("INSERT INTO courses (course_code, course_title) VALUES ('MTH101', 'MTH101')")
+    conn.commit()
+    tables = [r["name"] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()]
+    conn.close()
+    assert replica.CHANGE_LOG_TABLE not in tables